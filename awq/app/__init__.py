@@ -1 +1,10 @@
-# This file can be empty, it just marks the directory as a Python package
+# app/__init__.py
+
+import os
+import sys
+
+# Modules shared with the exl2 pipeline, such as common/model_store.py, live next to awq/.
+# The repository root goes first so an installed package named common cannot shadow them
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
@@ -0,0 +1,147 @@
+# app/calibration_cache.py
+
+import os
+import re
+import json
+import hashlib
+import logging
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# AutoAWQ's default calibration corpus
+PILEVAL = 'pileval'
+PILEVAL_DATASET = 'mit-han-lab/pile-val-backup'
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    A sha256 identifying how a tokenizer encodes text.
+
+    Fast tokenizers are fingerprinted from their full serialization (vocabulary,
+    merges, normalizer, pre-tokenizer), others from their class, vocabulary and
+    special tokens. Tokenizers of one family that encode identically share a
+    fingerprint, whatever repository they were loaded from.
+    """
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        payload = backend.to_str()
+    else:
+        payload = json.dumps({
+            'class': type(tokenizer).__name__,
+            'vocab': sorted(tokenizer.get_vocab().items()),
+            'special': sorted(str(token) for token in getattr(tokenizer, 'all_special_tokens', [])),
+        })
+    if not isinstance(payload, str):
+        raise TypeError(f"Cannot fingerprint tokenizer {type(tokenizer).__name__}")
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def load_calibration_texts(source: str, split: str = 'train', text_column: str = 'text') -> Iterator[str]:
+    """
+    Texts of a calibration corpus, in the order AutoAWQ would use them.
+
+    source is 'pileval' (AutoAWQ's default), a Hugging Face dataset name, or a
+    local file: JSON lines with a text_column field, or plain text with one
+    sample per line. Hub datasets are shuffled with seed 42 like AutoAWQ does.
+    """
+    if os.path.isfile(source):
+        with open(source, 'r', encoding='utf-8') as f:
+            for line in f:
+                if source.endswith('.jsonl'):
+                    line = json.loads(line)[text_column] if line.strip() else ''
+                yield line
+        return
+
+    from datasets import load_dataset
+    if source == PILEVAL:
+        dataset = load_dataset(PILEVAL_DATASET, split='validation')
+    else:
+        dataset = load_dataset(source, split=split)
+    for row in dataset.shuffle(seed=42):
+        yield row[text_column]
+
+def tokenize_calibration(texts: Iterable[str], tokenizer, n_samples: int, seqlen: int) -> np.ndarray:
+    """
+    Turn calibration texts into blocks of seqlen tokens, exactly like AutoAWQ's get_calib_dataset.
+
+    The first n_samples non-empty texts of at most seqlen tokens are encoded,
+    concatenated and cut into as many whole blocks as they fill.
+
+    Returns:
+        np.ndarray: int32 array of shape (blocks, seqlen).
+    """
+    encoded: List[int] = []
+    used = 0
+    for text in texts:
+        tokens = tokenizer.encode(text.strip())
+        if not tokens or len(tokens) > seqlen:
+            continue
+        encoded.extend(tokens)
+        used += 1
+        if used == n_samples:
+            break
+    blocks = len(encoded) // seqlen
+    if blocks == 0:
+        raise ValueError(f"Calibration texts give {len(encoded)} tokens, fewer than one block of {seqlen}")
+    return np.asarray(encoded[:blocks * seqlen], dtype=np.int32).reshape(blocks, seqlen)
+
+class CalibrationCache:
+    """
+    Pre-tokenized calibration sets stored as .npy token arrays.
+
+    A set is keyed by its source, the tokenizer fingerprint, the sample count
+    and the sequence length, so every job quantizing a model of the same
+    tokenizer family reuses it without downloading or tokenizing the corpus
+    again. Local sources are also keyed by their size and mtime, so an edited
+    file is tokenized again. Arrays are opened memory mapped.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, source: str, fingerprint: str, n_samples: int, seqlen: int) -> str:
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', os.path.basename(source) if os.path.isfile(source) else source)
+        if os.path.isfile(source):
+            stat = os.stat(source)
+            identity = f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}"
+            name = f"{name}-{hashlib.sha256(identity.encode('utf-8')).hexdigest()[:8]}"
+        return os.path.join(self.root, f"{name}-{fingerprint[:16]}-n{n_samples}-s{seqlen}.npy")
+
+    def load(self, source: str, fingerprint: str, n_samples: int, seqlen: int) -> Optional[np.ndarray]:
+        """
+        The cached token array for this key, memory mapped, or None.
+        """
+        path = self.path(source, fingerprint, n_samples, seqlen)
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable calibration set {path}: {str(e)}")
+            return None
+
+    def get_or_build(self, tokenizer, source: str, n_samples: int, seqlen: int,
+                     split: str = 'train', text_column: str = 'text') -> np.ndarray:
+        """
+        Load the calibration set for this tokenizer, building and storing it on a miss.
+
+        Returns:
+            np.ndarray: int32 token blocks of shape (blocks, seqlen).
+        """
+        fingerprint = tokenizer_fingerprint(tokenizer)
+        samples = self.load(source, fingerprint, n_samples, seqlen)
+        if samples is not None:
+            logger.info(f"Using cached calibration set for {source}: {samples.shape[0]} blocks of {seqlen} tokens")
+            return samples
+
+        logger.info(f"Tokenizing calibration set {source} ({n_samples} samples, {seqlen} tokens)")
+        samples = tokenize_calibration(load_calibration_texts(source, split, text_column), tokenizer, n_samples, seqlen)
+        path = self.path(source, fingerprint, n_samples, seqlen)
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, samples)
+        os.replace(tmp_path, path)
+        logger.info(f"Stored calibration set {path}: {samples.shape[0]} blocks")
+        return np.load(path, mmap_mode='r')
@@ -0,0 +1,180 @@
+# app/checkpointed_quantizer.py
+
+import logging
+from typing import Dict, Optional
+
+import torch
+from tqdm import tqdm
+from awq.modules.linear import WQLinear_GEMM, WQLinear_GEMV, WQLinear_GEMVFast, WQLinear_Marlin
+from awq.quantize.quantizer import AwqQuantizer
+from awq.quantize.scale import apply_clip, apply_scale
+from awq.utils.module import exclude_layers_to_not_quantize, get_named_linears, set_op_by_name
+from awq.utils.utils import clear_memory, get_best_device
+
+from app.layer_checkpoint import LayerCheckpoint
+from app.quant_trace import QuantTrace, trace_span
+
+logger = logging.getLogger(__name__)
+
+# WQLinear class _apply_quant uses for each quantization version
+WQLINEAR_VERSIONS = {
+    'gemm': WQLinear_GEMM,
+    'gemv': WQLinear_GEMV,
+    'marlin': WQLinear_Marlin,
+    'gemv_fast': WQLinear_GEMVFast,
+}
+
+class CheckpointedAwqQuantizer(AwqQuantizer):
+    """
+    AwqQuantizer that checkpoints every completed decoder layer and resumes after the last one.
+
+    Each layer goes through AutoAWQ's own steps (input features, scale search,
+    clipping, packing), which the other quantizers of this package reuse. With a LayerCheckpoint, the packed layer and the inputs
+    of the next layer are saved once it is done. A restarted job rebuilds the
+    completed layers from the checkpoint without searching them again and
+    continues with the saved inputs. Subclasses hook in with _load_layer,
+    _save_layer and _restore_layer. With a QuantTrace, the calibration capture,
+    every layer and every step within a layer are traced.
+
+    Passed to model.quantize as quantizer_cls, with the checkpoint in checkpoint
+    and the trace in trace.
+    """
+
+    def __init__(self, *args, checkpoint: Optional[LayerCheckpoint] = None, trace: Optional[QuantTrace] = None,
+                 **kwargs):
+        self.checkpoint = checkpoint
+        self.trace = trace
+        super().__init__(*args, **kwargs)
+
+    def init_quant(self, *args, **kwargs):
+        with trace_span(self.trace, 'calibration_capture'):
+            return super().init_quant(*args, **kwargs)
+
+    @torch.no_grad()
+    def quantize(self):
+        with trace_span(self.trace, 'resume'):
+            start = self._resume()
+        for i in tqdm(range(start, len(self.modules)), desc="AWQ", initial=start, total=len(self.modules)):
+            with trace_span(self.trace, 'layer', 'layer', layer=i):
+                with trace_span(self.trace, 'load', layer=i):
+                    self._load_layer(i)
+                self._quantize_layer(i)
+                with trace_span(self.trace, 'save', layer=i):
+                    self._save_layer(i)
+                clear_memory()
+
+    def _resume(self) -> int:
+        """
+        Restore the layers the checkpoint records as completed.
+
+        Returns:
+            int: Index of the first layer left to quantize.
+        """
+        if self.checkpoint is None or not self.checkpoint.completed:
+            return 0
+        completed = self.checkpoint.completed
+        if completed > len(self.modules):
+            raise ValueError(f"Checkpoint in {self.checkpoint.work_dir} has {completed} layers, the model {len(self.modules)}")
+        for i in range(completed):
+            self._restore_layer(i, self.checkpoint.load_layer(i))
+        inputs = self.checkpoint.load_inputs()
+        if inputs.shape != self.inps.shape:
+            raise ValueError(f"Checkpointed inputs have shape {tuple(inputs.shape)}, "
+                             f"the calibration set gives {tuple(self.inps.shape)}")
+        self.inps = inputs.to(self.inps.device, self.inps.dtype)
+        logger.info(f"Resuming quantization at layer {completed} of {len(self.modules)} from {self.checkpoint.work_dir}")
+        return completed
+
+    def _load_layer(self, i: int) -> None:
+        """
+        Make layer i ready to quantize. Layers are already in memory here.
+        """
+
+    def _restore_layer(self, i: int, tensors: Optional[Dict[str, torch.Tensor]]) -> None:
+        """
+        Rebuild checkpointed layer i as AutoAWQ leaves it: scaled activations and
+        WQLinear modules holding the saved packed weights, scales and zeros.
+        """
+        self._restore_module(self.modules[i], tensors)
+
+    def _restore_module(self, layer: torch.nn.Module, tensors: Dict[str, torch.Tensor]) -> torch.nn.Module:
+        """
+        Turn an unquantized decoder layer into the quantized one saved in tensors, with the current settings.
+        """
+        if not self.export_compatible:
+            self.awq_model._scale_activations(self.awq_model, layer)
+            named_linears = exclude_layers_to_not_quantize(get_named_linears(layer), self.modules_to_not_convert)
+            for name, linear in named_linears.items():
+                q_linear = WQLINEAR_VERSIONS[self.version].from_linear(linear, self.w_bit, self.group_size, init_only=True)
+                set_op_by_name(layer, name, q_linear)
+        layer.load_state_dict(tensors)
+        return layer
+
+    def _prepare_layer(self, i: int) -> None:
+        """
+        Move layer i to its device, as AutoAWQ does: CPU layers go to a GPU in turn.
+        The calibration inputs and the layer kwargs follow it.
+        """
+        common_device = next(self.modules[i].parameters()).device
+        if common_device is None or str(common_device) == "cpu":
+            if torch.cuda.is_available():
+                best_device = "cuda:" + str(i % torch.cuda.device_count())
+            else:
+                best_device = get_best_device()
+            self.modules[i] = self.modules[i].to(best_device)
+            common_device = next(self.modules[i].parameters()).device
+
+        for key in ("position_ids", "attention_mask"):
+            if self.module_kwargs.get(key) is not None:
+                self.module_kwargs[key] = self.module_kwargs[key].to(common_device)
+        self.inps = self.inps.to(common_device)
+
+    def _capture_input_feat(self, i: int) -> Dict[str, torch.Tensor]:
+        """
+        Inputs of the linears of layer i. Also moves self.inps on to the layer's outputs, the next layer's inputs.
+        """
+        named_linears = exclude_layers_to_not_quantize(get_named_linears(self.modules[i]), self.modules_to_not_convert)
+        with trace_span(self.trace, 'input_feat', layer=i):
+            input_feat = self._get_input_feat(self.modules[i], named_linears)
+            clear_memory()
+        return input_feat
+
+    def _search_and_scale(self, module: torch.nn.Module, input_feat: Dict[str, torch.Tensor], **span_args) -> None:
+        """
+        Search and apply the scales, then the clipping, of the current settings to module, in place.
+        apply_scale divides input_feat in place.
+        """
+        with trace_span(self.trace, 'scale_search', **span_args):
+            module_config = self.awq_model.get_layers_for_scaling(module, input_feat, self.module_kwargs)
+            scales_list = [self._search_best_scale(module, **config) for config in module_config]
+            apply_scale(module, scales_list, input_feat_dict=input_feat)
+        if self.apply_clip:
+            with trace_span(self.trace, 'clip_search', **span_args):
+                named_linears = exclude_layers_to_not_quantize(get_named_linears(module), self.modules_to_not_convert)
+                clip_list = self._search_best_clip(module, named_linears, input_feat)
+                apply_clip(module, clip_list)
+
+    def _pack(self, module: torch.nn.Module, **span_args) -> None:
+        """
+        Replace the linears of a scaled module with packed WQLinear modules, unless export_compatible.
+        """
+        if not self.export_compatible:
+            with trace_span(self.trace, 'pack', **span_args):
+                self._apply_quant(module, exclude_layers_to_not_quantize(get_named_linears(module),
+                                                                        self.modules_to_not_convert))
+
+    def _quantize_layer(self, i: int) -> None:
+        """
+        AutoAWQ's steps for layer i. Also moves self.inps on to the layer's outputs, the next layer's inputs.
+        """
+        self._prepare_layer(i)
+        input_feat = self._capture_input_feat(i)
+        self._search_and_scale(self.modules[i], input_feat, layer=i)
+        self._pack(self.modules[i], layer=i)
+
+    def _save_layer(self, i: int) -> None:
+        """
+        Checkpoint quantized layer i with the inputs of layer i + 1.
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.save(i, self.inps, self.modules[i].state_dict())
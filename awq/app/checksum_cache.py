@@ -0,0 +1,102 @@
+# app/checksum_cache.py
+
+import os
+import sqlite3
+import logging
+from typing import Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checksums (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+)
+"""
+
+def file_identity(path: str) -> Tuple[str, int, int, int]:
+    """
+    The cache key of a file: its absolute path, inode, size and mtime in nanoseconds.
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+class ChecksumCache:
+    """
+    Persistent sha256 cache for files, stored in a SQLite database.
+
+    A digest is only returned while the file keeps the path, inode, size and
+    mtime it was hashed with, so any rewrite, replacement or touch of the file
+    makes it miss. The database is opened on first use and is only meant to be
+    used from the thread that opened it. If it cannot be opened, e.g. because its
+    directory is not writable, every lookup misses and files are hashed as usual.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._unavailable = False
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self._connection is None and not self._unavailable:
+            connection = None
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+                connection = sqlite3.connect(self.db_path, timeout=30)
+                connection.execute(SCHEMA)
+            except (sqlite3.Error, OSError) as e:
+                # Warn once rather than for every file looked up
+                logger.warning(f"Checksum cache {self.db_path} is unavailable, hashing without it: {str(e)}")
+                if connection is not None:
+                    connection.close()
+                self._unavailable = True
+            else:
+                self._connection = connection
+        return self._connection
+
+    def get(self, identity: Tuple[str, int, int, int]) -> Optional[str]:
+        """
+        The cached digest for a file identity, or None.
+        """
+        connection = self._connect()
+        if connection is None:
+            return None
+        try:
+            row = connection.execute(
+                "SELECT sha256 FROM checksums WHERE path = ? AND inode = ? AND size = ? AND mtime_ns = ?",
+                identity).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Checksum cache {self.db_path} is unreadable: {str(e)}")
+            return None
+        return row[0] if row else None
+
+    def put_many(self, entries: Iterable[Tuple[Tuple[str, int, int, int], str]]) -> None:
+        """
+        Store (identity, digest) pairs, replacing older entries for the same paths.
+        """
+        rows = [(*identity, digest) for identity, digest in entries]
+        connection = self._connect()
+        if not rows or connection is None:
+            return
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO checksums (path, inode, size, mtime_ns, sha256) VALUES (?, ?, ?, ?, ?)",
+                    rows)
+        except sqlite3.Error as e:
+            # The cache only saves time, a failed write must not fail the validation
+            logger.warning(f"Could not update checksum cache {self.db_path}: {str(e)}")
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self) -> 'ChecksumCache':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
@@ -1,8 +1,10 @@
 # app/config.py
 
 import os
+import json
 from dotenv import load_dotenv
 from huggingface_hub import whoami
+from app.pipeline import PIPELINE_DEPTH
 
 load_dotenv()  # This loads the variables from .env file
 
@@ -13,6 +15,16 @@ def get_default_quanter():
     except Exception:
         return None
 
+def parse_quant_configs(spec: str, default: dict) -> list:
+    """
+    Quantization variants from a JSON list of overrides of the default config, e.g.
+    '[{}, {"q_group_size": 64}, {"version": "GEMV"}]'. An empty spec is the default alone.
+    """
+    variants = json.loads(spec) if spec else [{}]
+    if not isinstance(variants, list) or not variants or not all(isinstance(v, dict) for v in variants):
+        raise ValueError(f"QUANT_CONFIGS must be a non-empty JSON list of objects, got {spec}")
+    return [dict(default, **variant) for variant in variants]
+
 class Config:
     # Application Home Directory
     APP_HOME = os.getenv('APP_HOME', '/tmp')
@@ -47,6 +59,57 @@ class Config:
         'w_bit': 4,  # Bit width for quantization, 4-bit is the standard for AWQ
         'version': "GEMM"  # AWQ version, can be "GEMM" or "GEMV"
     }
+    # Variants quantized from one load and calibration pass, each published to its own repository
+    QUANT_CONFIGS = parse_quant_configs(os.getenv('QUANT_CONFIGS', ''), QUANT_CONFIG)
+
+    # Conversion Settings
+    CONVERSION_WORKERS = int(os.getenv('CONVERSION_WORKERS', '1'))  # Shards converted in parallel
+    CONVERSION_MEMORY_BUDGET_GB = float(os.getenv('CONVERSION_MEMORY_BUDGET_GB', '32'))  # RAM budget for concurrent shards
+    # Output dtype policy: a default mode (native, fp16, fp16-checked, bf16, fp32) followed by
+    # optional pattern=mode rules, e.g. "fp16-checked;*norm*=fp32"
+    CONVERSION_DTYPE_POLICY = os.getenv('CONVERSION_DTYPE_POLICY', 'fp16')
+    # Chunks in flight between the read, cast and write stages of a conversion, 0 to disable
+    CONVERSION_PIPELINE_DEPTH = int(os.getenv('CONVERSION_PIPELINE_DEPTH', str(PIPELINE_DEPTH)))
+    RESHARD_SIZE_GB = float(os.getenv('RESHARD_SIZE_GB', '0'))  # Repack converted weights into shards of this size, 0 to disable
+
+    # Calibration corpus: 'pileval' (AutoAWQ's default), a Hugging Face dataset or a local .txt/.jsonl file
+    CALIBRATION_DATA = os.getenv('CALIBRATION_DATA', 'pileval')
+    CALIBRATION_SAMPLES = int(os.getenv('CALIBRATION_SAMPLES', '128'))  # Texts tokenized, like AutoAWQ's max_calib_samples
+    CALIBRATION_SEQLEN = int(os.getenv('CALIBRATION_SEQLEN', '512'))  # Tokens per calibration block
+    # Pre-tokenized calibration sets reused across jobs, empty to let AutoAWQ fetch and tokenize every time
+    CALIBRATION_CACHE_DIR = os.getenv('CALIBRATION_CACHE_DIR', os.path.join(DATA_DIR, 'calibration'))
+
+    # Memory kept free on the host and the GPU on top of the quantization memory plan
+    QUANT_MEMORY_HEADROOM_GB = float(os.getenv('QUANT_MEMORY_HEADROOM_GB', '1'))
+    # Per-layer checkpoints of running quantizations, resumed after a restart; empty to disable
+    QUANT_CHECKPOINT_DIR = os.getenv('QUANT_CHECKPOINT_DIR', os.path.join(DATA_DIR, 'checkpoints'))
+    # Per-phase and per-layer time and memory traces of each quantization (JSON lines and Chrome trace); empty to disable
+    QUANT_TRACE_DIR = os.getenv('QUANT_TRACE_DIR', '')
+
+    # Download only the best weight format of a repository instead of every file
+    SELECTIVE_DOWNLOAD = os.getenv('SELECTIVE_DOWNLOAD', '1').lower() not in ('0', 'false', 'no')
+    # Check downloaded LFS files against the sha256 the Hub records for them
+    VERIFY_DOWNLOADS = os.getenv('VERIFY_DOWNLOADS', '1').lower() not in ('0', 'false', 'no')
+    # Files at least this large are fetched with parallel, resumable range requests
+    RANGE_DOWNLOAD_MIN_MB = float(os.getenv('RANGE_DOWNLOAD_MIN_MB', '256'))
+    DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', '4'))  # Range requests in flight per file, 0 to disable
+    DOWNLOAD_CHUNK_MB = float(os.getenv('DOWNLOAD_CHUNK_MB', '64'))  # Bytes per range request
+    # Files hashed in parallel when validating a model checksum
+    CHECKSUM_WORKERS = int(os.getenv('CHECKSUM_WORKERS', '4'))
+    # SQLite cache of file digests keyed by path, inode, size and mtime, empty to disable
+    CHECKSUM_CACHE_PATH = os.getenv('CHECKSUM_CACHE_PATH', os.path.join(DATA_DIR, 'checksums.sqlite'))
+
+    # Disk Space Admission
+    # What to do when a job's predicted peak disk use does not fit: 'refuse', 'queue' or 'off'
+    DISK_ADMISSION = os.getenv('DISK_ADMISSION', 'refuse')
+    # Other data directories, separated by os.pathsep, to use when DATA_DIR is too full
+    SCRATCH_DIRS = [path for path in os.getenv('SCRATCH_DIRS', '').split(os.pathsep) if path]
+    DISK_HEADROOM_GB = float(os.getenv('DISK_HEADROOM_GB', '2'))  # Space kept free on top of the prediction
+    DISK_QUEUE_TIMEOUT = float(os.getenv('DISK_QUEUE_TIMEOUT', '3600'))  # Seconds a queued job waits for space
+
+    # Content-addressed store of downloaded models shared by the awq and exl2 pipelines, empty to disable
+    MODEL_STORE_DIR = os.getenv('MODEL_STORE_DIR', os.path.join(APP_HOME, 'model-store'))
+    MODEL_STORE_BUDGET_GB = float(os.getenv('MODEL_STORE_BUDGET_GB', '500'))  # Least recently used models are evicted above this
 
     # Authentication Settings
     HF_ACCESS_TOKEN = os.getenv('HF_ACCESS_TOKEN')
@@ -0,0 +1,139 @@
+# app/conversion_journal.py
+
+import os
+import json
+import hashlib
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE_NAME = '.conversion-journal.json'
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+def file_sha256(path: str, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    """
+    Compute the sha256 of a file by reading it in chunks.
+    """
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+class ConversionJournal:
+    """
+    Record of a shard-by-shard conversion stored in the model directory.
+
+    The journal holds the source-to-output plan and the tie map fixed at the
+    start of the conversion and, for every finished output shard, its size, mtime and,
+    when the converter computed it, its sha256.
+    A rerun after a crash skips the shards the journal vouches for and redoes
+    only the rest, even though their sources may already have been removed.
+    """
+
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self.path = os.path.join(model_path, JOURNAL_FILE_NAME)
+        self.data: Dict[str, Any] = {'plan': {}, 'completed': {}}
+
+    @classmethod
+    def load(cls, model_path: str) -> 'ConversionJournal':
+        """
+        Load the journal of a model directory, or start an empty one.
+        """
+        journal = cls(model_path)
+        if os.path.exists(journal.path):
+            with open(journal.path, 'r') as f:
+                journal.data = json.load(f)
+            logger.info(f"Resuming conversion from journal {journal.path} "
+                        f"({len(journal.data['completed'])}/{len(journal.data['plan'])} shards done)")
+        return journal
+
+    @staticmethod
+    def exists(model_path: str) -> bool:
+        return os.path.exists(os.path.join(model_path, JOURNAL_FILE_NAME))
+
+    @property
+    def plan(self) -> Dict[str, str]:
+        return self.data['plan']
+
+    def set_plan(self, plan: Dict[str, str]) -> None:
+        """
+        Fix the source-to-output mapping. A plan already in the journal is kept,
+        because output names depend on the original list of sources.
+        """
+        if not self.data['plan']:
+            self.data['plan'] = dict(plan)
+            self.save()
+
+    @property
+    def ties(self) -> Optional[Dict[str, str]]:
+        return self.data.get('ties')
+
+    def set_ties(self, ties: Dict[str, str]) -> None:
+        """
+        Fix the tie map of the checkpoint. Like the plan, it is kept once recorded,
+        because it cannot be recomputed after some sources have been removed.
+        """
+        if 'ties' not in self.data:
+            self.data['ties'] = dict(ties)
+            self.save()
+
+    def is_complete(self, output: str, verify_digest: bool = False) -> bool:
+        """
+        Check whether an output shard was recorded and is still intact on disk.
+
+        Args:
+            output (str): Output file name relative to the model directory.
+            verify_digest (bool): Also re-hash the file instead of trusting size and mtime.
+        """
+        entry = self.data['completed'].get(output)
+        output_path = os.path.join(self.model_path, output)
+        if not entry or not os.path.exists(output_path):
+            return False
+
+        stat = os.stat(output_path)
+        if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime_ns']:
+            logger.warning(f"{output} changed since it was converted. It will be converted again.")
+            return False
+        if verify_digest and entry.get('sha256') is None:
+            logger.warning(f"{output} has no recorded digest. Trusting its size and mtime.")
+        elif verify_digest and file_sha256(output_path) != entry['sha256']:
+            logger.warning(f"{output} does not match its recorded digest. It will be converted again.")
+            return False
+        return True
+
+    def record(self, source: str, output: str, digest: Optional[str] = None) -> None:
+        """
+        Record a finished output shard and persist the journal. The digest is
+        stored as given; the file is not hashed again to fill it in.
+        """
+        output_path = os.path.join(self.model_path, output)
+        stat = os.stat(output_path)
+        self.data['completed'][output] = {
+            'source': source,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': digest,
+        }
+        self.save()
+
+    def save(self) -> None:
+        """
+        Atomically write the journal so a crash never leaves it half written.
+        """
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def finish(self) -> None:
+        """
+        Remove the journal once the whole conversion has completed.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            logger.info(f"Conversion complete. Removed journal {self.path}")
@@ -2,48 +2,62 @@
 
 import json
 import os
+import zipfile
 import shutil
+import hashlib
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from safetensors.torch import save_file as safetensors_save_file, load_file
 import torch
-from collections import defaultdict
 from tqdm import tqdm
+from app.safetensors_io import save_file_streaming, write_safetensors_index
+from app.dtype_policy import as_policy
+from app.scheduler import run_with_memory_budget
+from app.conversion_journal import ConversionJournal, file_sha256
+from app.pipeline import PIPELINE_DEPTH
+from app.tied_weights import (TIED_WEIGHTS_METADATA_KEY, alias_map, find_tied_weights, shared_pointers, shared_storages,
+                               ties_across_shards)
+from app.torch_zip import TorchZipCheckpoint, UnsupportedCheckpoint, transcode_checkpoint
 
 logger = logging.getLogger(__name__)
 
-def shared_pointers(tensors):
-    ptrs = defaultdict(list)
-    for k, v in tensors.items():
-        ptrs[v.data_ptr()].append(k)
-    return [names for names in ptrs.values() if len(names) > 1]
-
 def check_file_size(sf_filename, pt_filename):
     sf_size = os.stat(sf_filename).st_size
     pt_size = os.stat(pt_filename).st_size
     if (sf_size - pt_size) / pt_size > 0.01:
         logger.warning(f"File size difference exceeds 1% between {sf_filename} and {pt_filename}")
 
-def convert_model_to_safetensors(model_path: str) -> str:
+def convert_model_to_safetensors(model_path: str, workers: int = 1, memory_budget: int = None,
+                                 dtype_policy: str = 'fp16', pipeline_depth: int = PIPELINE_DEPTH) -> str:
     """
     Convert PyTorch model files to safetensors format or merge sharded safetensors.
+
+    Args:
+        model_path (str): Path to the model directory.
+        workers (int): Number of shards converted in parallel.
+        memory_budget (int): RAM budget in bytes for concurrent shard conversions.
+        dtype_policy (str): Output dtype policy, e.g. 'fp16', 'native' or 'fp16-checked;*norm*=fp32'.
+        pipeline_depth (int): Chunks in flight between the read, cast and write stages. 0 disables the pipeline.
     """
     logger.info(f"Converting model at {model_path} to safetensors format")
     
-    # Check if safetensors files already exist
+    # Check if safetensors files already exist. A journal means an earlier conversion
+    # was interrupted, so existing shards may be incomplete and the conversion resumes
+    resuming = ConversionJournal.exists(model_path)
     safetensors_files = [f for f in os.listdir(model_path) if f.startswith('model-') and f.endswith('.safetensors')]
-    if safetensors_files:
+    if safetensors_files and not resuming:
         logger.info("Safetensors files already exist. Skipping conversion.")
         update_safetensors_index(model_path)
         return model_path
 
     # Check for PyTorch bin files
-    pytorch_files = [f for f in os.listdir(model_path) if f.endswith('.bin')]
+    pytorch_files = sorted(f for f in os.listdir(model_path) if f.endswith('.bin'))
     
-    if pytorch_files:
+    if pytorch_files or resuming:
         logger.info(f"Found {len(pytorch_files)} PyTorch bin files. Converting to safetensors.")
         try:
-            convert_pytorch_to_safetensors(model_path, pytorch_files)
+            convert_pytorch_to_safetensors(model_path, pytorch_files, workers=workers, memory_budget=memory_budget,
+                                           dtype_policy=dtype_policy, pipeline_depth=pipeline_depth)
         except Exception as e:
             logger.error(f"Error converting PyTorch files to safetensors: {str(e)}")
             raise
@@ -56,58 +70,224 @@ def convert_model_to_safetensors(model_path: str) -> str:
     
     return model_path
 
-def convert_pytorch_to_safetensors(model_path: str, pytorch_files: list):
-    for i, pytorch_file in enumerate(pytorch_files, start=1):
-        pt_filename = os.path.join(model_path, pytorch_file)
-        sf_filename = os.path.join(model_path, f"model-{i:05d}-of-{len(pytorch_files):05d}.safetensors")
-        
-        logger.info(f"Converting {pytorch_file} to {os.path.basename(sf_filename)}")
+def load_shard_layout(pt_filename: str) -> Dict[str, torch.Tensor]:
+    """
+    Tensors of a shard to look for ties in, without reading their data.
+
+    Zip checkpoints are read from their TorchZipCheckpoint records: each tensor is a
+    view of the memory-mapped archive at the offset of its storage record, so views of
+    one storage share a pointer and nothing is unpickled. Other checkpoints go
+    through a memory-mapped torch.load.
+    """
+    try:
+        return TorchZipCheckpoint(pt_filename).tensors()
+    except UnsupportedCheckpoint:
+        return load_pytorch_shard(pt_filename, mmap=True)
+
+def load_pytorch_shard(pt_filename: str, mmap: bool = True) -> Dict[str, torch.Tensor]:
+    """
+    Load a PyTorch checkpoint shard on the CPU, memory-mapped when possible.
+
+    Memory-mapped tensors are only paged in when they are read, so a shard can be
+    converted without holding all of it in memory. Legacy (non-zip) checkpoints
+    cannot be memory-mapped and are loaded in full.
+    """
+    if mmap:
+        try:
+            loaded = torch.load(pt_filename, map_location="cpu", mmap=True)
+        except (RuntimeError, TypeError) as e:
+            logger.warning(f"Memory-mapped load not available for {pt_filename} ({str(e)}). Loading it in full.")
+            loaded = torch.load(pt_filename, map_location="cpu")
+    else:
         loaded = torch.load(pt_filename, map_location="cpu")
-        loaded = loaded.get("state_dict", loaded)
-        shared = shared_pointers(loaded)
+    return loaded.get("state_dict", loaded)
 
-        for shared_weights in shared:
-            for name in shared_weights[1:]:
-                loaded.pop(name)
+def drop_tied_weights(loaded: Dict[str, torch.Tensor], ties: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    Remove tied aliases from a shard in place.
+
+    Args:
+        loaded: Tensors of the shard.
+        ties: Alias-to-target map for the whole checkpoint. When omitted, only
+            aliases of the same storage within the shard are found.
+
+    Returns:
+        Dict[str, str]: Alias-to-target map of the removed tensors.
+    """
+    if ties is None:
+        ties = alias_map(shared_pointers(loaded))
+    dropped = {alias: target for alias, target in ties.items() if alias in loaded}
+    for alias in dropped:
+        loaded.pop(alias)
+    return dropped
+
+def convert_shard(pt_filename: str, sf_filename: str, streaming: bool = True, dtype_policy: str = 'fp16',
+                  ties: Optional[Dict[str, str]] = None, pipeline_depth: int = PIPELINE_DEPTH,
+                  digest: bool = False) -> Optional[str]:
+    """
+    Convert a single PyTorch bin shard to a safetensors file.
 
-        loaded = {k: v.contiguous().half() for k, v in loaded.items()}
+    In streaming mode zip checkpoints are transcoded straight from the archive
+    without unpickling tensors; other checkpoints are memory-mapped through
+    torch.load. Either way each tensor is cast chunk by chunk as it is written,
+    so memory stays flat instead of tracking the shard. Reading, casting and
+    writing overlap in a three-stage pipeline. The output dtype of every
+    tensor follows dtype_policy. Tied aliases are left out and recorded in the
+    file metadata. With digest, the output is hashed as it is written; tensors
+    copied in the kernel are then read back from the source to be hashed.
 
-        safetensors_save_file(loaded, sf_filename, metadata={"format": "pt"})
-        logger.info(f"Successfully converted {pytorch_file} to {os.path.basename(sf_filename)}")
+    Returns:
+        Optional[str]: sha256 of the written safetensors file, when digest is set.
+    """
+    policy = as_policy(dtype_policy)
+    hasher = hashlib.sha256() if digest else None
+    if streaming and zipfile.is_zipfile(pt_filename):
+        try:
+            transcode_checkpoint(pt_filename, sf_filename, dtype=policy, metadata={"format": "pt"}, ties=ties,
+                                 hasher=hasher, pipeline_depth=pipeline_depth)
+            return hasher.hexdigest() if hasher else None
+        except UnsupportedCheckpoint as e:
+            logger.info(f"Transcoding {pt_filename} directly is not possible ({str(e)}). Using torch.load.")
+
+    loaded = load_pytorch_shard(pt_filename, mmap=streaming)
+    tied = drop_tied_weights(loaded, ties)
+    metadata = {"format": "pt"}
+    if tied:
+        metadata[TIED_WEIGHTS_METADATA_KEY] = json.dumps(tied, sort_keys=True)
+
+    if streaming:
+        save_file_streaming(loaded, sf_filename, metadata=metadata, dtype=policy, hasher=hasher,
+                            pipeline_depth=pipeline_depth)
+        return hasher.hexdigest() if hasher else None
+
+    loaded = {k: v.contiguous().to(policy.resolve(k, v)) for k, v in loaded.items()}
+    # safetensors refuses tensors that still share a storage, such as slices of a fused weight
+    for names in shared_storages(loaded):
+        for name in names:
+            loaded[name] = loaded[name].clone()
+    safetensors_save_file(loaded, sf_filename, metadata=metadata)
+    return file_sha256(sf_filename) if digest else None
+
+def estimate_conversion_memory(pt_filename: str, streaming: bool = True) -> int:
+    """
+    Estimate the peak memory needed to convert a shard from its size on disk.
+
+    A full load keeps the original tensors and their cast copies alive at the
+    same time, while a streamed shard is bounded by the shard itself.
+    """
+    size = os.path.getsize(pt_filename)
+    return size if streaming else 2 * size
+
+def _init_conversion_worker(num_threads: int) -> None:
+    # Keep concurrent workers from oversubscribing the CPU with intra-op threads
+    torch.set_num_threads(num_threads)
+
+def convert_pytorch_to_safetensors(model_path: str, pytorch_files: list, streaming: bool = True, workers: int = 1,
+                                   memory_budget: int = None, dtype_policy: str = 'fp16',
+                                   pipeline_depth: int = PIPELINE_DEPTH, record_digests: bool = False) -> Dict[str, Any]:
+    """
+    Convert PyTorch bin shards to safetensors, optionally several at a time.
+
+    With more than one worker, shards run on a process pool and a shard is only
+    started once its estimated memory fits in the remaining budget. Progress is
+    recorded in a conversion journal in the model directory, so a rerun after a
+    crash skips the shards that were already converted.
+
+    Tied weights are found across all shards before any shard is written, so
+    each tied tensor is stored once even when its aliases live in other shards.
+    Zip shards are scanned from their storage records rather than torch.load.
+
+    With record_digests the journal also keeps the sha256 of every output shard,
+    at the cost of reading back the bytes that were copied in the kernel.
+
+    Returns:
+        Dict[str, Any]: Per-shard and aggregate throughput statistics.
+    """
+    journal = ConversionJournal.load(model_path)
+    journal.set_plan({
+        pytorch_file: f"model-{i:05d}-of-{len(pytorch_files):05d}.safetensors"
+        for i, pytorch_file in enumerate(pytorch_files, start=1)
+    })
+    if journal.ties is None:
+        # On a resumed run some sources may already be gone, so only the rest are scanned
+        sources = [f for f in journal.plan if os.path.exists(os.path.join(model_path, f))]
+        journal.set_ties(find_tied_weights(
+            sources,
+            lambda f: load_shard_layout(os.path.join(model_path, f)),
+            across_shards=ties_across_shards(model_path)
+        ))
+
+    jobs = []
+    for pytorch_file, sf_file in journal.plan.items():
+        pt_filename = os.path.join(model_path, pytorch_file)
+        sf_filename = os.path.join(model_path, sf_file)
+        if journal.is_complete(sf_file):
+            logger.info(f"{sf_file} was already converted. Skipping {pytorch_file}.")
+            if os.path.exists(pt_filename):
+                os.remove(pt_filename)
+            continue
+        if not os.path.exists(pt_filename):
+            raise FileNotFoundError(f"{pytorch_file} is missing and {sf_file} was not converted")
+        jobs.append({
+            'name': pytorch_file,
+            'cost': estimate_conversion_memory(pt_filename, streaming),
+            'bytes': os.path.getsize(pt_filename),
+            'args': (pt_filename, sf_filename, streaming, dtype_policy, journal.ties, pipeline_depth, record_digests),
+        })
+
+    if memory_budget is None:
+        memory_budget = sum(job['cost'] for job in jobs)
+
+    def on_complete(job, digest):
+        pt_filename, sf_filename = job['args'][:2]
+        journal.record(job['name'], os.path.basename(sf_filename), digest)
+        logger.info(f"Successfully converted {job['name']} to {os.path.basename(sf_filename)}")
 
         # Optionally, remove the original PyTorch file
         os.remove(pt_filename)
-        logger.info(f"Removed original PyTorch file: {pytorch_file}")
+        logger.info(f"Removed original PyTorch file: {job['name']}")
+
+    logger.info(f"Converting {len(jobs)} shards with {workers} worker(s)")
+    stats = run_with_memory_budget(
+        jobs,
+        convert_shard,
+        memory_budget,
+        max_workers=workers,
+        on_complete=on_complete,
+        initializer=_init_conversion_worker,
+        initargs=(max(1, (os.cpu_count() or 1) // max(1, workers)),)
+    )
+    journal.finish()
+    return stats
 
 def update_safetensors_index(model_path: str):
+    """
+    Regenerate model.safetensors.index.json from the headers of the safetensors shards.
+
+    The weight map is read from the shards themselves, so it stays correct even when
+    the safetensors shards do not map 1:1 onto the original bin shards.
+    """
     pytorch_index_file = os.path.join(model_path, 'pytorch_model.bin.index.json')
     safetensors_index_file = os.path.join(model_path, 'model.safetensors.index.json')
     
-    if not os.path.exists(pytorch_index_file):
-        logger.error("PyTorch index file not found. Cannot update safetensors index.")
+    if not os.path.exists(pytorch_index_file) and os.path.exists(safetensors_index_file):
+        logger.info("PyTorch index file not found. Keeping existing safetensors index.")
         return
     
-    with open(pytorch_index_file, 'r') as f:
-        index_data = json.load(f)
-    
     safetensors_files = sorted([f for f in os.listdir(model_path) if f.startswith('model-') and f.endswith('.safetensors')])
+    if not safetensors_files:
+        logger.error("No safetensors shards found. Cannot update safetensors index.")
+        return
     
-    new_weight_map = {}
-    for key, old_file in index_data['weight_map'].items():
-        shard_index = int(old_file.split('-')[-1].split('.')[0]) - 1
-        new_file = safetensors_files[shard_index]
-        new_weight_map[key] = new_file
-    
-    new_index_data = {
-        'metadata': index_data.get('metadata', {}),
-        'weight_map': new_weight_map
-    }
-    
-    with open(safetensors_index_file, 'w') as f:
-        json.dump(new_index_data, f, indent=2)
+    metadata = {}
+    if os.path.exists(pytorch_index_file):
+        with open(pytorch_index_file, 'r') as f:
+            metadata = json.load(f).get('metadata', {})
     
+    write_safetensors_index(model_path, safetensors_files, metadata)
     logger.info(f"Updated safetensors index file: {safetensors_index_file}")
     
     # Optionally, remove the old PyTorch index file
-    os.remove(pytorch_index_file)
-    logger.info(f"Removed old PyTorch index file: {pytorch_index_file}")
+    if os.path.exists(pytorch_index_file):
+        os.remove(pytorch_index_file)
+        logger.info(f"Removed old PyTorch index file: {pytorch_index_file}")
@@ -0,0 +1,333 @@
+# app/disk_admission.py
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import logging
+from typing import Any, Dict, List, NamedTuple, Optional
+from huggingface_hub import HfApi
+from app.dtype_policy import DtypePolicy
+from app.model_index import ModelDirIndex, SINGLE_SAFETENSORS_FILE, SAFETENSORS_INDEX_FILE
+from app.model_utils import fetch_repo_info, plan_download, repo_file_sizes
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+RESERVATIONS_FILE_NAME = '.disk-reservations.json'
+
+# Bytes per element written by each conversion mode; native keeps the source width
+MODE_ITEMSIZE = {'fp16': 2, 'fp16-checked': 2, 'bf16': 2, 'fp32': 4}
+TORCH_DTYPE_ITEMSIZE = {'float32': 4, 'float16': 2, 'bfloat16': 2}
+
+# Share of parameters AutoAWQ leaves in 16 bits (embeddings, lm_head, norms)
+UNQUANTIZED_FRACTION = 0.1
+
+class StageUsage(NamedTuple):
+    stage: str
+    peak_bytes: int
+
+class DiskPlan(NamedTuple):
+    stages: List[StageUsage]
+    present_bytes: int
+
+    @property
+    def peak_bytes(self) -> int:
+        return max((stage.peak_bytes for stage in self.stages), default=0)
+
+    @property
+    def required_bytes(self) -> int:
+        """
+        Free space the job still needs on top of what it already occupies.
+        """
+        return max(0, self.peak_bytes - self.present_bytes)
+
+class Admission(NamedTuple):
+    decision: str  # 'run' or 'refuse'
+    data_dir: Optional[str]
+    plan: DiskPlan
+    free_bytes: Dict[str, int]
+
+def is_top_level_shard(name: str) -> bool:
+    """
+    Whether name is a .bin or .safetensors shard at the top of the repository, the files conversion reads.
+    """
+    return '/' not in name and (name.endswith('.bin') or name.endswith('.safetensors'))
+
+def conversion_peak(shard_sizes: List[int], ratio: float, workers: int = 1) -> int:
+    """
+    Peak bytes of .bin shards and safetensors outputs during a conversion.
+
+    The converter removes each source shard once its output is complete and
+    converts up to workers shards at a time, so the peak is the largest sum of
+    finished outputs, remaining sources and in-flight outputs over the run.
+
+    Args:
+        shard_sizes: Source shard sizes in conversion order.
+        ratio: Output bytes per source byte.
+        workers: Shards converted at the same time.
+
+    Returns:
+        int: Peak bytes of sources and outputs.
+    """
+    peak = sum(shard_sizes)
+    for k in range(len(shard_sizes)):
+        done = ratio * sum(shard_sizes[:k])
+        remaining = sum(shard_sizes[k:])
+        in_flight = ratio * sum(shard_sizes[k:k + max(1, workers)])
+        peak = max(peak, int(done + remaining + in_flight))
+    return peak
+
+def quantized_size(weight_bytes: int, itemsize: int, w_bit: int, q_group_size: int) -> int:
+    """
+    Estimated size of the AWQ output for weights of weight_bytes stored itemsize bytes per element.
+
+    Quantized weights take w_bit bits per element plus a 16-bit scale and a
+    w_bit zero point per group; the UNQUANTIZED_FRACTION share stays in 16 bits.
+    """
+    params = weight_bytes / itemsize
+    # A group size of -1 or 0 means one scale per output channel, which is negligible
+    quantized_bits = w_bit + ((16 + w_bit) / q_group_size if q_group_size > 0 else 0)
+    return int(params * (UNQUANTIZED_FRACTION * 16 + (1 - UNQUANTIZED_FRACTION) * quantized_bits) / 8)
+
+def predict_disk_usage(files: Dict[str, int], present_bytes: int = 0, dtype_policy: str = 'fp16',
+                       source_itemsize: int = 2, w_bit: int = 4, q_group_size: int = 128,
+                       workers: int = 1, reshard: bool = False,
+                       quant_configs: Optional[List[Dict[str, Any]]] = None) -> DiskPlan:
+    """
+    Predict the peak disk use of each stage of a quantization job.
+
+    Stages follow main.py: download the repository, convert .bin weights to
+    safetensors when the repository has no safetensors model (and reshard them
+    when asked), then write the quantized model next to the source.
+
+    Args:
+        files: Size of every file in the source repository, by path.
+        present_bytes: Bytes of the job already on disk (partial download, earlier output).
+        dtype_policy: Conversion dtype policy; its default mode sets the output width.
+        source_itemsize: Bytes per element of the source weights.
+        w_bit: Quantization bit width.
+        q_group_size: Quantization group size.
+        workers: Shards converted in parallel.
+        reshard: Whether converted weights are repacked afterwards.
+        quant_configs: Variants the job quantizes, each written as its own model.
+            Replaces w_bit and q_group_size.
+
+    Returns:
+        DiskPlan: Peak bytes per stage, cumulative over the job directory.
+    """
+    total = sum(files.values())
+    stages = [StageUsage('download', total)]
+
+    weights = {name: size for name, size in files.items() if is_top_level_shard(name)}
+    other = total - sum(weights.values())
+    bins = [size for name, size in sorted(weights.items()) if name.endswith('.bin')]
+    needs_conversion = bins and SINGLE_SAFETENSORS_FILE not in files and SAFETENSORS_INDEX_FILE not in files
+
+    itemsize = source_itemsize
+    weight_bytes = sum(weights.values())
+    if needs_conversion:
+        mode = DtypePolicy.parse(dtype_policy).default
+        itemsize = MODE_ITEMSIZE.get(mode, source_itemsize)
+        ratio = itemsize / source_itemsize
+        converted = int(ratio * sum(bins))
+        stages.append(StageUsage('convert', other + conversion_peak(bins, ratio, workers)))
+        if reshard:
+            stages.append(StageUsage('reshard', other + 2 * converted))
+        weight_bytes = converted
+        total = other + converted
+
+    variants = quant_configs or [{'w_bit': w_bit, 'q_group_size': q_group_size}]
+    quantized = sum(quantized_size(weight_bytes, itemsize, variant['w_bit'], variant['q_group_size'])
+                    for variant in variants)
+    stages.append(StageUsage('quantize', total + quantized))
+    return DiskPlan(stages, present_bytes)
+
+def choose_data_dir(required: Dict[str, int], available: Dict[str, int]) -> Optional[str]:
+    """
+    Pick the first candidate directory whose available space covers the job.
+
+    Args:
+        required: Bytes the job still needs, by candidate directory, in preference order.
+        available: Free bytes left for new jobs, by candidate directory.
+
+    Returns:
+        Optional[str]: The chosen directory, or None when none has room.
+    """
+    for data_dir, needed in required.items():
+        if needed <= available.get(data_dir, 0):
+            return data_dir
+    return None
+
+def _existing_parent(path: str) -> str:
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _update_reservations(data_dir: str, job: Optional[str] = None, reserved: int = 0) -> int:
+    """
+    Drop reservations of finished processes, optionally record one for job, and
+    return the bytes reserved by other live jobs. The file is locked while it is
+    updated so concurrent jobs on one volume see each other.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(data_dir, RESERVATIONS_FILE_NAME), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            reservations = json.loads(f.read() or '{}')
+        except ValueError:
+            reservations = {}
+        key = f"{job}@{os.getpid()}"
+        reservations = {name: entry for name, entry in reservations.items()
+                        if name != key and _pid_alive(entry['pid'])}
+        others = sum(entry['bytes'] for entry in reservations.values())
+        if job and reserved:
+            reservations[key] = {'pid': os.getpid(), 'bytes': reserved}
+        f.seek(0)
+        f.truncate()
+        json.dump(reservations, f)
+    return others
+
+def job_bytes(data_dir: str, job_dir_names: List[str]) -> int:
+    """
+    Bytes the job's directories under data_dir occupy.
+    """
+    return sum(ModelDirIndex(os.path.join(data_dir, name)).total_size for name in job_dir_names
+               if os.path.isdir(os.path.join(data_dir, name)))
+
+def update_reservation(admission: Admission, job_dir_names: List[str], completed_stage: str) -> int:
+    """
+    Shrink the reservation of an admitted job once completed_stage has finished.
+
+    What the job wrote so far is on disk and counted by shutil.disk_usage, so
+    only the peak of the stages still to come, less the job's current bytes, stays
+    reserved. Call it after each stage of the plan.
+
+    Args:
+        admission: The admission returned by admit_job.
+        job_dir_names: The job directories passed to admit_job.
+        completed_stage: Name of the stage that has just finished.
+
+    Returns:
+        int: Bytes still reserved.
+    """
+    names = [stage.stage for stage in admission.plan.stages]
+    remaining = admission.plan.stages[names.index(completed_stage) + 1:] if completed_stage in names else []
+    peak = max((stage.peak_bytes for stage in remaining), default=0)
+    reserved = max(0, peak - job_bytes(admission.data_dir, job_dir_names))
+    _update_reservations(admission.data_dir, job_dir_names[0], reserved)
+    logger.info(f"Disk reservation after {completed_stage}: {reserved / GB:.2f} GB")
+    return reserved
+
+def release_reservation(admission: Admission, job_dir_names: List[str]) -> None:
+    """
+    Drop the reservation of an admitted job, once it no longer writes to disk.
+    """
+    _update_reservations(admission.data_dir, job_dir_names[0])
+
+def fetch_repo_file_sizes(repo_id: str, api: HfApi = None) -> Dict[str, int]:
+    """
+    Size of every file of a Hub repository, from its file metadata.
+    """
+    return repo_file_sizes(fetch_repo_info(repo_id, api))
+
+def local_source_itemsize(model_dir: str) -> Optional[int]:
+    """
+    Bytes per element of the weights according to the torch_dtype in config.json, if present.
+    """
+    try:
+        with open(os.path.join(model_dir, 'config.json')) as f:
+            return TORCH_DTYPE_ITEMSIZE.get(json.load(f).get('torch_dtype'))
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def admit_job(repo_id: str, job_dir_names: List[str], data_dirs: List[str], mode: str = 'refuse',
+              headroom: int = 0, queue_timeout: float = 0, poll_seconds: float = 60,
+              api: HfApi = None, selective: bool = False, **plan_options) -> Admission:
+    """
+    Decide whether and where a job may start, based on its predicted peak disk use.
+
+    Each candidate data directory is planned with the job files it already holds
+    (a directory that has them is preferred, so nothing is downloaded twice).
+    Free space is measured with shutil.disk_usage, less the reservations of other
+    running jobs. The job runs in the first directory with room and reserves its
+    remaining need there, until update_reservation shrinks it as stages finish,
+    release_reservation drops it or the process exits. Otherwise mode 'queue' polls
+    until room appears or queue_timeout passes, and 'refuse' gives up at once.
+
+    Args:
+        repo_id: Source repository, used for remote file sizes.
+        job_dir_names: Directories the job writes under a data directory, source model first.
+        data_dirs: Candidate data directories in preference order.
+        mode: 'refuse' or 'queue'.
+        headroom: Bytes to keep free on top of the prediction.
+        queue_timeout: Seconds to wait for space in 'queue' mode.
+        poll_seconds: Seconds between free space checks while queued.
+        api: HfApi-compatible object for the remote file sizes.
+        selective: Plan for the files a selective download fetches (see plan_download).
+        **plan_options: Passed to predict_disk_usage.
+
+    Returns:
+        Admission: The decision, the chosen directory and the plan for it.
+    """
+    try:
+        remote_files = fetch_repo_file_sizes(repo_id, api)
+        download_plan = plan_download(remote_files) if selective else None
+        if download_plan:
+            remote_files = {name: size for name, size in remote_files.items() if name not in download_plan.skipped}
+    except Exception as e:
+        logger.warning(f"Could not read file sizes of {repo_id}, planning from local files only: {str(e)}")
+        remote_files = None
+
+    plans = {}
+    for data_dir in data_dirs:
+        source_dir = os.path.join(data_dir, job_dir_names[0])
+        source = ModelDirIndex(source_dir) if os.path.isdir(source_dir) else None
+        present = job_bytes(data_dir, job_dir_names)
+        files = remote_files
+        if files is None:
+            files = {name: indexed.size for name, indexed in source.files.items()} if source else {}
+        options = dict(plan_options)
+        if source and 'source_itemsize' not in options:
+            options['source_itemsize'] = local_source_itemsize(source.model_path) or 2
+        plans[data_dir] = predict_disk_usage(files, present, **options)
+    # Prefer a directory that already holds part of the job
+    ordered = sorted(data_dirs, key=lambda data_dir: plans[data_dir].present_bytes == 0)
+
+    job = job_dir_names[0]
+    deadline = time.monotonic() + queue_timeout
+    while True:
+        free = {}
+        for data_dir in ordered:
+            reserved = _update_reservations(data_dir, job)
+            free[data_dir] = shutil.disk_usage(_existing_parent(data_dir)).free - reserved
+        required = {data_dir: plans[data_dir].required_bytes + headroom for data_dir in ordered}
+        chosen = choose_data_dir(required, free)
+        if chosen:
+            _update_reservations(chosen, job, plans[chosen].required_bytes)
+            for stage in plans[chosen].stages:
+                logger.info(f"Predicted disk use for {stage.stage}: {stage.peak_bytes / GB:.2f} GB")
+            logger.info(f"Admitted {repo_id} on {chosen}: needs {required[chosen] / GB:.2f} GB, "
+                        f"{free[chosen] / GB:.2f} GB free")
+            return Admission('run', chosen, plans[chosen], free)
+
+        for data_dir in ordered:
+            logger.warning(f"Not enough space in {data_dir}: {repo_id} needs {required[data_dir] / GB:.2f} GB, "
+                           f"{free[data_dir] / GB:.2f} GB free")
+        if mode != 'queue' or time.monotonic() + poll_seconds > deadline:
+            return Admission('refuse', None, plans[data_dirs[0]], free)
+        logger.info(f"Waiting {poll_seconds:.0f}s for disk space")
+        time.sleep(poll_seconds)
@@ -0,0 +1,134 @@
+# app/dtype_policy.py
+
+import fnmatch
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Largest finite float16 value
+FP16_MAX = 65504.0
+
+# Number of elements cast or scanned at a time
+CHUNK_ELEMENTS = 4 * 1024 * 1024
+
+DTYPE_MODES: Dict[str, Optional[torch.dtype]] = {
+    'native': None,
+    'fp16': torch.float16,
+    'fp16-checked': torch.float16,
+    'bf16': torch.bfloat16,
+    'fp32': torch.float32,
+}
+
+def iter_chunks(tensor: torch.Tensor, chunk_elements: int = CHUNK_ELEMENTS):
+    """
+    Yield consecutive flat slices of a tensor without copying it.
+    """
+    flat = tensor.reshape(-1)
+    for start in range(0, flat.numel(), chunk_elements):
+        yield flat[start:start + chunk_elements]
+
+def overflows_fp16(tensor: torch.Tensor, chunk_elements: int = CHUNK_ELEMENTS) -> bool:
+    """
+    Check, chunk by chunk, whether a tensor holds finite values outside the float16 range.
+    """
+    if tensor.dtype == torch.float16:
+        return False
+    for chunk in iter_chunks(tensor, chunk_elements):
+        chunk = chunk.float()
+        if torch.logical_and(chunk.abs() > FP16_MAX, torch.isfinite(chunk)).any():
+            return True
+    return False
+
+class DtypePolicy:
+    """
+    Per-tensor output dtype policy for conversions.
+
+    A policy has a default mode and ordered glob rules matched against tensor
+    names; the first matching rule wins. Modes are 'native' (keep the stored
+    dtype), 'fp16', 'bf16', 'fp32' and 'fp16-checked', which casts to float16
+    unless the tensor would overflow and otherwise falls back to bfloat16.
+    Only floating point tensors are ever cast.
+
+    Policies are written as strings such as "fp16-checked;*norm*=fp32",
+    a default mode followed by pattern=mode rules.
+    """
+
+    def __init__(self, default: str = 'fp16', rules: Optional[List[Tuple[str, str]]] = None):
+        for mode in [default] + [mode for _, mode in rules or []]:
+            if mode not in DTYPE_MODES:
+                raise ValueError(f"Unknown dtype mode '{mode}'. Expected one of {list(DTYPE_MODES)}")
+        self.default = default
+        self.rules = list(rules or [])
+
+    @classmethod
+    def parse(cls, spec: str) -> 'DtypePolicy':
+        """
+        Build a policy from a string such as "bf16;*norm*=fp32;lm_head.weight=native".
+        """
+        parts = [part.strip() for part in spec.split(';') if part.strip()]
+        default = 'native'
+        rules = []
+        for part in parts:
+            if '=' in part:
+                pattern, mode = part.rsplit('=', 1)
+                rules.append((pattern.strip(), mode.strip()))
+            else:
+                default = part
+        return cls(default, rules)
+
+    def __str__(self) -> str:
+        return ';'.join([self.default] + [f"{pattern}={mode}" for pattern, mode in self.rules])
+
+    def mode_for(self, name: str) -> str:
+        for pattern, mode in self.rules:
+            if fnmatch.fnmatchcase(name, pattern):
+                return mode
+        return self.default
+
+    def resolve(self, name: str, tensor: torch.Tensor) -> torch.dtype:
+        """
+        Decide the output dtype of a tensor. For 'fp16-checked' the tensor is
+        scanned in chunks, so this may read it once before it is written.
+        """
+        if not tensor.is_floating_point():
+            return tensor.dtype
+        mode = self.mode_for(name)
+        dtype = DTYPE_MODES[mode]
+        if dtype is None:
+            return tensor.dtype
+        if mode == 'fp16-checked' and overflows_fp16(tensor):
+            logger.warning(f"{name} has values outside the float16 range. Storing it as bfloat16.")
+            return torch.bfloat16
+        return dtype
+
+    def inspects(self, name: str, dtype: torch.dtype) -> bool:
+        """
+        Whether resolve needs to read the data of a tensor stored as dtype, which only
+        'fp16-checked' does for floating point tensors that are not float16 already.
+        """
+        return dtype.is_floating_point and dtype != torch.float16 and self.mode_for(name) == 'fp16-checked'
+
+    def output_dtype(self, name: str, dtype: torch.dtype) -> torch.dtype:
+        """
+        Output dtype from the stored dtype alone, for planning without reading data.
+        'fp16-checked' is planned as float16; the fallback keeps the same element size.
+        """
+        if not dtype.is_floating_point:
+            return dtype
+        return DTYPE_MODES[self.mode_for(name)] or dtype
+
+def as_policy(policy) -> Optional['DtypePolicy']:
+    """
+    Accept a DtypePolicy, a policy string, a torch dtype or None.
+    """
+    if policy is None or isinstance(policy, DtypePolicy):
+        return policy
+    if isinstance(policy, torch.dtype):
+        for mode, dtype in DTYPE_MODES.items():
+            if dtype == policy and mode != 'fp16-checked':
+                return DtypePolicy(mode)
+        raise ValueError(f"No dtype mode for {policy}")
+    return DtypePolicy.parse(policy)
@@ -0,0 +1,129 @@
+# app/layer_checkpoint.py
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+from typing import Any, Dict, Optional
+
+import torch
+from safetensors.torch import load_file
+
+from app.safetensors_io import save_file_streaming
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'checkpoint.json'
+# Model files whose size and mtime identify the weights being quantized
+MODEL_FILE_SUFFIXES = ('.safetensors', '.bin', '.json')
+
+def checkpoint_fingerprint(model_path: str, **job: Any) -> str:
+    """
+    A sha256 identifying a quantization job: the model files (names, sizes and
+    mtimes) plus everything passed in job, e.g. the quant config and calibration set.
+
+    Raises:
+        OSError: If the model directory cannot be read.
+    """
+    files = []
+    for name in sorted(os.listdir(model_path)):
+        if name.endswith(MODEL_FILE_SUFFIXES):
+            stat = os.stat(os.path.join(model_path, name))
+            files.append([name, stat.st_size, stat.st_mtime_ns])
+    payload = json.dumps({'model': os.path.abspath(model_path), 'files': files, 'job': job}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class LayerCheckpoint:
+    """
+    Per-layer progress of a quantization job in a work directory.
+
+    After each decoder layer, its quantized tensors (packed weights, scales
+    and zeros) and the calibration inputs of the next layer are written, then
+    checkpoint.json records the layer as completed. The manifest is replaced
+    last and atomically, so a job killed at any point resumes from the last
+    layer it records. A manifest left by a different job (other fingerprint)
+    is discarded.
+    """
+
+    def __init__(self, work_dir: str, fingerprint: str):
+        self.work_dir = work_dir
+        self.fingerprint = fingerprint
+        self.completed = 0
+        manifest_path = os.path.join(work_dir, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable checkpoint {manifest_path}: {str(e)}")
+            manifest = {}
+        if manifest.get('fingerprint') != fingerprint:
+            logger.info(f"Checkpoint in {work_dir} belongs to another job, starting over")
+            self.clear()
+            return
+        self.completed = int(manifest.get('completed', 0))
+        if self.completed and not os.path.exists(self.inputs_path(self.completed)):
+            logger.warning(f"Checkpoint in {work_dir} has no inputs for layer {self.completed}, starting over")
+            self.clear()
+
+    def layer_path(self, layer: int) -> str:
+        return os.path.join(self.work_dir, f"layer-{layer:05d}.safetensors")
+
+    def inputs_path(self, layer: int) -> str:
+        return os.path.join(self.work_dir, f"inputs-{layer:05d}.safetensors")
+
+    def save(self, layer: int, next_inputs: torch.Tensor, tensors: Optional[Dict[str, torch.Tensor]] = None) -> None:
+        """
+        Record layer as completed.
+
+        Args:
+            layer: Index of the decoder layer just quantized; layers are saved in order.
+            next_inputs: Calibration inputs of layer + 1.
+            tensors: The quantized layer's state dict, or None when the caller
+                keeps the layer's tensors itself (e.g. in an output shard).
+        """
+        if layer != self.completed:
+            raise ValueError(f"Checkpoint expects layer {self.completed}, got {layer}")
+        os.makedirs(self.work_dir, exist_ok=True)
+        if tensors is not None:
+            save_file_streaming({name: tensor.detach().cpu().contiguous() for name, tensor in tensors.items()},
+                                self.layer_path(layer), metadata={"format": "pt"})
+        save_file_streaming({'inputs': next_inputs.detach().cpu().contiguous()}, self.inputs_path(layer + 1))
+
+        manifest_path = os.path.join(self.work_dir, MANIFEST_FILE)
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'completed': layer + 1}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, manifest_path)
+        self.completed = layer + 1
+
+        # Only the inputs of the next layer are ever needed again
+        if os.path.exists(self.inputs_path(layer)):
+            os.remove(self.inputs_path(layer))
+        logger.debug(f"Checkpointed layer {layer} in {self.work_dir}")
+
+    def load_layer(self, layer: int) -> Optional[Dict[str, torch.Tensor]]:
+        """
+        The saved tensors of a completed layer, or None if the layer was saved without tensors.
+        """
+        if layer >= self.completed:
+            raise ValueError(f"Layer {layer} is not checkpointed, only {self.completed} layers are")
+        path = self.layer_path(layer)
+        return load_file(path) if os.path.exists(path) else None
+
+    def load_inputs(self) -> torch.Tensor:
+        """
+        Calibration inputs of the first layer not yet completed.
+        """
+        return load_file(self.inputs_path(self.completed))['inputs']
+
+    def clear(self) -> None:
+        """
+        Delete the work directory and start over from the first layer.
+        """
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.completed = 0
@@ -0,0 +1,122 @@
+# app/layer_streaming.py
+
+import os
+import logging
+from typing import Dict, Iterable, List, Optional
+
+import torch
+
+from app.resharder import ShardSource, find_source_shards
+from app.safetensors_io import save_file_streaming, write_safetensors_index
+from app.tied_weights import shared_pointers
+
+logger = logging.getLogger(__name__)
+
+class StreamedWeights:
+    """
+    Memory-mapped weights of a model directory, loaded into meta-initialized modules on demand.
+
+    Modules are built without allocating their parameters (on the meta device)
+    and filled one at a time with materialize, then emptied again with release,
+    so only the modules currently in use hold memory.
+    """
+
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self.source = ShardSource(model_path, find_source_shards(model_path))
+
+    def resolve(self, name: str) -> Optional[str]:
+        """
+        The stored tensor holding name, following tied aliases, or None.
+        """
+        if name in self.source.tensors:
+            return name
+        target = self.source.ties.get(name)
+        return target if target in self.source.tensors else None
+
+    def materialize(self, module: torch.nn.Module, prefix: str = '', dtype: Optional[torch.dtype] = None,
+                    skip: Iterable[str] = ()) -> List[str]:
+        """
+        Load the parameters and persistent buffers of module still on the meta device.
+
+        Args:
+            module: Module whose state_dict names, prefixed with prefix, are checkpoint names.
+            prefix: Checkpoint name prefix of module, e.g. 'model.layers.3.'.
+            dtype: Floating point tensors are cast to this dtype. None keeps stored dtypes.
+            skip: Checkpoint name prefixes left on the meta device, e.g. the decoder layers.
+
+        Returns:
+            List[str]: Checkpoint names of the meta tensors with no stored weight.
+        """
+        skip = tuple(skip)
+        state_dict: Dict[str, torch.Tensor] = {}
+        missing = []
+        for name, tensor in module.state_dict(keep_vars=True).items():
+            full_name = prefix + name
+            if tensor.device.type != 'meta' or (skip and full_name.startswith(skip)):
+                continue
+            stored_name = self.resolve(full_name)
+            if stored_name is None:
+                missing.append(full_name)
+                continue
+            value = self.source.get_tensor(stored_name)
+            if tuple(value.shape) != tuple(tensor.shape):
+                raise ValueError(f"{stored_name} has shape {tuple(value.shape)}, the model expects {tuple(tensor.shape)}")
+            if dtype is not None and value.is_floating_point():
+                value = value.to(dtype)
+            state_dict[name] = value
+        module.load_state_dict(state_dict, strict=False, assign=True)
+        return missing
+
+    @staticmethod
+    def release(module: torch.nn.Module) -> torch.nn.Module:
+        """
+        Free the tensors of module, leaving its structure on the meta device.
+        """
+        return module.to('meta')
+
+class LayerShardWriter:
+    """
+    Writes a model one safetensors shard at a time: shard 1 holds everything outside
+    the decoder layers and shard i + 2 holds decoder layer i, named like
+    save_pretrained names its shards. finish writes the index once all shards exist.
+    """
+
+    def __init__(self, output_dir: str, num_layers: int):
+        self.output_dir = output_dir
+        self.num_shards = num_layers + 1
+        os.makedirs(output_dir, exist_ok=True)
+
+    def shard_name(self, shard: int) -> str:
+        return f"model-{shard:05d}-of-{self.num_shards:05d}.safetensors"
+
+    def layer_shard(self, layer: int) -> str:
+        return self.shard_name(layer + 2)
+
+    def write(self, shard_name: str, tensors: Dict[str, torch.Tensor]) -> int:
+        """
+        Write tensors to shard_name, keeping one copy of tensors sharing storage (e.g. a tied LM head).
+
+        Returns:
+            int: Size of the written shard in bytes.
+        """
+        tensors = {name: tensor.detach().cpu().contiguous() for name, tensor in tensors.items()}
+        for names in shared_pointers(tensors):
+            for alias in names[1:]:
+                del tensors[alias]
+        size = save_file_streaming(tensors, os.path.join(self.output_dir, shard_name), metadata={"format": "pt"})
+        logger.info(f"Wrote {shard_name} ({size / (1024 * 1024):.2f} MB, {len(tensors)} tensors)")
+        return size
+
+    def finish(self) -> str:
+        """
+        Write model.safetensors.index.json over all shards.
+
+        Returns:
+            str: Path of the index file.
+        """
+        shard_names = [self.shard_name(shard) for shard in range(1, self.num_shards + 1)]
+        missing = [name for name in shard_names if not os.path.exists(os.path.join(self.output_dir, name))]
+        if missing:
+            raise FileNotFoundError(f"Cannot index {self.output_dir}, missing shards: {', '.join(missing)}")
+        return write_safetensors_index(self.output_dir, shard_names)
@@ -3,6 +3,7 @@ import sys
 import argparse
 import logging
 import re
+from typing import Any, Dict, List, NamedTuple
 from huggingface_hub import HfApi, create_repo, Repository, HfFolder, whoami
 import shutil
 
@@ -16,14 +17,46 @@ from app.model_utils import (
     check_model_files,
     get_model_size  # Add this import
 )
+from app.model_index import ModelDirIndex, SINGLE_SAFETENSORS_FILE, SAFETENSORS_INDEX_FILE
+from app.safetensors_inspector import inspect_safetensors
+from app.disk_admission import admit_job, release_reservation, update_reservation
 from app.quantization import run_quantization, validate_quantized_model
 from app.converter import convert_model_to_safetensors
+from app.resharder import reshard_model
 from app.template_parser import process_template
 from app.utils import create_logger
 
 # Initialize the logger
 logger = create_logger(Config.LOG_FILE)
 
+class AwqVariant(NamedTuple):
+    quant_config: Dict[str, Any]
+    repo_name: str
+    model_path: str
+    readme_path: str
+
+def awq_repo_suffix(quant_config: Dict[str, Any], quant_configs: List[Dict[str, Any]]) -> str:
+    """
+    Repository suffix of a variant: 'AWQ' for a single variant, otherwise also its bits, group size and kernel.
+    """
+    if len(quant_configs) == 1:
+        return 'AWQ'
+    suffix = f"AWQ-{quant_config['w_bit']}bit-{quant_config['q_group_size']}g-{quant_config['version']}"
+    return suffix if quant_config.get('zero_point', True) else f"{suffix}-sym"
+
+def plan_variants(model: str, quanter: str, data_dir: str) -> List[AwqVariant]:
+    """
+    The repository and output directory of every variant in Config.QUANT_CONFIGS.
+    """
+    variants = []
+    for quant_config in Config.QUANT_CONFIGS:
+        repo_name = f"{quanter}/{model}-{awq_repo_suffix(quant_config, Config.QUANT_CONFIGS)}"
+        model_path = os.path.join(data_dir, repo_name.split('/')[-1])
+        variants.append(AwqVariant(quant_config, repo_name, model_path, os.path.join(model_path, 'README.md')))
+    if len({variant.repo_name for variant in variants}) < len(variants):
+        raise ValueError(f"QUANT_CONFIGS has duplicate variants: {Config.QUANT_CONFIGS}")
+    return variants
+
 def parse_model_string(model_string):
     """Parse the combined author/model string."""
     match = re.match(r'([^/]+)/(.+)', model_string)
@@ -33,6 +66,7 @@ def parse_model_string(model_string):
         raise ValueError("Invalid model format. Use 'author/model'.")
 
 def main(author: str, model: str, quanter: str = None, expected_checksum: str = None):
+    admission = None
     try:
         logger.info(f"Starting quantization process for {author}/{model}")
         print(f"Starting quantization process for {author}/{model}")
@@ -50,19 +84,49 @@ def main(author: str, model: str, quanter: str = None, expected_checksum: str =
             logger.info(f"Using default quanter from configuration: {quanter}")
             print(f"Using default quanter from configuration: {quanter}")
 
+        # 0. Check that the job's predicted peak disk use fits before starting it
+        data_dir = Config.DATA_DIR
+        if Config.DISK_ADMISSION != 'off':
+            job_dir_names = [f"{author}-{model}"] + [os.path.basename(variant.model_path)
+                                                     for variant in plan_variants(model, quanter, Config.DATA_DIR)]
+            admission = admit_job(
+                f"{author}/{model}",
+                job_dir_names,
+                [Config.DATA_DIR] + Config.SCRATCH_DIRS,
+                mode=Config.DISK_ADMISSION,
+                headroom=int(Config.DISK_HEADROOM_GB * 1024 ** 3),
+                queue_timeout=Config.DISK_QUEUE_TIMEOUT,
+                dtype_policy=Config.CONVERSION_DTYPE_POLICY,
+                quant_configs=Config.QUANT_CONFIGS,
+                workers=Config.CONVERSION_WORKERS,
+                reshard=Config.RESHARD_SIZE_GB > 0,
+                selective=Config.SELECTIVE_DOWNLOAD
+            )
+            if admission.decision != 'run':
+                logger.error(f"Not enough disk space for {author}/{model}: needs {admission.plan.required_bytes / (1024 ** 3):.2f} GB")
+                print(f"Not enough disk space for {author}/{model}: needs {admission.plan.required_bytes / (1024 ** 3):.2f} GB")
+                admission = None
+                return
+            data_dir = admission.data_dir
+            if data_dir != Config.DATA_DIR:
+                logger.info(f"Using scratch directory {data_dir}")
+                print(f"Using scratch directory {data_dir}")
+
         # 1. Download the original model
-        model_path = os.path.join(Config.DATA_DIR, f"{author}-{model}")
+        model_path = os.path.join(data_dir, f"{author}-{model}")
+        model_index = None
         if not os.path.exists(model_path):
             try:
                 logger.info(f"Downloading model {author}/{model}")
                 print(f"Downloading model {author}/{model}")
-                model_path = download_model(author, model, expected_checksum)
+                model_path = download_model(author, model, expected_checksum, data_dir=data_dir)
                 logger.info(f"Model downloaded successfully to {model_path}")
                 print(f"Model downloaded successfully to {model_path}")
                 
                 # Add model size information
                 try:
-                    model_size = get_model_size(model_path)
+                    model_index = ModelDirIndex(model_path)
+                    model_size = get_model_size(model_path, model_index)
                     logger.info(f"Model size: {model_size / (1024 * 1024):.2f} MB")
                     print(f"Model size: {model_size / (1024 * 1024):.2f} MB")
                 except Exception as e:
@@ -72,150 +136,196 @@ def main(author: str, model: str, quanter: str = None, expected_checksum: str =
                 logger.error(f"Failed to download model {author}/{model}: {str(e)}")
                 print(f"Failed to download model {author}/{model}: {str(e)}")
                 return
+        if admission:
+            update_reservation(admission, job_dir_names, 'download')
 
-        # 2. Create or get existing AWQ repo
-        awq_repo_name = f"{quanter}/{model}-AWQ"
-        try:
-            api = HfApi()
-            repo_url = api.create_repo(repo_id=awq_repo_name, token=token, exist_ok=True)
-            logger.info(f"AWQ repo created or already exists: {repo_url}")
-            print(f"AWQ repo created or already exists: {repo_url}")
-        except Exception as e:
-            logger.error(f"Failed to create AWQ repo: {str(e)}")
-            print(f"Failed to create AWQ repo: {str(e)}")
-            return
+        # 2. Create or get the existing AWQ repo of every variant
+        variants = plan_variants(model, quanter, data_dir)
+        api = HfApi()
+        for variant in variants:
+            try:
+                repo_url = api.create_repo(repo_id=variant.repo_name, token=token, exist_ok=True)
+                logger.info(f"AWQ repo created or already exists: {repo_url}")
+                print(f"AWQ repo created or already exists: {repo_url}")
+            except Exception as e:
+                logger.error(f"Failed to create AWQ repo {variant.repo_name}: {str(e)}")
+                print(f"Failed to create AWQ repo {variant.repo_name}: {str(e)}")
+                return
 
-        # 3. Download existing AWQ repo if it exists
-        awq_model_path = os.path.join(Config.DATA_DIR, awq_repo_name.split('/')[-1])
-        os.makedirs(awq_model_path, exist_ok=True)
-        
-        # 4. Create and upload processing notice README
-        readme_path = os.path.join(awq_model_path, 'README.md')
-        try:
-            process_template(Config.PROCESSING_NOTICE_PATH, readme_path, author=author, model=model, quanter=quanter)
-            api.upload_file(
-                path_or_fileobj=readme_path,
-                path_in_repo="README.md",
-                repo_id=awq_repo_name,
-                token=token,
-                commit_message="Add processing notice"
-            )
-            logger.info("Processing notice README created and uploaded")
-            print("Processing notice README created and uploaded")
-        except Exception as e:
-            logger.error(f"Failed to create or upload processing notice: {str(e)}")
-            print(f"Failed to create or upload processing notice: {str(e)}")
-            # Continue despite this error
+            # 3. Download existing AWQ repo if it exists
+            os.makedirs(variant.model_path, exist_ok=True)
+
+            # 4. Create and upload processing notice README
+            try:
+                process_template(Config.PROCESSING_NOTICE_PATH, variant.readme_path, author=author, model=model,
+                                 quanter=quanter, repo=variant.repo_name)
+                api.upload_file(
+                    path_or_fileobj=variant.readme_path,
+                    path_in_repo="README.md",
+                    repo_id=variant.repo_name,
+                    token=token,
+                    commit_message="Add processing notice"
+                )
+                logger.info(f"Processing notice README created and uploaded to {variant.repo_name}")
+                print(f"Processing notice README created and uploaded to {variant.repo_name}")
+            except Exception as e:
+                logger.error(f"Failed to create or upload processing notice: {str(e)}")
+                print(f"Failed to create or upload processing notice: {str(e)}")
+                # Continue despite this error
 
         # 5. Check if quantization is needed
-        if os.path.exists(os.path.join(awq_model_path, 'model.safetensors')):
-            logger.info("AWQ model already exists. Skipping quantization.")
-            print("AWQ model already exists. Skipping quantization.")
-        else:
+        # Scan each directory once; the indexes answer the checks below
+        model_index = model_index or ModelDirIndex(model_path)
+        pending = []
+        for variant in variants:
+            if ModelDirIndex(variant.model_path).has(SINGLE_SAFETENSORS_FILE):
+                logger.info(f"AWQ model already exists in {variant.model_path}. Skipping quantization.")
+                print(f"AWQ model already exists in {variant.model_path}. Skipping quantization.")
+            else:
+                pending.append(variant)
+        if pending:
             # Check if the model files are valid
-            if check_model_files(model_path):
+            if check_model_files(model_path, model_index):
                 logger.info("Model files are valid. Proceeding with conversion and quantization.")
                 print("Model files are valid. Proceeding with conversion and quantization.")
                 
                 # Convert the model to a single safetensors file if needed
                 logger.info("Checking if model conversion to safetensors format is needed")
                 print("Checking if model conversion to safetensors format is needed")
-                if os.path.exists(os.path.join(model_path, 'model.safetensors')):
+                if model_index.has(SINGLE_SAFETENSORS_FILE):
                     logger.info("model.safetensors already exists. Skipping conversion.")
                     print("model.safetensors already exists. Skipping conversion.")
                     converted_path = model_path
-                elif os.path.exists(os.path.join(model_path, 'model.safetensors.index.json')):
+                    converted_index = model_index
+                elif model_index.has(SAFETENSORS_INDEX_FILE):
                     logger.info("Sharded safetensors model found. No conversion needed.")
                     print("Sharded safetensors model found. No conversion needed.")
                     converted_path = model_path
+                    converted_index = model_index
                 else:
                     logger.info("Starting model conversion to safetensors format")
                     print("Starting model conversion to safetensors format")
-                    converted_path = convert_model_to_safetensors(model_path)
+                    converted_path = convert_model_to_safetensors(
+                        model_path,
+                        workers=Config.CONVERSION_WORKERS,
+                        memory_budget=int(Config.CONVERSION_MEMORY_BUDGET_GB * 1024 ** 3),
+                        dtype_policy=Config.CONVERSION_DTYPE_POLICY,
+                        pipeline_depth=Config.CONVERSION_PIPELINE_DEPTH
+                    )
                     logger.info(f"Model converted and saved to {converted_path}")
                     print(f"Model converted and saved to {converted_path}")
+                    if admission:
+                        update_reservation(admission, job_dir_names, 'convert')
+
+                    if Config.RESHARD_SIZE_GB > 0:
+                        logger.info(f"Resharding converted model into {Config.RESHARD_SIZE_GB} GB shards")
+                        print(f"Resharding converted model into {Config.RESHARD_SIZE_GB} GB shards")
+                        reshard_model(converted_path, target_size=int(Config.RESHARD_SIZE_GB * 1024 ** 3))
+                        if admission:
+                            update_reservation(admission, job_dir_names, 'reshard')
+                    converted_index = ModelDirIndex(converted_path)
 
                 # Add this line to print the model size after conversion
-                converted_model_size = get_model_size(converted_path)
+                converted_model_size = get_model_size(converted_path, converted_index)
                 logger.info(f"Converted model size: {converted_model_size / (1024 * 1024):.2f} MB")
                 print(f"Converted model size: {converted_model_size / (1024 * 1024):.2f} MB")
 
                 # Check if model weights exist after conversion
-                if not (os.path.exists(os.path.join(converted_path, 'model.safetensors')) or 
-                        os.path.exists(os.path.join(converted_path, 'model.safetensors.index.json'))):
+                if not converted_index.has_safetensors_weights:
                     logger.error("No safetensors model weights found after conversion. Aborting quantization.")
                     print("No safetensors model weights found after conversion. Aborting quantization.")
                     return
 
+                # Pre-flight: check the weights to quantize from their headers before loading them
+                report = inspect_safetensors(converted_path, converted_index)
+                if not report.ok:
+                    for problem in report.problems:
+                        logger.error(f"Invalid safetensors weights: {problem}")
+                    print(f"Invalid safetensors weights in {converted_path}: {'; '.join(report.problems)}. Aborting quantization.")
+                    return
+                logger.info(f"Weights to quantize: {report.summary()}")
+                print(f"Weights to quantize: {report.summary()}")
+
                 # Quantize the model
                 logger.info("Starting model quantization")
                 print("Starting model quantization")
                 try:
-                    run_quantization(converted_path, Config.QUANT_CONFIG, awq_model_path)
+                    # All pending variants come from one load and calibration pass
+                    run_quantization(converted_path, [variant.quant_config for variant in pending],
+                                     [variant.model_path for variant in pending])
                 except Exception as e:
                     logger.error(f"Quantization failed: {str(e)}")
                     print(f"Quantization failed: {str(e)}")
                     logger.exception("Detailed traceback:")
                     return
 
-        # After quantization
-        model_path = os.path.join(awq_model_path, 'model.safetensors')
-        sharded_model_index = os.path.join(awq_model_path, 'model.safetensors.index.json')
-        
-        if os.path.exists(model_path):
-            logger.info("AWQ model created successfully.")
-            print("AWQ model created successfully.")
-        elif os.path.exists(sharded_model_index):
-            logger.info("AWQ sharded model created successfully.")
-            print("AWQ sharded model created successfully.")
-        else:
-            logger.error(
-                "AWQ model creation failed. Neither 'model.safetensors' nor 'model.safetensors.index.json' found in the output directory."
-            )
-            print(
-                "AWQ model creation failed. Neither 'model.safetensors' nor 'model.safetensors.index.json' found in the output directory."
-            )
-            return
+        for variant in variants:
+            publish_variant(api, token, variant, model_index, author, model, quanter)
+    except Exception as e:
+        logger.error(f"An error occurred during the quantization process: {str(e)}")
+        print(f"An error occurred during the quantization process: {str(e)}")
+        sys.exit(1)
+    finally:
+        # The job writes nothing more, so its remaining reservation goes back to other jobs
+        if admission:
+            release_reservation(admission, job_dir_names)
 
-        # Copy config.json and tokenizer files to AWQ model directory if they don't exist
-        for file in ['config.json', 'tokenizer.json', 'tokenizer_config.json']:
-            src = os.path.join(model_path, file)
-            dst = os.path.join(awq_model_path, file)
-            if os.path.exists(src) and not os.path.exists(dst):
-                shutil.copy2(src, dst)
-                logger.info(f"Copied {file} to AWQ model directory")
-
-        # 6. Validate AWQ model
-        if validate_quantized_model(awq_model_path):
-            # Update README with initial content
-            process_template(Config.INITIAL_README_PATH, readme_path, author=author, model=model, quanter=quanter)
-            api.upload_file(
-                path_or_fileobj=readme_path,
-                path_in_repo="README.md",
-                repo_id=awq_repo_name,
-                token=token,
-                commit_message="Update README after successful quantization"
-            )
-            logger.info("AWQ model validated and README updated")
-        else:
-            logger.error("AWQ model validation failed")
-            print("AWQ model validation failed")
-            return
+def publish_variant(api: HfApi, token: str, variant: AwqVariant, model_index: ModelDirIndex,
+                    author: str, model: str, quanter: str) -> bool:
+    """
+    Check, validate and upload the quantized model of one variant. Returns whether it was uploaded.
+    """
+    awq_index = ModelDirIndex(variant.model_path)
 
-        # 7. Final push of AWQ model to HuggingFace
-        api.upload_folder(
-            folder_path=awq_model_path,
-            repo_id=awq_repo_name,
+    if awq_index.has(SINGLE_SAFETENSORS_FILE):
+        logger.info(f"AWQ model created successfully in {variant.model_path}.")
+        print(f"AWQ model created successfully in {variant.model_path}.")
+    elif awq_index.has(SAFETENSORS_INDEX_FILE):
+        logger.info(f"AWQ sharded model created successfully in {variant.model_path}.")
+        print(f"AWQ sharded model created successfully in {variant.model_path}.")
+    else:
+        logger.error(
+            f"AWQ model creation failed. Neither 'model.safetensors' nor 'model.safetensors.index.json' found in {variant.model_path}."
+        )
+        print(
+            f"AWQ model creation failed. Neither 'model.safetensors' nor 'model.safetensors.index.json' found in {variant.model_path}."
+        )
+        return False
+
+    # Copy config.json and tokenizer files to AWQ model directory if they don't exist
+    for file in ['config.json', 'tokenizer.json', 'tokenizer_config.json']:
+        if model_index.has(file) and not awq_index.has(file):
+            shutil.copy2(model_index.files[file].real_path, os.path.join(variant.model_path, file))
+            logger.info(f"Copied {file} to AWQ model directory")
+
+    # 6. Validate AWQ model
+    if validate_quantized_model(variant.model_path):
+        # Update README with initial content
+        process_template(Config.INITIAL_README_PATH, variant.readme_path, author=author, model=model, quanter=quanter,
+                         repo=variant.repo_name)
+        api.upload_file(
+            path_or_fileobj=variant.readme_path,
+            path_in_repo="README.md",
+            repo_id=variant.repo_name,
             token=token,
-            commit_message="Upload quantized AWQ model"
+            commit_message="Update README after successful quantization"
         )
-        logger.info("AWQ model successfully uploaded to HuggingFace")
-        print("AWQ model successfully uploaded to HuggingFace")
+        logger.info("AWQ model validated and README updated")
+    else:
+        logger.error(f"AWQ model validation failed for {variant.repo_name}")
+        print(f"AWQ model validation failed for {variant.repo_name}")
+        return False
 
-    except Exception as e:
-        logger.error(f"An error occurred during the quantization process: {str(e)}")
-        print(f"An error occurred during the quantization process: {str(e)}")
-        sys.exit(1)
+    # 7. Final push of AWQ model to HuggingFace
+    api.upload_folder(
+        folder_path=variant.model_path,
+        repo_id=variant.repo_name,
+        token=token,
+        commit_message="Upload quantized AWQ model"
+    )
+    logger.info(f"AWQ model successfully uploaded to {variant.repo_name}")
+    print(f"AWQ model successfully uploaded to {variant.repo_name}")
+    return True
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Quantize a Hugging Face model")
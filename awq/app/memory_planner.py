@@ -0,0 +1,237 @@
+# app/memory_planner.py
+
+import os
+import re
+import json
+import logging
+from typing import Any, Dict, NamedTuple, Optional
+
+from app.safetensors_inspector import SafetensorsReport, inspect_safetensors
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+# AutoAWQ's default calibration set: max_calib_samples and max_calib_seq_len
+DEFAULT_CALIB_SAMPLES = 128
+DEFAULT_CALIB_SEQLEN = 512
+
+FLOAT_DTYPES = ('F16', 'BF16', 'F32', 'F64', 'F8_E4M3', 'F8_E5M2')
+
+# Decoder layer index in tensor names: model.layers.3., transformer.h.3., blocks.3. ...
+LAYER_PATTERN = re.compile(r'(?:^|\.)(?:layers|h|blocks|block)\.(\d+)\.')
+
+class ModelShape(NamedTuple):
+    num_layers: int
+    hidden_size: int
+    intermediate_size: int
+    vocab_size: int
+    num_attention_heads: int
+    num_key_value_heads: int
+    tie_word_embeddings: bool
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'ModelShape':
+        """
+        Read the shape of a decoder-only model from its config.json contents.
+
+        The names used by Llama-style, GPT-2-style and OPT-style configs are all
+        accepted; multimodal configs are read from their text_config.
+        """
+        config = config.get('text_config') or config
+
+        def first(*keys, default=None):
+            for key in keys:
+                if config.get(key) is not None:
+                    return config[key]
+            if default is None:
+                raise ValueError(f"config.json has none of {', '.join(keys)}")
+            return default
+
+        hidden_size = int(first('hidden_size', 'n_embd', 'd_model'))
+        heads = int(first('num_attention_heads', 'n_head', 'num_heads'))
+        return cls(
+            num_layers=int(first('num_hidden_layers', 'n_layer', 'num_layers')),
+            hidden_size=hidden_size,
+            intermediate_size=int(first('intermediate_size', 'ffn_dim', 'n_inner', default=4 * hidden_size)),
+            vocab_size=int(first('vocab_size')),
+            num_attention_heads=heads,
+            num_key_value_heads=int(first('num_key_value_heads', 'num_kv_heads', default=heads)),
+            tie_word_embeddings=bool(config.get('tie_word_embeddings', False)),
+        )
+
+    @property
+    def layer_params(self) -> int:
+        """
+        Parameters of one decoder layer: attention projections, a gated MLP and two norms.
+        """
+        kv_size = self.hidden_size // self.num_attention_heads * self.num_key_value_heads
+        attention = 2 * self.hidden_size * self.hidden_size + 2 * self.hidden_size * kv_size
+        return attention + 3 * self.hidden_size * self.intermediate_size + 2 * self.hidden_size
+
+    @property
+    def resident_params(self) -> int:
+        """
+        Parameters outside the decoder layers: embeddings, the final norm and, unless tied, the LM head.
+        """
+        return self.vocab_size * self.hidden_size * (1 if self.tie_word_embeddings else 2) + self.hidden_size
+
+class MemoryEstimate(NamedTuple):
+    model_bytes: int
+    layer_bytes: int  # Largest decoder layer
+    resident_bytes: int  # Everything outside the decoder layers
+    largest_shard_bytes: int
+    activation_bytes: int  # Calibration inputs, outputs and cached linear inputs of one layer
+
+    @property
+    def layer_working_set(self) -> int:
+        """
+        Memory needed next to a layer while it is quantized: the activations and
+        a second copy of its weights for the scale and clip searches.
+        """
+        return self.activation_bytes + self.layer_bytes
+
+class ExecutionPlan(NamedTuple):
+    mode: str  # 'full', 'offload' or 'stream'
+    device: str  # 'cuda' or 'cpu'
+    host_peak_bytes: int
+    device_peak_bytes: int
+    fits: bool
+    max_memory: Optional[Dict[Any, int]]
+    estimate: MemoryEstimate
+
+    def summary(self) -> str:
+        return (f"{self.mode} on {self.device}: host peak {self.host_peak_bytes / GB:.2f} GB, "
+                f"device peak {self.device_peak_bytes / GB:.2f} GB"
+                + ("" if self.fits else " (does not fit)"))
+
+def estimate_memory(config: Dict[str, Any], report: Optional[SafetensorsReport] = None, load_itemsize: int = 2,
+                    n_samples: int = DEFAULT_CALIB_SAMPLES, seqlen: int = DEFAULT_CALIB_SEQLEN) -> MemoryEstimate:
+    """
+    Estimate the memory AutoAWQ needs to load and quantize a model.
+
+    Weights come from the shard headers when a report is given, grouped by
+    decoder layer from the tensor names, and are otherwise derived from the
+    config. Floating point weights are counted at load_itemsize bytes, the
+    dtype they are loaded in. The per-layer activations follow AutoAWQ: the
+    layer's calibration inputs and outputs, plus the inputs cached for each
+    linear (three of hidden size for q/k/v, o and gate/up, one of intermediate
+    size for down), all at load_itemsize.
+
+    Args:
+        config: config.json contents.
+        report: Header inspection of the safetensors weights.
+        load_itemsize: Bytes per element of the loaded weights and activations.
+        n_samples: Calibration samples.
+        seqlen: Tokens per calibration sample.
+
+    Returns:
+        MemoryEstimate: Weight, shard and activation sizes in bytes.
+    """
+    shape = ModelShape.from_config(config)
+    if report and report.tensors:
+        layers: Dict[int, int] = {}
+        resident = 0
+        shards: Dict[str, int] = {}
+        for name, info in report.tensors.items():
+            nbytes = info.numel * load_itemsize if info.dtype in FLOAT_DTYPES else info.nbytes
+            shards[info.shard] = shards.get(info.shard, 0) + nbytes
+            match = LAYER_PATTERN.search(name)
+            if match:
+                layers[int(match.group(1))] = layers.get(int(match.group(1)), 0) + nbytes
+            else:
+                resident += nbytes
+        layer_bytes = max(layers.values(), default=0)
+        model_bytes = resident + sum(layers.values())
+        largest_shard = max(shards.values())
+    else:
+        layer_bytes = shape.layer_params * load_itemsize
+        resident = shape.resident_params * load_itemsize
+        model_bytes = resident + shape.num_layers * layer_bytes
+        largest_shard = model_bytes
+
+    tokens = n_samples * seqlen
+    activation_bytes = tokens * (5 * shape.hidden_size + shape.intermediate_size) * load_itemsize
+    return MemoryEstimate(model_bytes, layer_bytes, resident, largest_shard, activation_bytes)
+
+def plan_execution(estimate: MemoryEstimate, host_bytes: int, device_bytes: int = 0, headroom: int = 0) -> ExecutionPlan:
+    """
+    Choose how to run a quantization given the memory available.
+
+    With a GPU (device_bytes > 0):
+      - 'full': the whole model plus one layer's working set fits on the device.
+        Safetensors are memory mapped, so the host holds about one shard and the
+        CPU copy AutoAWQ keeps of the layer being searched.
+      - 'offload': the device holds the embeddings and one layer's working set;
+        layers that do not fit stay in host memory and AutoAWQ moves each to the
+        device in turn. max_memory caps the device share of the weights.
+      - 'stream': neither fits; layers are loaded one at a time from the shards.
+    On CPU, 'full' loads the whole model in host memory and 'stream' is the
+    fallback. When even streaming does not fit, the plan says so in fits.
+
+    Args:
+        estimate: From estimate_memory.
+        host_bytes: Available host memory.
+        device_bytes: Available device memory, 0 without a GPU.
+        headroom: Bytes kept free on each side on top of the estimate.
+
+    Returns:
+        ExecutionPlan: The chosen mode with its peak memory estimates.
+    """
+    host = host_bytes - headroom
+    stream_device = estimate.layer_bytes + estimate.layer_working_set
+    if device_bytes > 0:
+        device = device_bytes - headroom
+        full_device = estimate.model_bytes + estimate.layer_working_set
+        full_host = estimate.largest_shard_bytes + estimate.layer_bytes
+        if full_device <= device and full_host <= host:
+            return ExecutionPlan('full', 'cuda', full_host, full_device, True, None, estimate)
+
+        offload_device = estimate.resident_bytes + estimate.layer_bytes + estimate.layer_working_set
+        weights_on_device = max(0, device - estimate.layer_working_set)
+        offload_host = estimate.model_bytes - min(weights_on_device, estimate.model_bytes) + estimate.layer_bytes
+        if offload_device <= device and offload_host <= host:
+            max_memory = {0: weights_on_device, 'cpu': host}
+            return ExecutionPlan('offload', 'cuda', offload_host, device, True, max_memory, estimate)
+
+        stream_host = estimate.resident_bytes + 2 * estimate.layer_bytes
+        return ExecutionPlan('stream', 'cuda', stream_host, stream_device,
+                             stream_host <= host and stream_device <= device, None, estimate)
+
+    full_host = estimate.model_bytes + estimate.layer_working_set
+    if full_host <= host:
+        return ExecutionPlan('full', 'cpu', full_host, 0, True, None, estimate)
+    stream_host = estimate.resident_bytes + stream_device
+    return ExecutionPlan('stream', 'cpu', stream_host, 0, stream_host <= host, None, estimate)
+
+def available_host_memory() -> int:
+    """
+    Host memory available to a new process: MemAvailable from /proc/meminfo,
+    or the free physical pages where that is not readable.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+def plan_quantization(model_path: str, host_bytes: int, device_bytes: int = 0, headroom: int = 0,
+                      n_samples: int = DEFAULT_CALIB_SAMPLES, seqlen: int = DEFAULT_CALIB_SEQLEN) -> ExecutionPlan:
+    """
+    Plan the quantization of a model directory from its config.json and shard headers.
+
+    Weights are loaded in float16 on a GPU and float32 on CPU, as run_quantization does.
+    Nothing is loaded; only the headers and the config are read.
+    """
+    with open(os.path.join(model_path, 'config.json'), 'r') as f:
+        config = json.load(f)
+    report = inspect_safetensors(model_path)
+    load_itemsize = 2 if device_bytes > 0 else 4
+    estimate = estimate_memory(config, report, load_itemsize, n_samples, seqlen)
+    plan = plan_execution(estimate, host_bytes, device_bytes, headroom)
+    logger.info(f"Memory plan for {model_path}: {plan.summary()} (model {estimate.model_bytes / GB:.2f} GB, "
+                f"largest layer {estimate.layer_bytes / GB:.2f} GB, activations {estimate.activation_bytes / GB:.2f} GB)")
+    return plan
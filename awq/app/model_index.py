@@ -0,0 +1,124 @@
+# app/model_index.py
+
+import os
+import logging
+from typing import Dict, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = 'config.json'
+TOKENIZER_FILES = ['tokenizer.json', 'tokenizer.model']
+SINGLE_BIN_FILE = 'pytorch_model.bin'
+SINGLE_SAFETENSORS_FILE = 'model.safetensors'
+SAFETENSORS_INDEX_FILE = 'model.safetensors.index.json'
+BIN_INDEX_FILE = 'pytorch_model.bin.index.json'
+
+class IndexedFile(NamedTuple):
+    path: str
+    real_path: str
+    size: int
+
+class ModelDirIndex:
+    """
+    Every file of a model directory, found in a single scandir pass.
+
+    Files are keyed by their path relative to the model directory, in the same
+    top-down order as os.walk. Each entry is stat'ed once and symlinks (such as
+    those into a Hugging Face cache) are resolved once, so the checks, the size
+    and the conversion decisions made from an index do not touch the file system
+    again. A directory that changes afterwards needs a new index.
+    """
+
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self.files: Dict[str, IndexedFile] = {}
+        self._by_name: Dict[str, IndexedFile] = {}
+        self._scan(model_path, '')
+
+    def _scan(self, directory: str, prefix: str) -> None:
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.error(f"Failed to scan {directory}: {str(e)}")
+            return
+
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    # Like os.walk, symlinked directories are not followed
+                    if not entry.is_symlink():
+                        subdirs.append(entry)
+                    continue
+                size = entry.stat().st_size
+            except OSError as e:
+                logger.warning(f"Skipping {entry.path}: {str(e)}")
+                continue
+            real_path = os.path.realpath(entry.path) if entry.is_symlink() else entry.path
+            indexed = IndexedFile(entry.path, real_path, size)
+            self.files[prefix + entry.name] = indexed
+            self._by_name.setdefault(entry.name, indexed)
+
+        for entry in subdirs:
+            self._scan(entry.path, f"{prefix}{entry.name}/")
+
+    def find(self, filename: str) -> str:
+        """
+        Path of the first file with this name anywhere in the tree, with symlinks
+        resolved, or an empty string. Same result as model_utils.find_file.
+        """
+        indexed = self._by_name.get(filename)
+        return indexed.real_path if indexed else ""
+
+    def has(self, relative_path: str) -> bool:
+        """
+        Whether the model directory holds this file at this relative path.
+        """
+        return relative_path in self.files
+
+    def top_level(self, suffix: str) -> List[str]:
+        """
+        Sorted names of the files directly in the model directory ending with suffix.
+        """
+        return [name for name in self.files if '/' not in name and name.endswith(suffix)]
+
+    @property
+    def total_size(self) -> int:
+        return sum(indexed.size for indexed in self.files.values())
+
+    @property
+    def has_config(self) -> bool:
+        return bool(self.find(CONFIG_FILE))
+
+    @property
+    def tokenizer_file(self) -> str:
+        for filename in TOKENIZER_FILES:
+            if self.find(filename):
+                return filename
+        return ""
+
+    @property
+    def weights_format(self) -> Optional[str]:
+        """
+        How the weights are stored: 'bin', 'safetensors', 'sharded-safetensors',
+        'sharded-bin', or None when no weights are found. When several layouts are
+        present, the first in that order wins.
+        """
+        if self.find(SINGLE_BIN_FILE):
+            return 'bin'
+        if self.find(SINGLE_SAFETENSORS_FILE):
+            return 'safetensors'
+        if self.find(SAFETENSORS_INDEX_FILE):
+            return 'sharded-safetensors'
+        if self.find(BIN_INDEX_FILE):
+            return 'sharded-bin'
+        return None
+
+    @property
+    def has_safetensors_weights(self) -> bool:
+        """
+        Whether model.safetensors or model.safetensors.index.json sits at the top of
+        the directory, i.e. the weights can be quantized without conversion.
+        """
+        return self.has(SINGLE_SAFETENSORS_FILE) or self.has(SAFETENSORS_INDEX_FILE)
@@ -1,15 +1,40 @@
 import os
+import glob
+import json
 import logging
-from typing import Dict
-from huggingface_hub import login, snapshot_download, HfFolder
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Dict, List, NamedTuple, Optional
+from huggingface_hub import login, snapshot_download, hf_hub_download, hf_hub_url, HfApi, HfFolder
+from huggingface_hub.utils import build_hf_headers
 from app.config import Config
+from app.checksum_cache import ChecksumCache, file_identity
+from app.model_index import CONFIG_FILE, ModelDirIndex
+from common.model_store import ModelStore
+from app.safetensors_inspector import inspect_safetensors
+from app.range_downloader import download_file
 import hashlib
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
-# Add a simple cache for downloaded models
-model_cache: Dict[str, str] = {}
+CHECKSUM_CHUNK_SIZE = 8 * 1024 * 1024
+
+# File types holding model weights, in any framework
+WEIGHT_SUFFIXES = ('.safetensors', '.bin', '.pt', '.pth', '.ckpt', '.h5', '.msgpack', '.gguf', '.onnx', '.ot', '.tflite')
+
+# Weight formats the pipeline can use, best first: (name, prefix, suffix, index file)
+WEIGHT_FORMATS = [
+    ('safetensors', 'model', '.safetensors', 'model.safetensors.index.json'),
+    ('bin', 'pytorch_model', '.bin', 'pytorch_model.bin.index.json'),
+]
+
+class DownloadPlan(NamedTuple):
+    weights_format: str
+    allow_patterns: List[str]
+    skipped: List[str]
+    download_bytes: int
+    saved_bytes: int
 
 def authenticate_huggingface():
     """
@@ -23,14 +48,77 @@ def authenticate_huggingface():
         logger.error("HF_ACCESS_TOKEN not found in environment variables or Hugging Face cache.")
         return None
 
-def download_model(author: str, model: str, expected_checksum: str = None) -> str:
+def download_model(author: str, model: str, expected_checksum: str = None, api: HfApi = None,
+                   data_dir: str = None) -> str:
     """
     Download the model from Hugging Face, handling the new blob structure and validating checksum.
+
+    The repository is listed first and, when it holds several weight formats, only
+    the best one is downloaded (see plan_download). Every LFS file is checked
+    against the sha256 the Hub records for it, and a file that does not match is
+    downloaded again once before giving up. Files of at least
+    Config.RANGE_DOWNLOAD_MIN_MB are fetched with parallel range requests that
+    resume where an interrupted run stopped. The model goes under data_dir,
+    Config.DATA_DIR by default. With a model store configured, a snapshot already
+    stored (by this or another pipeline) is linked into place instead of
+    downloaded, and a new download is added to the store.
     """
+    store = ModelStore(Config.MODEL_STORE_DIR, int(Config.MODEL_STORE_BUDGET_GB * 1024 ** 3)) if Config.MODEL_STORE_DIR else None
     try:
         logger.info(f"Attempting to download model {author}/{model}")
-        model_path = snapshot_download(repo_id=f"{author}/{model}", local_dir=os.path.join(Config.DATA_DIR, f"{author}-{model}"))
-        logger.info(f"Model downloaded successfully to {model_path}")
+        repo_id = f"{author}/{model}"
+        local_dir = os.path.join(data_dir or Config.DATA_DIR, f"{author}-{model}")
+        try:
+            info = fetch_repo_info(repo_id, api)
+        except Exception as e:
+            logger.warning(f"Could not list {repo_id}: {str(e)}")
+            info = None
+        revision = info.sha if info else None
+
+        if store and store.materialize(repo_id, revision, local_dir):
+            model_path = local_dir
+        else:
+            files = repo_file_sizes(info) if info else {}
+            plan = plan_download(files) if info and Config.SELECTIVE_DOWNLOAD else None
+            if plan:
+                logger.info(f"Downloading {plan.weights_format} weights only: {plan.download_bytes / (1024 ** 3):.2f} GB, "
+                            f"skipping {len(plan.skipped)} files and saving {plan.saved_bytes / (1024 ** 3):.2f} GB")
+                files = {name: size for name, size in files.items() if name not in plan.skipped}
+            # Ranged downloads need the pinned revision, so every file comes from the same commit
+            ranged = large_files(files) if revision else []
+            model_path = snapshot_download(repo_id=repo_id, local_dir=local_dir, revision=revision,
+                                           allow_patterns=plan.allow_patterns if plan else None,
+                                           ignore_patterns=[glob.escape(name) for name in ranged] or None)
+            for filename in ranged:
+                download_repo_file(repo_id, filename, local_dir, revision, files[filename])
+            logger.info(f"Model downloaded successfully to {model_path}")
+
+            lfs_checksums = None
+            if Config.VERIFY_DOWNLOADS and info is None:
+                # The object ids come from the same listing, so listing again would fail the same way
+                logger.warning(f"Skipping LFS verification of {repo_id}: its file list is not available")
+            elif Config.VERIFY_DOWNLOADS:
+                lfs_checksums = fetch_lfs_checksums(repo_id, api, info)
+                if plan:
+                    lfs_checksums = {name: digest for name, digest in lfs_checksums.items() if name not in plan.skipped}
+                corrupt = verify_lfs_files(model_path, lfs_checksums)
+                for filename in corrupt:
+                    logger.warning(f"{filename} does not match its LFS object id, downloading it again")
+                    if filename in ranged:
+                        os.remove(os.path.join(local_dir, filename))
+                        download_repo_file(repo_id, filename, local_dir, revision, files[filename])
+                        continue
+                    hf_hub_download(repo_id=repo_id, filename=filename, local_dir=local_dir, revision=revision,
+                                    force_download=True)
+                if corrupt:
+                    corrupt = verify_lfs_files(model_path, {filename: lfs_checksums[filename] for filename in corrupt})
+                    if corrupt:
+                        raise ValueError(f"Files do not match their LFS object ids after a new download: {', '.join(corrupt)}")
+                logger.info(f"Verified {len(lfs_checksums)} LFS files against their object ids")
+
+            if store and revision:
+                # Verified LFS object ids are the content addresses, only the small files get hashed
+                store.ingest(repo_id, revision, model_path, lfs_checksums)
         
         if expected_checksum:
             if validate_model_checksum(model_path, expected_checksum):
@@ -42,48 +130,148 @@ def download_model(author: str, model: str, expected_checksum: str = None) -> st
     except Exception as e:
         logger.error(f"Error downloading model {author}/{model}: {str(e)}")
         raise
+    finally:
+        if store:
+            store.close()
+
+def fetch_repo_info(repo_id: str, api: HfApi = None):
+    """
+    Model info of a Hub repository with per-file metadata (sizes, LFS object ids) and its commit sha.
+    """
+    return (api or HfApi()).model_info(repo_id, files_metadata=True)
+
+def repo_file_sizes(info) -> Dict[str, int]:
+    return {sibling.rfilename: sibling.size or 0 for sibling in info.siblings or []}
+
+def large_files(files: Dict[str, int]) -> List[str]:
+    """
+    Files big enough to be fetched with range requests instead of snapshot_download.
+    """
+    if Config.DOWNLOAD_CONNECTIONS <= 0:
+        return []
+    threshold = Config.RANGE_DOWNLOAD_MIN_MB * 1024 ** 2
+    return sorted(name for name, size in files.items() if size >= threshold)
+
+def download_repo_file(repo_id: str, filename: str, local_dir: str, revision: str, size: int = None) -> str:
+    """
+    Fetch one file of a Hub repository over Config.DOWNLOAD_CONNECTIONS parallel,
+    resumable range requests (see range_downloader.download_file).
+    """
+    url = hf_hub_url(repo_id, filename, revision=revision)
+    return download_file(url, os.path.join(local_dir, filename), size=size, headers=build_hf_headers(),
+                         connections=Config.DOWNLOAD_CONNECTIONS, chunk_size=int(Config.DOWNLOAD_CHUNK_MB * 1024 ** 2))
+
+def fetch_lfs_checksums(repo_id: str, api: HfApi = None, info=None) -> Dict[str, str]:
+    """
+    Map every LFS file of a Hub repository to the sha256 recorded as its object id.
+    """
+    info = info or fetch_repo_info(repo_id, api)
+    # lfs is a dict on older huggingface_hub releases and a dict subclass on newer ones
+    return {sibling.rfilename: sibling.lfs['sha256'] for sibling in info.siblings or [] if sibling.lfs}
+
+def is_weight_file(filename: str) -> bool:
+    name = filename.rsplit('/', 1)[-1]
+    if name.endswith('.index.json'):
+        name = name[:-len('.index.json')]
+    return name.endswith(WEIGHT_SUFFIXES)
+
+def plan_download(files: Dict[str, int]) -> Optional[DownloadPlan]:
+    """
+    Choose the single weight format to download from a repository listing.
+
+    Top-level safetensors weights (model.safetensors or model-*-of-*.safetensors)
+    are preferred over PyTorch .bin weights; either way, the matching index is
+    kept. Every other weight file (the other format, TensorFlow, Flax, GGUF, ONNX,
+    consolidated.* and original/ checkpoints) is skipped, while configs, tokenizers
+    and other small files are kept.
 
-def check_model_files(model_path: str) -> bool:
+    Args:
+        files: Size of every file in the repository, by path.
+
+    Returns:
+        Optional[DownloadPlan]: The allow patterns and byte counts, or None when no
+        known weight format is found and the whole repository should be downloaded.
+    """
+    top_level = [name for name in files if '/' not in name]
+    for weights_format, prefix, suffix, index in WEIGHT_FORMATS:
+        weights = [name for name in top_level if name.startswith(prefix) and name.endswith(suffix)]
+        if weights:
+            break
+    else:
+        return None
+
+    keep = set(weights)
+    if index in files:
+        keep.add(index)
+    keep.update(name for name in files if not is_weight_file(name))
+    skipped = sorted(name for name in files if name not in keep)
+    return DownloadPlan(
+        weights_format=weights_format,
+        allow_patterns=[glob.escape(name) for name in sorted(keep)],
+        skipped=skipped,
+        download_bytes=sum(files[name] for name in keep),
+        saved_bytes=sum(files[name] for name in skipped),
+    )
+
+def verify_lfs_files(model_path: str, lfs_checksums: Dict[str, str], workers: int = None) -> List[str]:
+    """
+    Hash the given files of a model directory in parallel against their LFS sha256.
+
+    Returns the files that are missing or do not match.
+    """
+    file_paths = {filename: os.path.join(model_path, filename) for filename in lfs_checksums}
+    digests = hash_files(list(file_paths.values()), workers)
+    return [filename for filename, file_path in file_paths.items() if digests.get(file_path) != lfs_checksums[filename]]
+
+def check_model_files(model_path: str, index: ModelDirIndex = None) -> bool:
     """
     Verify if the specified model path contains valid model files.
+
+    The checks run against a ModelDirIndex, scanned here unless one is passed in.
+    Safetensors weights are also checked from their headers (see
+    inspect_safetensors), so a truncated shard or an index that does not match
+    the shards fails here without reading any tensor data.
     """
-    required_files = ['config.json']
-    for file in required_files:
-        file_path = find_file(model_path, file)
-        if not file_path:
-            logger.error(f"Required file {file} not found in {model_path}")
-            return False
+    index = index or ModelDirIndex(model_path)
+    if not index.has_config:
+        logger.error(f"Required file {CONFIG_FILE} not found in {model_path}")
+        return False
     
     # Check for tokenizer files
-    if not (find_file(model_path, 'tokenizer.json') or find_file(model_path, 'tokenizer.model')):
+    if not index.tokenizer_file:
         logger.error(f"No tokenizer file (tokenizer.json or tokenizer.model) found in {model_path}")
         return False
     
     # Check for either pytorch_model.bin, model.safetensors, or sharded model files
-    if find_file(model_path, 'pytorch_model.bin'):
+    weights_format = index.weights_format
+    if weights_format == 'bin':
         logger.info(f"Found single file model: pytorch_model.bin")
-    elif find_file(model_path, 'model.safetensors'):
+    elif weights_format == 'safetensors':
         logger.info(f"Found single file model: model.safetensors")
-    elif find_file(model_path, 'model.safetensors.index.json'):
+    elif weights_format == 'sharded-safetensors':
         logger.info(f"Found sharded safetensors model")
-    elif find_file(model_path, 'pytorch_model.bin.index.json'):
+    elif weights_format == 'sharded-bin':
         logger.info(f"Found sharded PyTorch model")
     else:
         logger.error(f"No valid model weights found in {model_path}")
         return False
+
+    if index.has_safetensors_weights:
+        report = inspect_safetensors(model_path, index)
+        for problem in report.problems:
+            logger.error(f"Invalid safetensors weights in {model_path}: {problem}")
+        if not report.ok:
+            return False
+        logger.info(f"Safetensors weights: {report.summary()}")
     
     logger.info(f"All required model files found in {model_path}")
     return True
 
-def get_model_size(model_path: str) -> int:
+def get_model_size(model_path: str, index: ModelDirIndex = None) -> int:
     """
     Get the total size of all model files in bytes.
     """
-    total_size = 0
-    for root, _, files in os.walk(model_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            total_size += os.path.getsize(file_path)
+    total_size = (index or ModelDirIndex(model_path)).total_size
     
     logger.info(f"Total model size: {total_size / (1024 * 1024):.2f} MB")
     return total_size
@@ -91,10 +279,26 @@ def get_model_size(model_path: str) -> int:
 def validate_model_checksum(model_path: str, expected_checksum: str) -> bool:
     """
     Validate the model file(s) checksum.
+
+    expected_checksum is either a directory root as returned by
+    calculate_directory_checksum or the path of a manifest written by
+    save_checksum_manifest. With a manifest, a mismatch names the files that differ.
+    Digests are reused from the checksum cache for files that did not change.
     """
     logger.info(f"Validating checksum for model at {model_path}")
-    
-    calculated_checksum = calculate_directory_checksum(model_path)
+
+    with ChecksumCache(Config.CHECKSUM_CACHE_PATH) if Config.CHECKSUM_CACHE_PATH else nullcontext() as cache:
+        if os.path.isfile(expected_checksum):
+            expected_manifest = load_checksum_manifest(expected_checksum)
+            manifest = calculate_directory_manifest(model_path, cache=cache)
+            if manifest_root(manifest) == manifest_root(expected_manifest):
+                logger.info("Checksum validation successful")
+                return True
+            for problem in diff_manifests(expected_manifest, manifest):
+                logger.warning(f"Checksum mismatch: {problem}")
+            return False
+
+        calculated_checksum = calculate_directory_checksum(model_path, cache=cache)
     
     if calculated_checksum == expected_checksum:
         logger.info("Checksum validation successful")
@@ -103,23 +307,125 @@ def validate_model_checksum(model_path: str, expected_checksum: str) -> bool:
         logger.warning(f"Checksum mismatch. Expected: {expected_checksum}, Calculated: {calculated_checksum}")
         return False
 
-def calculate_directory_checksum(directory: str) -> str:
+def hash_file(file_path: str, chunk_size: int = CHECKSUM_CHUNK_SIZE) -> str:
     """
-    Calculate a checksum for all files in a directory.
+    Compute the sha256 of a file in chunks, so memory use does not grow with the file.
     """
-    checksums = []
-    for root, _, files in os.walk(directory):
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def hash_files(file_paths: List[str], workers: int = None, cache: ChecksumCache = None) -> Dict[str, str]:
+    """
+    Compute the sha256 of each file on a thread pool.
+
+    Returns a map of file path to hex digest in the order of file_paths. hashlib
+    releases the GIL on large updates, so the files are hashed in parallel. A file
+    that cannot be read is logged and left out. With a cache, only files whose
+    path, inode, size or mtime changed since they were cached are read.
+    """
+    digests = {}
+    hashed = []
+    with ThreadPoolExecutor(max_workers=max(1, workers or Config.CHECKSUM_WORKERS)) as executor:
+        pending = []
+        for file_path in file_paths:
+            identity = None
+            if cache is not None:
+                try:
+                    # Taken before hashing, so a file rewritten meanwhile misses next time
+                    identity = file_identity(file_path)
+                except OSError:
+                    pass
+                digest = cache.get(identity) if identity else None
+                if digest:
+                    pending.append((file_path, None, digest))
+                    continue
+            pending.append((file_path, identity, executor.submit(hash_file, file_path)))
+
+        for file_path, identity, result in pending:
+            try:
+                digests[file_path] = result if isinstance(result, str) else result.result()
+            except OSError as e:
+                logger.error(f"Failed to hash {file_path}: {str(e)}")
+                continue
+            if identity:
+                hashed.append((identity, digests[file_path]))
+
+    if cache is not None:
+        logger.info(f"Hashed {len(hashed)} of {len(file_paths)} files, the rest came from the checksum cache")
+        cache.put_many(hashed)
+    return digests
+
+def calculate_directory_manifest(directory: str, workers: int = None, cache: ChecksumCache = None) -> Dict[str, str]:
+    """
+    Compute the sha256 of every file in a directory on a thread pool.
+
+    Returns an ordered map of path (relative to directory, '/'-separated) to hex
+    digest. Files are ordered by directory, then by name. A file that cannot be
+    read is left out, which makes the root mismatch.
+    """
+    file_paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
         for file in sorted(files):  # Sort to ensure consistent order
-            file_path = os.path.join(root, file)
-            with open(file_path, "rb") as f:
-                file_hash = hashlib.sha256(f.read()).hexdigest()
-                checksums.append(file_hash)
-    
-    return hashlib.sha256("".join(checksums).encode()).hexdigest()
+            file_paths.append(os.path.join(root, file))
+
+    return {os.path.relpath(file_path, directory).replace(os.sep, '/'): digest
+            for file_path, digest in hash_files(file_paths, workers, cache).items()}
+
+def manifest_root(manifest: Dict[str, str]) -> str:
+    """
+    Combine the file digests of a manifest into one root digest.
+
+    The root is the sha256 of the concatenated hex digests in manifest order.
+    That matches the checksum of earlier releases for directories without subdirectories.
+    """
+    return hashlib.sha256("".join(manifest.values()).encode()).hexdigest()
+
+def calculate_directory_checksum(directory: str, cache: ChecksumCache = None) -> str:
+    """
+    Calculate a checksum for all files in a directory.
+    """
+    return manifest_root(calculate_directory_manifest(directory, cache=cache))
+
+def diff_manifests(expected: Dict[str, str], actual: Dict[str, str]) -> List[str]:
+    """
+    Describe the files that are missing, unexpected or different between two manifests.
+    """
+    problems = []
+    for path, digest in expected.items():
+        if path not in actual:
+            problems.append(f"{path} is missing")
+        elif actual[path] != digest:
+            problems.append(f"{path} has sha256 {actual[path]}, expected {digest}")
+    problems.extend(f"{path} is not in the manifest" for path in actual if path not in expected)
+    return problems
+
+def save_checksum_manifest(directory: str, manifest_path: str) -> str:
+    """
+    Hash a directory and write its manifest and root as JSON. Returns the root.
+    """
+    manifest = calculate_directory_manifest(directory)
+    root = manifest_root(manifest)
+    with open(manifest_path, 'w') as f:
+        json.dump({'root': root, 'files': manifest}, f, indent=2)
+    logger.info(f"Wrote checksum manifest for {len(manifest)} files to {manifest_path}")
+    return root
+
+def load_checksum_manifest(manifest_path: str) -> Dict[str, str]:
+    """
+    Read the file digests of a manifest written by save_checksum_manifest.
+    """
+    with open(manifest_path) as f:
+        return json.load(f)['files']
 
 def find_file(directory: str, filename: str) -> str:
     """
     Find a file in the directory structure, following symlinks if necessary.
+
+    Each call walks the whole tree; scan once with ModelDirIndex for repeated lookups.
     """
     for root, dirs, files in os.walk(directory):
         if filename in files:
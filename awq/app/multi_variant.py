@@ -0,0 +1,112 @@
+# app/multi_variant.py
+
+import copy
+import logging
+from typing import Any, Dict, List, Optional, Sequence
+
+import torch
+from awq.models._config import AwqConfig
+from awq.utils.utils import clear_memory
+
+from app.checkpointed_quantizer import CheckpointedAwqQuantizer
+
+logger = logging.getLogger(__name__)
+
+class MultiVariantQuantizer(CheckpointedAwqQuantizer):
+    """
+    AwqQuantizer producing several AWQ variants from one load and one calibration pass.
+
+    AutoAWQ feeds every decoder layer the outputs of the previous layer before
+    it was quantized, so a layer's calibration inputs and the inputs cached for
+    its linears are the same for every variant. They are captured once per
+    layer. Variants sharing w_bit, q_group_size and zero_point (e.g. GEMM and
+    GEMV of one group size) also share their scale and clip search, and only
+    pack separately. The steps are those of CheckpointedAwqQuantizer, and so is
+    the checkpoint: every variant of a layer is saved with it, under the index
+    of the variant. Quantized layers are kept on CPU until save_variant installs
+    them in the model.
+
+    Passed to model.quantize as quantizer_cls, with the variant configs in
+    variants, an optional LayerCheckpoint in checkpoint and an optional
+    QuantTrace in trace.
+    """
+
+    def __init__(self, *args, variants: Sequence[Dict[str, Any]] = (), **kwargs):
+        super().__init__(*args, **kwargs)
+        if not variants:
+            raise ValueError("MultiVariantQuantizer needs at least one variant")
+        self.variants: List[AwqConfig] = []
+        for variant in variants:
+            config = AwqConfig.from_dict(dict(variant))
+            config.modules_to_not_convert = self.modules_to_not_convert
+            self.variants.append(config)
+        self.variant_layers: List[List[torch.nn.Module]] = [[] for _ in self.variants]
+
+    def _use_variant(self, variant: AwqConfig) -> None:
+        self.w_bit = variant.w_bit
+        self.group_size = variant.q_group_size
+        self.zero_point = variant.zero_point
+        self.version = variant.version
+
+    def _search_groups(self) -> Dict[tuple, List[int]]:
+        groups: Dict[tuple, List[int]] = {}
+        for index, variant in enumerate(self.variants):
+            groups.setdefault((variant.w_bit, variant.q_group_size, variant.zero_point), []).append(index)
+        return groups
+
+    @torch.no_grad()
+    def quantize(self):
+        logger.info(f"Quantizing {len(self.variants)} variants with {len(self._search_groups())} scale searches per layer")
+        super().quantize()
+
+    def _quantize_layer(self, i: int) -> None:
+        """
+        Capture the inputs of layer i once, then search and pack every variant of it.
+        """
+        self._prepare_layer(i)
+        # Captured once: also moves self.inps on to the outputs of the unquantized layer
+        input_feat = self._capture_input_feat(i)
+
+        for indexes in self._search_groups().values():
+            self._use_variant(self.variants[indexes[0]])
+            scaled = copy.deepcopy(self.modules[i])
+            # apply_scale divides the cached inputs in place, so each search gets its own copy
+            self._search_and_scale(scaled, {name: feat.clone() for name, feat in input_feat.items()},
+                                   layer=i, variants=indexes)
+            for position, index in enumerate(indexes):
+                self._use_variant(self.variants[index])
+                layer = scaled if position == len(indexes) - 1 else copy.deepcopy(scaled)
+                self._pack(layer, layer=i, variant=index)
+                self.variant_layers[index].append(layer.cpu())
+            del scaled
+            clear_memory()
+
+        # The unquantized layer is no longer needed
+        self.modules[i] = self.variant_layers[0][i]
+        del input_feat
+        clear_memory()
+
+    def _save_layer(self, i: int) -> None:
+        if self.checkpoint is not None:
+            self.checkpoint.save(i, self.inps, {f"{index}.{name}": tensor
+                                                for index, layers in enumerate(self.variant_layers)
+                                                for name, tensor in layers[i].state_dict().items()})
+
+    def _restore_layer(self, i: int, tensors: Optional[Dict[str, torch.Tensor]]) -> None:
+        for index, variant in enumerate(self.variants):
+            self._use_variant(variant)
+            prefix = f"{index}."
+            layer = self._restore_module(copy.deepcopy(self.modules[i]), {
+                name[len(prefix):]: tensor for name, tensor in tensors.items() if name.startswith(prefix)})
+            self.variant_layers[index].append(layer.cpu())
+        self.modules[i] = self.variant_layers[0][i]
+
+    def save_variant(self, index: int, output_dir: str) -> None:
+        """
+        Install the layers of one variant in the model and save it with its own quantization config.
+        """
+        for i, layer in enumerate(self.variant_layers[index]):
+            self.modules[i] = layer
+        self.awq_model.quant_config = self.variants[index]
+        logger.info(f"Saving variant {self.variants[index].to_dict()} to {output_dir}")
+        self.awq_model.save_quantized(output_dir)
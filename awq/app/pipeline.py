@@ -0,0 +1,100 @@
+# app/pipeline.py
+
+import os
+import queue
+import threading
+from typing import Any, Callable, Iterable
+
+# Items allowed in flight between two stages. The stages only overlap with a spare core,
+# so on a single core the pipeline is off by default
+PIPELINE_DEPTH = 4 if (os.cpu_count() or 1) > 1 else 0
+
+# How often a blocked stage checks whether the pipeline was stopped
+POLL_SECONDS = 0.1
+
+_DONE = object()
+_STOPPED = object()
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+def _put(q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(q: queue.Queue, stop: threading.Event) -> Any:
+    while not stop.is_set():
+        try:
+            return q.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            continue
+    return _STOPPED
+
+def run_pipeline(produce: Iterable, transform: Callable[[Any], Any], consume: Callable[[Any], None],
+                 depth: int = PIPELINE_DEPTH) -> None:
+    """
+    Run produce -> transform -> consume as three overlapping stages.
+
+    produce is iterated on a reader thread and transform runs on a second thread,
+    joined to each other and to consume by queues of at most depth items. consume
+    runs on the calling thread and sees items in order. Tensor copies, casts, file
+    writes and hashing release the GIL, so reading item N+1 overlaps casting item N
+    and writing item N-1. An exception in any stage stops the others and is
+    re-raised here. A depth of 0 runs the stages one after the other.
+    """
+    if depth <= 0:
+        for item in produce:
+            consume(transform(item))
+        return
+
+    stop = threading.Event()
+    read_queue = queue.Queue(depth)
+    cast_queue = queue.Queue(depth)
+
+    def reader():
+        try:
+            for item in produce:
+                if not _put(read_queue, item, stop):
+                    return
+            _put(read_queue, _DONE, stop)
+        except BaseException as e:
+            _put(read_queue, _Failure(e), stop)
+
+    def caster():
+        try:
+            while True:
+                item = _get(read_queue, stop)
+                if item is _STOPPED:
+                    return
+                if item is _DONE or isinstance(item, _Failure):
+                    _put(cast_queue, item, stop)
+                    return
+                if not _put(cast_queue, transform(item), stop):
+                    return
+        except BaseException as e:
+            _put(cast_queue, _Failure(e), stop)
+
+    threads = [
+        threading.Thread(target=reader, name='pipeline-reader', daemon=True),
+        threading.Thread(target=caster, name='pipeline-cast', daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = cast_queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            consume(item)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,165 @@
+# app/quant_trace.py
+
+import os
+import json
+import time
+import resource
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+def read_rss() -> Tuple[int, int]:
+    """
+    Current and peak resident set size of this process in bytes, from
+    /proc/self/status, or the peak from getrusage where that is not readable.
+    """
+    rss = peak = 0
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return rss, max(peak, rss)
+
+def reset_rss_peak() -> bool:
+    """
+    Reset the peak RSS of this process to its current RSS (Linux 4.0+). Returns False where unsupported.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class QuantTrace:
+    """
+    Spans around quantization phases and decoder layers, with their wall time,
+    CPU time, RSS and device memory high-water marks.
+
+    Every span is appended to a JSON-lines file as soon as it ends, so the trace
+    of a job that dies is kept up to its last span. close writes the same spans
+    as a Chrome trace-event file (chrome://tracing, Perfetto), with RSS and device
+    memory counters. Spans nest: peaks are reset when a span starts and folded
+    into the enclosing spans when it ends, so every span reports its own peak.
+    Where the peak RSS cannot be reset, rss_peak is the process peak so far.
+    """
+
+    def __init__(self, jsonl_path: str, chrome_path: Optional[str] = None, metadata: Optional[Dict[str, Any]] = None):
+        self.jsonl_path = jsonl_path
+        self.chrome_path = chrome_path
+        self.spans: List[Dict[str, Any]] = []
+        self._open: List[Dict[str, int]] = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._devices = list(range(torch.cuda.device_count())) if torch.cuda.is_available() else []
+        os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+        self._file = open(jsonl_path, 'w')
+        self._write({'type': 'meta', 'pid': os.getpid(), 'time': time.time(), 'devices': len(self._devices),
+                     **(metadata or {})})
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(record, default=str) + '\n')
+        self._file.flush()
+
+    def _device_peak(self) -> Optional[int]:
+        if not self._devices:
+            return None
+        return sum(torch.cuda.max_memory_allocated(device) for device in self._devices)
+
+    def _fold_peaks(self) -> None:
+        _, rss_peak = read_rss()
+        device_peak = self._device_peak() or 0
+        for span in self._open:
+            span['rss_peak'] = max(span['rss_peak'], rss_peak)
+            span['device_peak'] = max(span['device_peak'], device_peak)
+
+    def _reset_peaks(self) -> None:
+        reset_rss_peak()
+        for device in self._devices:
+            torch.cuda.reset_peak_memory_stats(device)
+
+    @contextmanager
+    def span(self, name: str, category: str = 'phase', **args: Any):
+        """
+        Trace the enclosed block as a span; args (e.g. layer=3) are recorded with it.
+        """
+        with self._lock:
+            self._fold_peaks()
+            peaks = {'rss_peak': 0, 'device_peak': 0}
+            self._open.append(peaks)
+            depth = len(self._open) - 1
+            self._reset_peaks()
+        rss_start, _ = read_rss()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+            with self._lock:
+                self._fold_peaks()
+                self._open = [span for span in self._open if span is not peaks]
+            record = {
+                'type': 'span', 'name': name, 'category': category, 'depth': depth,
+                'start_s': round(start_wall - self._start, 6), 'wall_s': round(wall, 6), 'cpu_s': round(cpu, 6),
+                'rss_start': rss_start, 'rss_end': read_rss()[0], 'rss_peak': peaks['rss_peak'],
+                'device_peak': peaks['device_peak'] if self._devices else None, 'args': args,
+            }
+            if error:
+                record['error'] = error
+            self.spans.append(record)
+            self._write(record)
+
+    def chrome_events(self) -> List[Dict[str, Any]]:
+        """
+        The spans as Chrome trace events: one complete event per span and memory counters at each span end.
+        """
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            start_us = int(span['start_s'] * 1e6)
+            end_us = start_us + int(span['wall_s'] * 1e6)
+            args = {key: span[key] for key in ('cpu_s', 'rss_start', 'rss_end', 'rss_peak', 'device_peak')}
+            args.update(span['args'])
+            if 'error' in span:
+                args['error'] = span['error']
+            events.append({'name': span['name'], 'cat': span['category'], 'ph': 'X', 'ts': start_us,
+                           'dur': end_us - start_us, 'pid': pid, 'tid': 0, 'args': args})
+            counters = {'rss_peak_mb': span['rss_peak'] / (1024 * 1024)}
+            if span['device_peak'] is not None:
+                counters['device_peak_mb'] = span['device_peak'] / (1024 * 1024)
+            events.append({'name': 'memory', 'ph': 'C', 'ts': end_us, 'pid': pid, 'args': counters})
+        # Enclosing spans before the spans they contain
+        return sorted(events, key=lambda event: (event['ts'], -event.get('dur', 0)))
+
+    def close(self) -> None:
+        """
+        Close the JSON-lines trace and write the Chrome trace-event file.
+        """
+        if self._file.closed:
+            return
+        self._file.close()
+        if self.chrome_path:
+            with open(self.chrome_path, 'w') as f:
+                json.dump({'traceEvents': self.chrome_events(), 'displayTimeUnit': 'ms'}, f)
+        logger.info(f"Quantization trace written to {self.jsonl_path}"
+                    + (f" and {self.chrome_path}" if self.chrome_path else ""))
+
+def trace_span(trace: Optional[QuantTrace], name: str, category: str = 'phase', **args: Any):
+    """
+    trace.span(name, ...) when tracing, a no-op context otherwise.
+    """
+    return trace.span(name, category, **args) if trace is not None else nullcontext()
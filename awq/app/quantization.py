@@ -1,26 +1,52 @@
 # app/quantization.py
 
 import os
+import time
+import hashlib
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Union
 from awq import AutoAWQForCausalLM, __version__ as awq_version
 from transformers import AutoTokenizer
 import torch
+from app.config import Config
+from app.calibration_cache import CalibrationCache
+from app.checkpointed_quantizer import CheckpointedAwqQuantizer
+from app.layer_checkpoint import LayerCheckpoint, checkpoint_fingerprint
+from app.memory_planner import available_host_memory, plan_quantization
+from app.multi_variant import MultiVariantQuantizer
+from app.quant_trace import QuantTrace, trace_span
+from app.streaming_quantizer import run_streaming_quantization
 
 logger = logging.getLogger(__name__)
 
 logger.info(f"AutoAWQ version: {awq_version}")
 print(f"AutoAWQ version: {awq_version}")
 
-def run_quantization(model_path: str, quant_config: Dict[str, Any], output_dir: str) -> None:
+def run_quantization(model_path: str, quant_config: Union[Dict[str, Any], List[Dict[str, Any]]],
+                     output_dir: Union[str, List[str]]) -> None:
     """
     Run the quantization process on the given model using AutoAWQ.
 
+    Several variants (e.g. group sizes 128, 64 and 32, or GEMM and GEMV) can be
+    produced from one load: pass a list of configs and a list of output
+    directories of the same length. The model is loaded and calibrated once and
+    each variant gets its own scale search and output directory.
+
+    With Config.QUANT_TRACE_DIR set, the wall time, CPU time and memory high-water
+    marks of every phase and decoder layer are traced to that directory.
+
     Args:
         model_path (str): Path to the model directory.
-        quant_config (Dict[str, Any]): Configuration for quantization.
-        output_dir (str): Directory to save the quantized model.
+        quant_config (Dict[str, Any] or list): Configuration for quantization, or one per variant.
+        output_dir (str or list): Directory to save the quantized model, or one per variant.
     """
+    variants = quant_config if isinstance(quant_config, list) else [quant_config]
+    output_dirs = output_dir if isinstance(output_dir, list) else [output_dir]
+    if not variants or len(variants) != len(output_dirs):
+        raise ValueError(f"Expected one output directory per quantization config, got {len(variants)} configs "
+                         f"and {len(output_dirs)} directories")
+
+    trace = open_trace(model_path, variants, output_dirs)
     try:
         logger.info(f"Starting quantization for model at {model_path}")
         print(f"Starting quantization for model at {model_path}")
@@ -45,14 +71,53 @@ def run_quantization(model_path: str, quant_config: Dict[str, Any], output_dir:
             logger.warning("CUDA is not available. Using CPU for quantization. This will be significantly slower.")
             print("WARNING: CUDA is not available. Using CPU for quantization. This will be significantly slower.")
 
+        # Plan the load from config.json and the shard headers before touching the weights
+        load_kwargs = {}
+        try:
+            with trace_span(trace, 'plan'):
+                plan = plan_quantization(model_path, available_host_memory(), available_memory if cuda_available else 0,
+                                         headroom=int(Config.QUANT_MEMORY_HEADROOM_GB * 1024 ** 3),
+                                         n_samples=Config.CALIBRATION_SAMPLES, seqlen=Config.CALIBRATION_SEQLEN)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not plan memory use, loading with defaults: {str(e)}")
+            plan = None
+        if plan:
+            print(f"Memory plan: {plan.summary()}")
+            if plan.mode == 'stream' and not plan.fits:
+                raise RuntimeError(f"Not enough memory to quantize the model, even one layer at a time: {plan.summary()}")
+            if plan.max_memory:
+                load_kwargs['max_memory'] = plan.max_memory
+
+        # Too large to load whole: quantize one decoder layer at a time from the memory-mapped shards
+        if plan and plan.mode == 'stream':
+            with trace_span(trace, 'calibration_data'):
+                tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+                calib_kwargs = load_calibration_kwargs(tokenizer)
+            for variant, variant_dir in zip(variants, output_dirs):
+                logger.info(f"Quantizing layer by layer into {variant_dir}")
+                print(f"Quantizing layer by layer into {variant_dir}")
+                dtype = torch.float16 if cuda_available else torch.float32
+                checkpoint = open_checkpoint(model_path, variant, variant_dir, calib_kwargs, mode='stream', dtype=dtype)
+                with trace_span(trace, 'quantize', output_dir=variant_dir):
+                    run_streaming_quantization(model_path, variant, variant_dir, tokenizer, calib_kwargs,
+                                               dtype=dtype, checkpoint=checkpoint, trace=trace)
+                    tokenizer.save_pretrained(variant_dir)
+                if checkpoint:
+                    checkpoint.clear()
+            logger.info(f"Quantization completed successfully. Quantized model saved to {', '.join(output_dirs)}")
+            print(f"Quantization completed successfully. Quantized model saved to {', '.join(output_dirs)}")
+            return
+
         # Load model and tokenizer
         try:
-            model = AutoAWQForCausalLM.from_pretrained(
-                model_path,
-                low_cpu_mem_usage=True,
-                torch_dtype=torch.float16 if cuda_available else torch.float32,
-                device_map="auto" if cuda_available else None
-            )
+            with trace_span(trace, 'load_model'):
+                model = AutoAWQForCausalLM.from_pretrained(
+                    model_path,
+                    low_cpu_mem_usage=True,
+                    torch_dtype=torch.float16 if cuda_available else torch.float32,
+                    device_map="auto" if cuda_available else None,
+                    **load_kwargs
+                )
         except RuntimeError as e:
             if "CUDA out of memory" in str(e):
                 logger.error("CUDA out of memory error. The model is too large for your GPU.")
@@ -61,7 +126,9 @@ def run_quantization(model_path: str, quant_config: Dict[str, Any], output_dir:
             else:
                 raise
 
-        tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        with trace_span(trace, 'calibration_data'):
+            tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+            calib_kwargs = load_calibration_kwargs(tokenizer)
 
         # Quantize
         logger.info("Performing AWQ quantization")
@@ -69,20 +136,44 @@ def run_quantization(model_path: str, quant_config: Dict[str, Any], output_dir:
         
         # Check if the model has the quantize method
         if hasattr(model, 'quantize'):
-            model.quantize(tokenizer, quant_config=quant_config)
+            if len(variants) == 1:
+                checkpoint = open_checkpoint(model_path, variants[0], output_dirs[0], calib_kwargs, mode='full',
+                                             dtype=torch.float16 if cuda_available else torch.float32)
+                with trace_span(trace, 'quantize'):
+                    # The checkpointed quantizer also carries the per-layer trace
+                    if checkpoint or trace:
+                        model.quantize(tokenizer, quant_config=variants[0], quantizer_cls=CheckpointedAwqQuantizer,
+                                       checkpoint=checkpoint, trace=trace, **calib_kwargs)
+                    else:
+                        model.quantize(tokenizer, quant_config=variants[0], **calib_kwargs)
+            else:
+                logger.info(f"Quantizing {len(variants)} variants from one calibration pass")
+                print(f"Quantizing {len(variants)} variants from one calibration pass")
+                checkpoint = open_checkpoint(model_path, variants, output_dirs, calib_kwargs, mode='full',
+                                             dtype=torch.float16 if cuda_available else torch.float32)
+                with trace_span(trace, 'quantize'):
+                    model.quantize(tokenizer, quant_config=variants[0], quantizer_cls=MultiVariantQuantizer,
+                                   variants=variants, checkpoint=checkpoint, trace=trace, **calib_kwargs)
         else:
             logger.error("The loaded model does not support the 'quantize' method. It may not be compatible with AWQ quantization.")
             print("The loaded model does not support the 'quantize' method. It may not be compatible with AWQ quantization.")
             raise AttributeError("Model does not support 'quantize' method")
 
         # Save quantized model
-        logger.info(f"Saving quantized model to {output_dir}")
-        print(f"Saving quantized model to {output_dir}")
-        model.save_quantized(output_dir)
-        tokenizer.save_pretrained(output_dir)
+        for index, variant_dir in enumerate(output_dirs):
+            logger.info(f"Saving quantized model to {variant_dir}")
+            print(f"Saving quantized model to {variant_dir}")
+            with trace_span(trace, 'save', output_dir=variant_dir):
+                if len(variants) == 1:
+                    model.save_quantized(variant_dir)
+                else:
+                    model.quantizer.save_variant(index, variant_dir)
+                tokenizer.save_pretrained(variant_dir)
+        if checkpoint:
+            checkpoint.clear()
 
-        logger.info(f"Quantization completed successfully. Quantized model saved to {output_dir}")
-        print(f"Quantization completed successfully. Quantized model saved to {output_dir}")
+        logger.info(f"Quantization completed successfully. Quantized model saved to {', '.join(output_dirs)}")
+        print(f"Quantization completed successfully. Quantized model saved to {', '.join(output_dirs)}")
     except RuntimeError as e:
         if "CUDA out of memory" in str(e):
             error_msg = (
@@ -127,6 +218,84 @@ def run_quantization(model_path: str, quant_config: Dict[str, Any], output_dir:
         print(f"Quantization failed: {str(e)}")
         logger.exception("Detailed traceback for quantization:")
         raise
+    finally:
+        if trace:
+            trace.close()
+
+def load_calibration_kwargs(tokenizer) -> Dict[str, Any]:
+    """
+    Calibration arguments for model.quantize from the pre-tokenized calibration cache.
+
+    The cached blocks are passed as token lists, which AutoAWQ concatenates and
+    splits back into the same blocks, so calibration needs no network access or
+    tokenization. Returns no arguments, leaving AutoAWQ to fetch and tokenize its
+    default corpus, when the cache is disabled or the set cannot be built.
+    """
+    if not Config.CALIBRATION_CACHE_DIR:
+        return {}
+    try:
+        samples = CalibrationCache(Config.CALIBRATION_CACHE_DIR).get_or_build(
+            tokenizer, Config.CALIBRATION_DATA, Config.CALIBRATION_SAMPLES, Config.CALIBRATION_SEQLEN)
+    except Exception as e:
+        logger.warning(f"Calibration cache unavailable, AutoAWQ will load {Config.CALIBRATION_DATA} itself: {str(e)}")
+        return {}
+    return {
+        'calib_data': samples.tolist(),
+        'max_calib_samples': samples.shape[0],
+        'max_calib_seq_len': samples.shape[1],
+    }
+
+def open_checkpoint(model_path: str, quant_config: Union[Dict[str, Any], List[Dict[str, Any]]],
+                    output_dir: Union[str, List[str]], calib_kwargs: Dict[str, Any],
+                    **job: Any) -> Optional[LayerCheckpoint]:
+    """
+    The per-layer checkpoint of the job writing output_dir, in a work directory under Config.QUANT_CHECKPOINT_DIR.
+    A job quantizing several variants passes the list of their configs and output directories.
+
+    The checkpoint is resumed only if it was written for the same model files,
+    quant config, calibration set, AutoAWQ version and job settings (e.g. the
+    execution mode and dtype); otherwise it starts over. Returns None when
+    checkpointing is disabled or the model files cannot be read.
+    """
+    if not Config.QUANT_CHECKPOINT_DIR:
+        return None
+    try:
+        fingerprint = checkpoint_fingerprint(model_path, quant_config=quant_config, calibration=calib_kwargs,
+                                             awq_version=awq_version, **job)
+    except OSError as e:
+        logger.warning(f"Quantizing without checkpoints: {str(e)}")
+        return None
+    output_dirs = [os.path.abspath(path) for path in (output_dir if isinstance(output_dir, list) else [output_dir])]
+    key = '\n'.join(output_dirs)
+    name = f"{os.path.basename(output_dirs[0])}-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:8]}"
+    checkpoint = LayerCheckpoint(os.path.join(Config.QUANT_CHECKPOINT_DIR, name), fingerprint)
+    if checkpoint.completed:
+        logger.info(f"Found checkpoint of {checkpoint.completed} quantized layers in {checkpoint.work_dir}")
+        print(f"Resuming from checkpoint of {checkpoint.completed} quantized layers in {checkpoint.work_dir}")
+    return checkpoint
+
+def open_trace(model_path: str, variants: List[Dict[str, Any]], output_dirs: List[str]) -> Optional[QuantTrace]:
+    """
+    A trace of the job in Config.QUANT_TRACE_DIR, named after the model and the start time.
+
+    Writes <model>-<time>.jsonl as the job runs and <model>-<time>.trace.json
+    (chrome://tracing, Perfetto) when it ends. Returns None when tracing is
+    disabled or the trace directory cannot be written.
+    """
+    if not Config.QUANT_TRACE_DIR:
+        return None
+    name = f"{os.path.basename(os.path.normpath(model_path))}-{time.strftime('%Y%m%d-%H%M%S')}"
+    try:
+        trace = QuantTrace(os.path.join(Config.QUANT_TRACE_DIR, f"{name}.jsonl"),
+                           chrome_path=os.path.join(Config.QUANT_TRACE_DIR, f"{name}.trace.json"),
+                           metadata={'model_path': model_path, 'quant_configs': variants, 'output_dirs': output_dirs,
+                                     'awq_version': awq_version, 'torch_version': torch.__version__})
+    except OSError as e:
+        logger.warning(f"Quantizing without a trace: {str(e)}")
+        return None
+    logger.info(f"Tracing quantization to {trace.jsonl_path}")
+    print(f"Tracing quantization to {trace.jsonl_path}")
+    return trace
 
 def validate_quant_config(quant_config: dict) -> None:
     """
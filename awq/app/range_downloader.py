@@ -0,0 +1,255 @@
+# app/range_downloader.py
+
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import requests
+
+logger = logging.getLogger(__name__)
+
+PART_SUFFIX = '.part'
+RESUME_SUFFIX = '.resume.json'
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+STREAM_BLOCK_SIZE = 1024 * 1024
+# Seconds between resume map writes while chunks are in flight
+SAVE_INTERVAL = 1.0
+
+class DownloadInterrupted(Exception):
+    """
+    A range response ended before all of its bytes arrived.
+    """
+
+class ResumeMap:
+    """
+    Progress of a ranged download, stored next to the partial file.
+
+    The file is split into fixed-size chunks, and the map records how many
+    leading bytes of each chunk are on disk. It is only saved after the partial
+    file has been fsynced, so it never vouches for bytes that a crash could lose.
+    A rerun with the same size, chunk size and validator (ETag) continues every
+    chunk where it stopped; anything else starts over.
+    """
+
+    def __init__(self, path: str, size: int, chunk_size: int, validator: Optional[str] = None):
+        self.path = path
+        self.size = size
+        self.chunk_size = chunk_size
+        self.validator = validator
+        self.progress: List[int] = [0] * max(1, -(-size // chunk_size))
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+
+    @classmethod
+    def load(cls, path: str, size: int, chunk_size: int, validator: Optional[str] = None) -> Optional['ResumeMap']:
+        """
+        Load the map at path if it describes the same download, else return None.
+        """
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        resume = cls(path, size, chunk_size, validator)
+        if (data.get('size') != size or data.get('chunk_size') != chunk_size or data.get('validator') != validator
+                or len(data.get('progress', [])) != len(resume.progress)):
+            logger.info(f"Ignoring stale resume map {path}")
+            return None
+        resume.progress = [min(int(done), resume.chunk_length(index)) for index, done in enumerate(data['progress'])]
+        return resume
+
+    def chunk_length(self, index: int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    @property
+    def done_bytes(self) -> int:
+        return sum(self.progress)
+
+    def pending(self) -> List[int]:
+        """
+        Indexes of the chunks that are not complete.
+        """
+        return [index for index, done in enumerate(self.progress) if done < self.chunk_length(index)]
+
+    def advance(self, index: int, length: int) -> None:
+        with self._lock:
+            self.progress[index] += length
+
+    def save(self, fd: int, force: bool = False) -> None:
+        """
+        Fsync the partial file behind fd, then atomically write the map.
+        Without force, writes closer together than SAVE_INTERVAL are skipped.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._saved_at < SAVE_INTERVAL:
+                return
+            self._saved_at = now
+            data = {'size': self.size, 'chunk_size': self.chunk_size, 'validator': self.validator,
+                    'progress': list(self.progress)}
+            os.fsync(fd)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def _preallocate(fd: int, size: int) -> None:
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not every file system supports fallocate; a sparse file still takes positioned writes
+        os.ftruncate(fd, size)
+
+def _probe(session: requests.Session, url: str, headers: Dict[str, str], timeout: float):
+    """
+    Ask for the first byte to learn the size, the validator and whether ranges are served.
+
+    Returns (size, validator, accepts_ranges); size is None when the server does not report it.
+    """
+    with session.get(url, headers={**headers, 'Range': 'bytes=0-0'}, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        validator = response.headers.get('ETag')
+        if response.status_code == 206:
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            return (int(total) if total.isdigit() else None), validator, True
+        length = response.headers.get('Content-Length')
+        return (int(length) if length and length.isdigit() else None), validator, False
+
+def _fetch_chunk(session: requests.Session, url: str, headers: Dict[str, str], fd: int, resume: ResumeMap,
+                 index: int, retries: int, timeout: float, backoff: float) -> None:
+    """
+    Download one chunk with range requests, retrying from the last byte written.
+    Failures only count against retries while no new bytes arrive.
+    """
+    chunk_start = index * resume.chunk_size
+    chunk_end = chunk_start + resume.chunk_length(index)
+    failures = 0
+    while resume.progress[index] < resume.chunk_length(index):
+        offset = chunk_start + resume.progress[index]
+        received = 0
+        try:
+            range_header = f"bytes={offset}-{chunk_end - 1}"
+            with session.get(url, headers={**headers, 'Range': range_header}, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                if response.status_code != 206 or not response.headers.get('Content-Range', '').startswith(f"bytes {offset}-"):
+                    raise requests.HTTPError(f"Server ignored range {range_header} (status {response.status_code})")
+                for block in response.iter_content(STREAM_BLOCK_SIZE):
+                    block = block[:chunk_end - offset]
+                    os.pwrite(fd, block, offset)
+                    offset += len(block)
+                    received += len(block)
+                    resume.advance(index, len(block))
+                    resume.save(fd)
+            if offset < chunk_end:
+                raise DownloadInterrupted(f"Connection closed at byte {offset} of range {range_header}")
+        except (requests.RequestException, DownloadInterrupted) as e:
+            failures = 0 if received else failures + 1
+            if failures > retries:
+                raise
+            delay = backoff * 2 ** max(0, failures - 1)
+            logger.warning(f"Chunk {index} failed at byte {offset} ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def _download_whole(session: requests.Session, url: str, headers: Dict[str, str], part_path: str, timeout: float) -> int:
+    """
+    Single-stream download for servers that do not serve ranges. Nothing can be resumed.
+    """
+    written = 0
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        with open(part_path, 'wb') as f:
+            for block in response.iter_content(STREAM_BLOCK_SIZE):
+                f.write(block)
+                written += len(block)
+    return written
+
+def download_file(url: str, dest: str, size: Optional[int] = None, headers: Optional[Dict[str, str]] = None,
+                  connections: int = 4, chunk_size: int = DEFAULT_CHUNK_SIZE, retries: int = 5,
+                  timeout: float = 60, backoff: float = 1.0, session: Optional[requests.Session] = None) -> str:
+    """
+    Download url to dest with parallel HTTP range requests.
+
+    The file is preallocated as dest.part and split into chunk_size chunks, which
+    up to connections threads fetch and write in place with pwrite. Progress is
+    kept in dest.resume.json (see ResumeMap), so after a dropped connection a
+    chunk is requested again from its last written byte, and after a crash or a
+    failed run the next call continues every chunk where it stopped. dest only
+    appears, by rename, once every byte is on disk. Servers that do not serve
+    ranges get a single plain download.
+
+    Args:
+        url: File URL; redirects are followed.
+        dest: Path of the downloaded file.
+        size: Expected size in bytes, when known from a listing. A complete dest of
+            this size with no resume map is left alone.
+        headers: Extra request headers, e.g. authorization.
+        connections: Chunks downloaded at the same time.
+        chunk_size: Bytes per range request.
+        retries: Failed attempts allowed per chunk without progress.
+        timeout: Seconds to wait for a connection or for data.
+        backoff: Seconds before the first retry, doubling on each further failure.
+        session: requests session to use, a new one by default.
+
+    Returns:
+        str: dest.
+    """
+    headers = dict(headers or {})
+    part_path = dest + PART_SUFFIX
+    resume_path = dest + RESUME_SUFFIX
+    if size is not None and os.path.isfile(dest) and os.path.getsize(dest) == size and not os.path.exists(resume_path):
+        logger.info(f"{dest} is already downloaded")
+        return dest
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+
+    session = session or requests.Session()
+    remote_size, validator, accepts_ranges = _probe(session, url, headers, timeout)
+    if size is not None and remote_size is not None and size != remote_size:
+        raise ValueError(f"{url} is {remote_size} bytes, expected {size}")
+    size = remote_size if remote_size is not None else size
+
+    if not accepts_ranges or not size:
+        logger.info(f"Ranges are not served for {url}, downloading it in one stream")
+        written = _download_whole(session, url, headers, part_path, timeout)
+        if size is not None and written != size:
+            raise DownloadInterrupted(f"Received {written} of {size} bytes of {url}")
+        os.replace(part_path, dest)
+        return dest
+
+    resume = ResumeMap.load(resume_path, size, chunk_size, validator) if os.path.exists(part_path) else None
+    if resume:
+        logger.info(f"Resuming {dest}: {resume.done_bytes / (1024 ** 2):.1f} of {size / (1024 ** 2):.1f} MB on disk")
+    else:
+        resume = ResumeMap(resume_path, size, chunk_size, validator)
+
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT)
+    try:
+        if os.fstat(fd).st_size != size:
+            _preallocate(fd, size)
+        resume.save(fd, force=True)
+        pending = resume.pending()
+        start = time.monotonic()
+        before = resume.done_bytes
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(connections, len(pending) or 1))) as executor:
+                futures = [executor.submit(_fetch_chunk, session, url, headers, fd, resume, index, retries, timeout, backoff)
+                           for index in pending]
+                for future in futures:
+                    future.result()
+        finally:
+            resume.save(fd, force=True)
+        elapsed = max(time.monotonic() - start, 1e-6)
+        logger.info(f"Downloaded {dest}: {(resume.done_bytes - before) / (1024 ** 2):.1f} MB in {elapsed:.1f}s "
+                    f"over {min(connections, len(pending))} connections")
+    finally:
+        os.close(fd)
+
+    os.replace(part_path, dest)
+    resume.remove()
+    return dest
@@ -0,0 +1,219 @@
+# app/resharder.py
+
+import os
+import re
+import json
+import shutil
+import logging
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+
+from app.converter import load_pytorch_shard, drop_tied_weights
+from app.dtype_policy import as_policy
+from app.tied_weights import find_tied_weights, ties_across_shards
+from app.safetensors_io import (
+    INDEX_FILE_NAME,
+    SAFETENSORS_TO_DTYPE,
+    TIED_WEIGHTS_METADATA_KEY,
+    read_header,
+    tensor_nbytes,
+    write_safetensors,
+    write_safetensors_index,
+)
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+def parse_size(size: str) -> int:
+    """
+    Parse a human readable size such as '5GB', '500MB' or '2147483648' into bytes.
+    """
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)(I?B)?\s*', str(size).upper())
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+    value, unit = float(match.group(1)), match.group(2)
+    return int(value * 1024 ** ' KMGT'.index(unit or ' '))
+
+def find_source_shards(model_path: str) -> List[str]:
+    """
+    List the weight shards of a model directory, preferring safetensors over bin files.
+    """
+    files = sorted(os.listdir(model_path))
+    safetensors_files = [f for f in files if f.startswith('model') and f.endswith('.safetensors')]
+    if safetensors_files:
+        return safetensors_files
+    bin_files = [f for f in files if f.startswith('pytorch_model') and f.endswith('.bin')]
+    if bin_files:
+        return bin_files
+    raise FileNotFoundError(f"No safetensors or bin shards found in {model_path}")
+
+def plan_shards(tensor_sizes: List[Tuple[str, int]], target_size: int) -> List[List[str]]:
+    """
+    Pack tensors into as few shards of at most target_size bytes as possible.
+
+    Uses first-fit decreasing. A tensor larger than the target gets a shard of its
+    own. Within a shard tensors keep their original order, and shards are ordered
+    by their first tensor so related weights stay close together.
+
+    Args:
+        tensor_sizes: (name, nbytes) pairs in checkpoint order.
+        target_size: Maximum shard size in bytes.
+
+    Returns:
+        List[List[str]]: Tensor names for each output shard.
+    """
+    order = {name: i for i, (name, _) in enumerate(tensor_sizes)}
+    bins = []  # [free bytes, names]
+    for name, nbytes in sorted(tensor_sizes, key=lambda item: (-item[1], order[item[0]])):
+        for shard in bins:
+            if nbytes <= shard[0]:
+                shard[0] -= nbytes
+                shard[1].append(name)
+                break
+        else:
+            bins.append([max(target_size - nbytes, 0), [name]])
+
+    shards = [sorted(names, key=order.__getitem__) for _, names in bins]
+    return sorted(shards, key=lambda names: order[names[0]])
+
+class ShardSource:
+    """
+    Lazy, memory-mapped access to the tensors of a set of safetensors or bin shards.
+
+    Tied aliases are not exposed as tensors; ties maps each of them to the tensor
+    it shares, whether read from safetensors metadata or found across bin shards.
+    """
+
+    def __init__(self, model_path: str, shard_files: List[str]):
+        self.handles = {}
+        self.ties: Dict[str, str] = {}
+        self.tensors: Dict[str, Tuple[str, torch.dtype, Tuple[int, ...]]] = {}
+
+        bin_files = [f for f in shard_files if not f.endswith('.safetensors')]
+        for shard_file in bin_files:
+            self.handles[shard_file] = load_pytorch_shard(os.path.join(model_path, shard_file), mmap=True)
+        if bin_files:
+            self.ties.update(find_tied_weights(bin_files, self.handles.__getitem__,
+                                               across_shards=ties_across_shards(model_path)))
+
+        for shard_file in shard_files:
+            path = os.path.join(model_path, shard_file)
+            if shard_file.endswith('.safetensors'):
+                header, _ = read_header(path)
+                metadata = header.pop('__metadata__', None) or {}
+                self.ties.update(json.loads(metadata.get(TIED_WEIGHTS_METADATA_KEY, '{}')))
+                self.handles[shard_file] = safe_open(path, framework='pt')
+                entries = [(name, SAFETENSORS_TO_DTYPE[info['dtype']], tuple(info['shape'])) for name, info in header.items()]
+            else:
+                state_dict = self.handles[shard_file]
+                drop_tied_weights(state_dict, self.ties)
+                entries = [(name, tensor.dtype, tuple(tensor.shape)) for name, tensor in state_dict.items()]
+
+            for name, dtype, shape in entries:
+                if name in self.tensors:
+                    raise ValueError(f"Tensor {name} found in both {self.tensors[name][0]} and {shard_file}")
+                self.tensors[name] = (shard_file, dtype, shape)
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        shard_file = self.tensors[name][0]
+        handle = self.handles[shard_file]
+        if isinstance(handle, dict):
+            return handle[name]
+        return handle.get_tensor(name)
+
+def reshard_model(model_path: str, output_path: Optional[str] = None, target_size: int = 5 * GB,
+                  dtype=None) -> List[str]:
+    """
+    Repack the weights of a model into evenly sized safetensors shards and regenerate the index.
+
+    Tensors are streamed one at a time from memory-mapped sources, so memory use is
+    bounded by the largest tensor. When resharding in place, the new shards are
+    written to a staging directory and moved into place once all of them are
+    complete; the old shards they do not replace are only removed after that.
+
+    Args:
+        model_path (str): Directory with safetensors or bin shards.
+        output_path (str): Destination directory. Defaults to model_path.
+        target_size (int): Maximum shard size in bytes.
+        dtype: Optional DtypePolicy, policy string or torch dtype for the output tensors.
+
+    Returns:
+        List[str]: File names of the new shards.
+    """
+    output_path = output_path or model_path
+    source_files = find_source_shards(model_path)
+    source = ShardSource(model_path, source_files)
+
+    policy = as_policy(dtype)
+    sizes = []
+    for name, (_, src_dtype, shape) in source.tensors.items():
+        out_dtype = policy.output_dtype(name, src_dtype) if policy else src_dtype
+        sizes.append((name, tensor_nbytes(shape, out_dtype)))
+
+    plan = plan_shards(sizes, target_size)
+    if len(plan) == 1:
+        shard_names = ['model.safetensors']
+    else:
+        shard_names = [f"model-{i:05d}-of-{len(plan):05d}.safetensors" for i in range(1, len(plan) + 1)]
+    logger.info(f"Resharding {len(source.tensors)} tensors from {len(source_files)} files into {len(plan)} shards "
+                f"of at most {target_size / GB:.2f} GB")
+
+    staging_path = os.path.join(output_path, '.reshard-tmp')
+    os.makedirs(staging_path, exist_ok=True)
+    try:
+        for shard_name, names in zip(shard_names, plan):
+            entries = []
+            for name in names:
+                _, src_dtype, shape = source.tensors[name]
+                if policy and policy.inspects(name, src_dtype):
+                    # Only fp16-checked reads the tensor to pick its dtype; it is read again when written
+                    out_dtype = policy.resolve(name, source.get_tensor(name))
+                else:
+                    out_dtype = policy.output_dtype(name, src_dtype) if policy else src_dtype
+                entries.append((name, out_dtype, shape))
+            metadata = {"format": "pt"}
+            # Ties are recorded next to the tensor they point at
+            tied = {alias: target for alias, target in source.ties.items() if target in names}
+            if tied:
+                metadata[TIED_WEIGHTS_METADATA_KEY] = json.dumps(tied, sort_keys=True)
+            size = write_safetensors(entries, source.get_tensor,
+                                     os.path.join(staging_path, shard_name), metadata=metadata)
+            logger.info(f"Wrote {shard_name} ({size / GB:.2f} GB, {len(names)} tensors)")
+    except Exception:
+        shutil.rmtree(staging_path, ignore_errors=True)
+        raise
+    del source
+
+    # The new shards replace old ones of the same name atomically, so the directory
+    # holds a complete set of weights at every step
+    for shard_name in shard_names:
+        os.replace(os.path.join(staging_path, shard_name), os.path.join(output_path, shard_name))
+    os.rmdir(staging_path)
+
+    if len(shard_names) > 1:
+        index_file = write_safetensors_index(output_path, shard_names)
+        logger.info(f"Wrote safetensors index file: {index_file}")
+
+    if os.path.abspath(output_path) == os.path.abspath(model_path):
+        stale_files = [f for f in source_files if f not in shard_names] + ['pytorch_model.bin.index.json']
+        if len(shard_names) == 1:
+            stale_files.append(INDEX_FILE_NAME)
+        for stale_file in stale_files:
+            if os.path.exists(os.path.join(model_path, stale_file)):
+                os.remove(os.path.join(model_path, stale_file))
+    return shard_names
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Repack model weights into evenly sized safetensors shards")
+    parser.add_argument("model_path", help="Directory containing safetensors or bin shards")
+    parser.add_argument("--output", help="Output directory (defaults to resharding in place)")
+    parser.add_argument("--target-size", default="5GB", help="Maximum shard size, e.g. 2GB or 5GB")
+    parser.add_argument("--dtype", help="Output dtype policy, e.g. bf16 or 'fp16-checked;*norm*=fp32' (defaults to stored dtypes)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    reshard_model(args.model_path, args.output, parse_size(args.target_size), dtype=args.dtype)
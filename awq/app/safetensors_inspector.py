@@ -0,0 +1,202 @@
+# app/safetensors_inspector.py
+
+import os
+import json
+import struct
+import logging
+import argparse
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from app.model_index import ModelDirIndex, SINGLE_SAFETENSORS_FILE, SAFETENSORS_INDEX_FILE
+
+logger = logging.getLogger(__name__)
+
+# Bytes per element of each safetensors dtype code. Kept free of torch so the
+# inspection runs before anything heavy is imported.
+DTYPE_SIZES = {
+    'BOOL': 1, 'U8': 1, 'I8': 1, 'F8_E4M3': 1, 'F8_E5M2': 1,
+    'I16': 2, 'U16': 2, 'F16': 2, 'BF16': 2,
+    'I32': 4, 'U32': 4, 'F32': 4,
+    'I64': 8, 'U64': 8, 'F64': 8,
+}
+
+# Headers larger than this are rejected, like the safetensors library does
+MAX_HEADER_SIZE = 100 * 1024 * 1024
+
+class TensorInfo(NamedTuple):
+    shard: str
+    dtype: str
+    shape: Tuple[int, ...]
+    nbytes: int
+
+    @property
+    def numel(self) -> int:
+        numel = 1
+        for dim in self.shape:
+            numel *= dim
+        return numel
+
+class SafetensorsReport(NamedTuple):
+    shards: List[str]
+    tensors: Dict[str, TensorInfo]
+    problems: List[str]
+
+    @property
+    def ok(self) -> bool:
+        return bool(self.shards) and not self.problems
+
+    @property
+    def total_params(self) -> int:
+        return sum(info.numel for info in self.tensors.values())
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(info.nbytes for info in self.tensors.values())
+
+    @property
+    def bytes_by_dtype(self) -> Dict[str, int]:
+        totals: Dict[str, int] = {}
+        for info in self.tensors.values():
+            totals[info.dtype] = totals.get(info.dtype, 0) + info.nbytes
+        return dict(sorted(totals.items()))
+
+    def summary(self) -> str:
+        dtypes = ', '.join(f"{dtype} {size / (1024 ** 3):.2f} GB" for dtype, size in self.bytes_by_dtype.items())
+        return (f"{len(self.tensors)} tensors in {len(self.shards)} shards, "
+                f"{self.total_params / 1e9:.2f}B params ({dtypes or 'no data'})")
+
+def inspect_shard(path: str, shard: Optional[str] = None) -> Tuple[Dict[str, TensorInfo], List[str]]:
+    """
+    Read the 8-byte length and the JSON header of a safetensors file and check
+    that every tensor's data lies within the file.
+
+    Only the header is read, whatever the size of the file.
+
+    Args:
+        path: Path of the safetensors file.
+        shard: Name reported for the file, its base name by default.
+
+    Returns:
+        Tuple[Dict[str, TensorInfo], List[str]]: The tensors of the file and the problems found.
+    """
+    shard = shard or os.path.basename(path)
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            prefix = f.read(8)
+            if len(prefix) < 8:
+                return {}, [f"{shard} is truncated: {file_size} bytes, too small for a safetensors header"]
+            (header_size,) = struct.unpack('<Q', prefix)
+            if header_size > MAX_HEADER_SIZE:
+                return {}, [f"{shard} is not a safetensors file: header length {header_size}"]
+            if 8 + header_size > file_size:
+                return {}, [f"{shard} is truncated: header needs {8 + header_size} bytes, file has {file_size}"]
+            header = json.loads(f.read(header_size))
+    except OSError as e:
+        return {}, [f"{shard} cannot be read: {str(e)}"]
+    except (ValueError, UnicodeDecodeError) as e:
+        return {}, [f"{shard} has a corrupt header: {str(e)}"]
+    if not isinstance(header, dict):
+        return {}, [f"{shard} has a corrupt header: not a JSON object"]
+
+    tensors = {}
+    problems = []
+    data_size = file_size - 8 - header_size
+    data_end = 0
+    for name, entry in header.items():
+        if name == '__metadata__':
+            continue
+        try:
+            dtype, shape = entry['dtype'], tuple(int(dim) for dim in entry['shape'])
+            begin, end = (int(offset) for offset in entry['data_offsets'])
+        except (KeyError, TypeError, ValueError):
+            problems.append(f"{shard}: {name} has a malformed header entry")
+            continue
+        if dtype not in DTYPE_SIZES:
+            problems.append(f"{shard}: {name} has unknown dtype {dtype}")
+            continue
+        info = TensorInfo(shard, dtype, shape, end - begin)
+        if end - begin != info.numel * DTYPE_SIZES[dtype]:
+            problems.append(f"{shard}: {name} spans {end - begin} bytes, its shape {list(shape)} and {dtype} need "
+                            f"{info.numel * DTYPE_SIZES[dtype]}")
+        tensors[name] = info
+        data_end = max(data_end, end)
+
+    if data_end > data_size:
+        problems.append(f"{shard} is truncated: tensor data ends at byte {8 + header_size + data_end}, "
+                        f"file has {file_size}")
+    elif data_end < data_size:
+        problems.append(f"{shard} has {data_size - data_end} bytes after its last tensor")
+    return tensors, problems
+
+def inspect_safetensors(model_path: str, index: ModelDirIndex = None) -> SafetensorsReport:
+    """
+    Inspect the safetensors weights of a model directory from their headers alone.
+
+    The weights are model.safetensors when present, like transformers loads them,
+    otherwise the shards named by model.safetensors.index.json. Besides each
+    shard's own checks (see inspect_shard), the index is checked against the
+    shard contents: shards it names that are missing, tensors it maps to a shard
+    that does not hold them, tensors the shards hold that it does not list, and
+    tensors found in more than one shard.
+
+    Args:
+        model_path: Model directory.
+        index: ModelDirIndex of the directory, scanned here unless passed in.
+
+    Returns:
+        SafetensorsReport: Shards, tensors and the problems found. A directory
+        without safetensors weights gives a report with no shards.
+    """
+    index = index or ModelDirIndex(model_path)
+    problems = []
+    weight_map = None
+    if index.has(SINGLE_SAFETENSORS_FILE):
+        shards = [SINGLE_SAFETENSORS_FILE]
+    elif index.has(SAFETENSORS_INDEX_FILE):
+        try:
+            with open(os.path.join(model_path, SAFETENSORS_INDEX_FILE), 'r') as f:
+                weight_map = json.load(f)['weight_map']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            return SafetensorsReport([], {}, [f"{SAFETENSORS_INDEX_FILE} cannot be read: {str(e)}"])
+        shards = sorted(set(weight_map.values()))
+    else:
+        return SafetensorsReport([], {}, [])
+
+    tensors: Dict[str, TensorInfo] = {}
+    holders: Dict[str, List[str]] = {}
+    for shard in shards:
+        if not index.has(shard):
+            problems.append(f"{shard} is missing")
+            continue
+        shard_tensors, shard_problems = inspect_shard(os.path.join(model_path, shard), shard)
+        problems.extend(shard_problems)
+        for name, info in shard_tensors.items():
+            holders.setdefault(name, []).append(shard)
+            if name in tensors:
+                problems.append(f"{name} is duplicated in {tensors[name].shard} and {shard}")
+                continue
+            tensors[name] = info
+
+    if weight_map is not None:
+        present = {shard for shard in shards if index.has(shard)}
+        for name, shard in sorted(weight_map.items()):
+            if shard in present and shard not in holders.get(name, []):
+                problems.append(f"{name} is mapped to {shard} by the index but is not in it")
+        for name in sorted(set(tensors) - set(weight_map)):
+            problems.append(f"{name} in {tensors[name].shard} is not listed in the index")
+    return SafetensorsReport(shards, tensors, problems)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check safetensors weights from their headers and summarize them")
+    parser.add_argument("model_path", help="Directory containing model.safetensors or a sharded safetensors model")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    report = inspect_safetensors(args.model_path)
+    print(report.summary())
+    for dtype, size in report.bytes_by_dtype.items():
+        print(f"  {dtype}: {size} bytes")
+    for problem in report.problems:
+        print(f"Problem: {problem}")
+    raise SystemExit(0 if report.ok else 1)
@@ -0,0 +1,304 @@
+# app/safetensors_io.py
+
+import ctypes
+import json
+import os
+import struct
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import torch
+
+from app.dtype_policy import as_policy, iter_chunks
+from app.pipeline import PIPELINE_DEPTH, run_pipeline
+
+logger = logging.getLogger(__name__)
+
+# Mapping between torch dtypes and the dtype codes used in safetensors headers
+DTYPE_TO_SAFETENSORS = {
+    torch.bool: "BOOL",
+    torch.uint8: "U8",
+    torch.int8: "I8",
+    torch.int16: "I16",
+    torch.int32: "I32",
+    torch.int64: "I64",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.float32: "F32",
+    torch.float64: "F64",
+}
+
+SAFETENSORS_TO_DTYPE = {code: dtype for dtype, code in DTYPE_TO_SAFETENSORS.items()}
+
+HEADER_ALIGNMENT = 8
+INDEX_FILE_NAME = 'model.safetensors.index.json'
+# Metadata key holding the JSON alias-to-target map of tied tensors left out of a file
+TIED_WEIGHTS_METADATA_KEY = 'tied_weights'
+
+
+def dtype_code(dtype: torch.dtype) -> str:
+    """
+    Return the safetensors dtype code for a torch dtype.
+    """
+    try:
+        return DTYPE_TO_SAFETENSORS[dtype]
+    except KeyError:
+        raise ValueError(f"Unsupported dtype for safetensors: {dtype}")
+
+
+def tensor_nbytes(shape, dtype: torch.dtype) -> int:
+    """
+    Number of bytes a contiguous tensor of the given shape and dtype occupies.
+    """
+    numel = 1
+    for dim in shape:
+        numel *= dim
+    return numel * torch.empty((), dtype=dtype).element_size()
+
+
+def build_header(entries: List[Tuple[str, torch.dtype, Tuple[int, ...]]], metadata: Optional[Dict[str, str]] = None) -> bytes:
+    """
+    Build a serialized safetensors header (length prefix included).
+
+    Args:
+        entries: (name, dtype, shape) tuples in the order the tensor data will be written.
+        metadata: Optional string-to-string metadata stored under "__metadata__".
+
+    Returns:
+        bytes: The 8-byte little-endian header length followed by the padded JSON header.
+    """
+    header = {}
+    if metadata:
+        header["__metadata__"] = {str(k): str(v) for k, v in metadata.items()}
+
+    offset = 0
+    for name, dtype, shape in entries:
+        nbytes = tensor_nbytes(shape, dtype)
+        header[name] = {
+            "dtype": dtype_code(dtype),
+            "shape": list(shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    padding = (HEADER_ALIGNMENT - len(header_bytes) % HEADER_ALIGNMENT) % HEADER_ALIGNMENT
+    header_bytes += b" " * padding
+    return struct.pack("<Q", len(header_bytes)) + header_bytes
+
+
+def tensor_buffer(tensor: torch.Tensor) -> memoryview:
+    """
+    Zero-copy view over the raw bytes of a contiguous CPU tensor.
+
+    The caller must keep the tensor alive while the view is in use.
+    """
+    nbytes = tensor.numel() * tensor.element_size()
+    if nbytes == 0:
+        return memoryview(b"")
+    return memoryview((ctypes.c_ubyte * nbytes).from_address(tensor.data_ptr())).cast("B")
+
+
+def write_tensor(f, tensor: torch.Tensor, hasher=None, dtype: Optional[torch.dtype] = None) -> int:
+    """
+    Write the raw bytes of a tensor to an open binary file.
+
+    When dtype differs from the tensor's dtype the tensor is cast chunk by chunk
+    as it is written, so no full-size cast copy is ever allocated.
+
+    Returns:
+        int: Number of bytes written.
+    """
+    tensor = tensor.detach().cpu()
+    if dtype is None or dtype == tensor.dtype:
+        chunks = [tensor.contiguous()]
+    else:
+        chunks = (chunk.to(dtype) for chunk in iter_chunks(tensor))
+
+    written = 0
+    for chunk in chunks:
+        buffer = tensor_buffer(chunk)
+        f.write(buffer)
+        if hasher is not None:
+            hasher.update(buffer)
+        written += len(buffer)
+        del buffer, chunk
+    return written
+
+
+def read_chunks(entries: List[Tuple[str, torch.dtype, Tuple[int, ...]]], get_tensor: Callable[[str], torch.Tensor]):
+    """
+    Yield (chunk, output dtype) pairs for every entry, reading each chunk into memory.
+
+    Copying pages a memory-mapped chunk in, so in a pipeline the reads of chunks
+    that keep their dtype happen on the reader thread rather than while the
+    writer waits. Chunks that are cast are read by the cast stage.
+    """
+    for name, out_dtype, shape in entries:
+        tensor = get_tensor(name)
+        if tuple(tensor.shape) != tuple(shape):
+            raise ValueError(f"Tensor {name} has shape {tuple(tensor.shape)}, expected {tuple(shape)}")
+        for chunk in iter_chunks(tensor.detach().cpu()):
+            # A cast reads the chunk anyway, so only chunks written as they are get copied
+            yield (chunk.clone() if chunk.dtype == out_dtype else chunk), out_dtype
+        del tensor
+
+def cast_chunk(item: Tuple[torch.Tensor, torch.dtype]) -> torch.Tensor:
+    chunk, out_dtype = item
+    return chunk if chunk.dtype == out_dtype else chunk.to(out_dtype)
+
+def write_entries(f, entries: List[Tuple[str, torch.dtype, Tuple[int, ...]]], get_tensor: Callable[[str], torch.Tensor],
+                  hasher=None, pipeline_depth: int = PIPELINE_DEPTH) -> None:
+    """
+    Write the data of entries back to back at the current position of an open binary file.
+
+    With a pipeline_depth above 0, reading, casting and writing overlap as in
+    write_safetensors; otherwise one tensor at a time is written on the calling thread.
+    """
+    if pipeline_depth > 0:
+        def write_chunk(chunk: torch.Tensor) -> None:
+            buffer = tensor_buffer(chunk)
+            f.write(buffer)
+            if hasher is not None:
+                hasher.update(buffer)
+            del buffer
+
+        run_pipeline(read_chunks(entries, get_tensor), cast_chunk, write_chunk, pipeline_depth)
+        return
+    for name, out_dtype, shape in entries:
+        tensor = get_tensor(name)
+        if tuple(tensor.shape) != tuple(shape):
+            raise ValueError(f"Tensor {name} has shape {tuple(tensor.shape)}, expected {tuple(shape)}")
+        write_tensor(f, tensor, hasher, out_dtype)
+        del tensor
+
+def write_safetensors(entries: List[Tuple[str, torch.dtype, Tuple[int, ...]]], get_tensor: Callable[[str], torch.Tensor],
+                      filename: str, metadata: Optional[Dict[str, str]] = None, hasher=None,
+                      pipeline_depth: int = PIPELINE_DEPTH) -> int:
+    """
+    Write a safetensors file from a plan of entries, fetching one tensor at a time.
+
+    Reading, casting and writing run as a three-stage pipeline over chunks of at
+    most CHUNK_ELEMENTS elements, so the disk keeps reading while earlier chunks
+    are cast and written.
+
+    Args:
+        entries: (name, output dtype, shape) tuples in write order.
+        get_tensor: Callable returning the (possibly memory-mapped) tensor for a name.
+        filename: Output path. Data goes to a temporary file that is renamed on success.
+        metadata: Optional metadata stored in the header.
+        hasher: Optional hashlib object updated with every byte written, giving the
+            file digest without reading the file back.
+        pipeline_depth: Chunks in flight between pipeline stages. 0 reads, casts and
+            writes one tensor at a time on the calling thread.
+
+    Returns:
+        int: Size of the written file in bytes.
+    """
+    header = build_header(entries, metadata)
+
+    tmp_filename = f"{filename}.tmp"
+    try:
+        with open(tmp_filename, "wb") as f:
+            f.write(header)
+            if hasher is not None:
+                hasher.update(header)
+            write_entries(f, entries, get_tensor, hasher, pipeline_depth)
+        os.replace(tmp_filename, filename)
+    except Exception:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+    size = os.path.getsize(filename)
+    logger.debug(f"Wrote {len(entries)} tensors ({size / (1024 * 1024):.2f} MB) to {filename}")
+    return size
+
+
+def save_file_streaming(tensors: Dict[str, torch.Tensor], filename: str, metadata: Optional[Dict[str, str]] = None,
+                        dtype=None, hasher=None, pipeline_depth: int = PIPELINE_DEPTH) -> int:
+    """
+    Write tensors to a safetensors file one tensor at a time.
+
+    The header is computed from shapes and dtypes alone, so the tensors can be
+    memory-mapped: each one is cast chunk by chunk as it is written, keeping
+    memory flat regardless of tensor or shard size.
+
+    Args:
+        tensors: Mapping of tensor names to (possibly memory-mapped) tensors.
+        filename: Output safetensors path. Data goes to a temporary file that is renamed on success.
+        metadata: Optional metadata stored in the header.
+        dtype: Optional DtypePolicy, policy string or torch dtype deciding the output
+            dtype of each floating point tensor. None keeps stored dtypes.
+        hasher: Optional hashlib object updated with the bytes of the file.
+        pipeline_depth: Chunks in flight between the read, cast and write stages.
+
+    Returns:
+        int: Size of the written file in bytes.
+    """
+    policy = as_policy(dtype)
+    entries = [
+        (name, policy.resolve(name, tensor) if policy else tensor.dtype, tuple(tensor.shape))
+        for name, tensor in tensors.items()
+    ]
+    return write_safetensors(entries, tensors.__getitem__, filename, metadata, hasher, pipeline_depth)
+
+
+def read_header(filename: str) -> Tuple[Dict[str, Any], int]:
+    """
+    Read the JSON header of a safetensors file without touching the tensor data.
+
+    Returns:
+        Tuple[Dict[str, Any], int]: The header and the file offset where tensor data starts.
+    """
+    with open(filename, "rb") as f:
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            raise ValueError(f"{filename} is too small to be a safetensors file")
+        (header_size,) = struct.unpack("<Q", prefix)
+        header_bytes = f.read(header_size)
+        if len(header_bytes) < header_size:
+            raise ValueError(f"{filename} has a truncated header")
+    return json.loads(header_bytes), 8 + header_size
+
+
+def write_safetensors_index(model_path: str, shard_files: Iterable[str], metadata: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Write model.safetensors.index.json by reading the headers of the given shards.
+
+    Tie maps recorded in the shard metadata are merged into the index metadata.
+
+    Args:
+        model_path: Directory containing the shards.
+        shard_files: Shard file names relative to model_path.
+        metadata: Optional index metadata. total_size is always recomputed.
+
+    Returns:
+        str: Path of the written index file.
+    """
+    weight_map = {}
+    tied_weights = {}
+    total_size = 0
+    for shard_file in sorted(shard_files):
+        header, _ = read_header(os.path.join(model_path, shard_file))
+        shard_metadata = header.pop("__metadata__", None) or {}
+        tied_weights.update(json.loads(shard_metadata.get(TIED_WEIGHTS_METADATA_KEY, "{}")))
+        for name, info in header.items():
+            begin, end = info["data_offsets"]
+            total_size += end - begin
+            weight_map[name] = shard_file
+
+    metadata = {**(metadata or {}), 'total_size': total_size}
+    if tied_weights:
+        metadata[TIED_WEIGHTS_METADATA_KEY] = dict(sorted(tied_weights.items()))
+    index_data = {
+        'metadata': metadata,
+        'weight_map': dict(sorted(weight_map.items()))
+    }
+    index_file = os.path.join(model_path, INDEX_FILE_NAME)
+    # A new file, not a rewrite: the old index may be a link to a blob of the model store
+    tmp_path = f"{index_file}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index_data, f, indent=2)
+    os.replace(tmp_path, index_file)
+    return index_file
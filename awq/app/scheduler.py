@@ -0,0 +1,102 @@
+# app/scheduler.py
+
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+def select_admissible(pending: List[Dict[str, Any]], in_flight_cost: int, memory_budget: int, free_slots: int) -> List[int]:
+    """
+    Pick the pending jobs that can start now without exceeding the memory budget.
+
+    Jobs are considered in order and admitted first-fit. A job larger than the
+    whole budget is only admitted when nothing else is running, so it still runs.
+
+    Args:
+        pending: Jobs waiting to run, each with a 'cost' in bytes.
+        in_flight_cost: Estimated memory of the jobs already running.
+        memory_budget: Memory budget in bytes.
+        free_slots: Number of idle workers.
+
+    Returns:
+        List[int]: Indexes into pending of the jobs to start.
+    """
+    admitted = []
+    used = in_flight_cost
+    for i, job in enumerate(pending):
+        if len(admitted) >= free_slots:
+            break
+        if used + job['cost'] <= memory_budget or (used == 0 and not admitted):
+            admitted.append(i)
+            used += job['cost']
+    return admitted
+
+def _timed_call(func: Callable, args: tuple) -> tuple:
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def _record(job: Dict[str, Any], elapsed: float, stats: List[Dict[str, Any]]) -> None:
+    mb = job['bytes'] / MB
+    rate = mb / elapsed if elapsed > 0 else 0.0
+    stats.append({'name': job['name'], 'bytes': job['bytes'], 'seconds': elapsed, 'mb_per_s': rate})
+    logger.info(f"Converted {job['name']}: {mb:.2f} MB in {elapsed:.2f}s ({rate:.2f} MB/s)")
+
+def run_with_memory_budget(jobs: List[Dict[str, Any]], func: Callable, memory_budget: int, max_workers: int = 1,
+                           on_complete: Optional[Callable] = None, initializer: Optional[Callable] = None,
+                           initargs: tuple = ()) -> Dict[str, Any]:
+    """
+    Run jobs on a process pool, admitting only as many as fit in the memory budget.
+
+    Args:
+        jobs: Jobs to run. Each is a dict with 'name', 'cost' (estimated peak memory
+            in bytes), 'bytes' (input size used for throughput) and 'args' for func.
+        func: Module-level callable run as func(*job['args']) in a worker process.
+        memory_budget: Memory budget in bytes shared by all concurrent jobs.
+        max_workers: Maximum number of worker processes. With 1, jobs run in-process.
+        on_complete: Optional callback called in the parent as on_complete(job, result).
+        initializer: Optional worker process initializer.
+        initargs: Arguments for the initializer.
+
+    Returns:
+        Dict[str, Any]: Per-job statistics under 'jobs' plus aggregate throughput.
+    """
+    stats = []
+    start = time.perf_counter()
+
+    if max_workers <= 1:
+        for job in jobs:
+            result, elapsed = _timed_call(func, job['args'])
+            _record(job, elapsed, stats)
+            if on_complete:
+                on_complete(job, result)
+    else:
+        pending = list(jobs)
+        running = {}
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=initializer, initargs=initargs) as executor:
+            while pending or running:
+                in_flight_cost = sum(job['cost'] for job in running.values())
+                admitted = select_admissible(pending, in_flight_cost, memory_budget, max_workers - len(running))
+                for i in admitted:
+                    job = pending[i]
+                    running[executor.submit(_timed_call, func, job['args'])] = job
+                    logger.debug(f"Started {job['name']} (estimated {job['cost'] / MB:.2f} MB)")
+                pending = [job for i, job in enumerate(pending) if i not in admitted]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    result, elapsed = future.result()
+                    _record(job, elapsed, stats)
+                    if on_complete:
+                        on_complete(job, result)
+
+    wall_seconds = time.perf_counter() - start
+    total_bytes = sum(job['bytes'] for job in jobs)
+    rate = total_bytes / MB / wall_seconds if wall_seconds > 0 else 0.0
+    logger.info(f"Converted {len(jobs)} shards ({total_bytes / MB:.2f} MB) in {wall_seconds:.2f}s ({rate:.2f} MB/s aggregate)")
+    return {'jobs': stats, 'total_bytes': total_bytes, 'wall_seconds': wall_seconds, 'mb_per_s': rate}
@@ -0,0 +1,137 @@
+# app/streaming_quantizer.py
+
+import os
+import shutil
+import logging
+from typing import Any, Dict, Optional
+
+import torch
+import transformers
+from accelerate import init_empty_weights
+from awq.models._config import AwqConfig
+from awq.models.auto import AWQ_CAUSAL_LM_MODEL_MAP
+from awq.models.base import TRANSFORMERS_AUTO_MAPPING_DICT
+from awq.utils.module import get_op_name
+from transformers import AutoConfig
+
+from app.checkpointed_quantizer import CheckpointedAwqQuantizer
+from app.layer_checkpoint import LayerCheckpoint
+from app.layer_streaming import LayerShardWriter, StreamedWeights
+from app.quant_trace import QuantTrace, trace_span
+
+logger = logging.getLogger(__name__)
+
+class StreamingAwqQuantizer(CheckpointedAwqQuantizer):
+    """
+    AwqQuantizer that holds one decoder layer in memory at a time.
+
+    The model is built on the meta device. Each layer is loaded from the
+    memory-mapped shards, run on the calibration inputs, quantized, written to
+    its own output shard and released before the next one is loaded, so peak
+    memory is the embeddings plus one layer and its activations. The steps per
+    layer are AutoAWQ's own, so the output matches a full in-memory run. With a
+    checkpoint, the output shards already written are the completed layers and
+    only the next layer's inputs are checkpointed.
+
+    Passed to model.quantize as quantizer_cls, with weights, writer and dtype.
+    """
+
+    def __init__(self, *args, weights: StreamedWeights = None, writer: LayerShardWriter = None,
+                 dtype: torch.dtype = torch.float32, **kwargs):
+        awq_model, model = args[0], args[1]
+        self.weights = weights
+        self.writer = writer
+        self.dtype = dtype
+        self.layers_prefix = get_op_name(model, awq_model.get_model_layers(model)) + '.'
+        # init_quant runs the calibration samples up to the first layer
+        self._materialize(awq_model.get_model_layers(model), 0)
+        super().__init__(*args, **kwargs)
+
+    def _materialize(self, modules, i: int) -> None:
+        missing = self.weights.materialize(modules[i], f"{self.layers_prefix}{i}.", self.dtype)
+        if missing:
+            raise ValueError(f"Weights missing from {self.weights.model_path}: {', '.join(missing)}")
+
+    def _load_layer(self, i: int) -> None:
+        if next(self.modules[i].parameters()).device.type == 'meta':
+            self._materialize(self.modules, i)
+
+    def _restore_layer(self, i: int, tensors: Optional[Dict[str, torch.Tensor]]) -> None:
+        # Completed layers are in their output shards already
+        self.modules[i] = self.weights.release(self.modules[i])
+
+    def _save_layer(self, i: int) -> None:
+        prefix = f"{self.layers_prefix}{i}."
+        self.writer.write(self.writer.layer_shard(i), {
+            prefix + name: tensor for name, tensor in self.modules[i].state_dict().items()})
+        if self.checkpoint is not None:
+            self.checkpoint.save(i, self.inps)
+        self.modules[i] = self.weights.release(self.modules[i])
+
+def run_streaming_quantization(model_path: str, quant_config: Dict[str, Any], output_dir: str, tokenizer,
+                               calib_kwargs: Optional[Dict[str, Any]] = None,
+                               dtype: torch.dtype = torch.float32,
+                               checkpoint: Optional[LayerCheckpoint] = None,
+                               trace: Optional[QuantTrace] = None) -> None:
+    """
+    Quantize a model with AutoAWQ one decoder layer at a time, without ever loading it whole.
+
+    The output directory gets the same sharded safetensors, index and config
+    that save_quantized writes, with one shard per decoder layer.
+
+    Args:
+        model_path (str): Model directory with safetensors or bin weights.
+        quant_config (Dict[str, Any]): AutoAWQ quantization config.
+        output_dir (str): Directory to save the quantized model.
+        tokenizer: Tokenizer for the calibration set.
+        calib_kwargs: Calibration arguments passed on to model.quantize.
+        dtype: Dtype the weights are loaded and calibrated in.
+        checkpoint: Per-layer checkpoint to resume from and update.
+        trace: Trace of the model build, each layer and the final save.
+    """
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+    if config.model_type not in AWQ_CAUSAL_LM_MODEL_MAP:
+        raise TypeError(f"{config.model_type} isn't supported yet.")
+    target_cls = getattr(transformers, TRANSFORMERS_AUTO_MAPPING_DICT[config.model_type])
+
+    with trace_span(trace, 'build_model'):
+        # Parameters stay on the meta device; small buffers such as rotary frequencies are real
+        with init_empty_weights(include_buffers=False):
+            model = target_cls.from_config(config, torch_dtype=dtype, trust_remote_code=True)
+        model.eval()
+        awq_model = AWQ_CAUSAL_LM_MODEL_MAP[config.model_type](
+            model, config.model_type, is_quantized=False, config=config,
+            quant_config=AwqConfig.from_dict(quant_config), processor=None)
+
+        weights = StreamedWeights(model_path)
+        layers = awq_model.get_model_layers(model)
+        layers_prefix = get_op_name(model, layers) + '.'
+        missing = weights.materialize(model, dtype=dtype, skip=[layers_prefix])
+        # A tied LM head is usually not stored; tying fills it from the embeddings
+        model.tie_weights()
+        state_dict = model.state_dict(keep_vars=True)
+        missing = [name for name in missing if state_dict[name].device.type == 'meta']
+        if missing:
+            raise ValueError(f"Weights missing from {model_path}: {', '.join(missing)}")
+
+    writer = LayerShardWriter(output_dir, len(layers))
+    if checkpoint is not None and not all(os.path.exists(os.path.join(output_dir, writer.layer_shard(i)))
+                                          for i in range(checkpoint.completed)):
+        logger.warning(f"Output shards of the checkpointed layers are missing from {output_dir}, starting over")
+        checkpoint.clear()
+    writer.write(writer.shard_name(1), {name: tensor for name, tensor in model.state_dict().items()
+                                        if not name.startswith(layers_prefix)})
+
+    logger.info(f"Streaming AWQ quantization of {len(layers)} layers from {model_path}")
+    awq_model.quantize(tokenizer, quant_config=quant_config, quantizer_cls=StreamingAwqQuantizer,
+                       weights=weights, writer=writer, dtype=dtype, checkpoint=checkpoint, trace=trace,
+                       **(calib_kwargs or {}))
+
+    with trace_span(trace, 'finish'):
+        writer.finish()
+        model.config.quantization_config = awq_model.quant_config.to_transformers_dict()
+        model.config.save_pretrained(output_dir)
+        generation_config = os.path.join(model_path, 'generation_config.json')
+        if os.path.exists(generation_config):
+            shutil.copy2(generation_config, output_dir)
+    logger.info(f"Streamed quantized model written to {output_dir}")
@@ -0,0 +1,180 @@
+# app/tied_weights.py
+
+import os
+import json
+import hashlib
+import logging
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+
+from app.safetensors_io import TIED_WEIGHTS_METADATA_KEY, tensor_buffer
+
+logger = logging.getLogger(__name__)
+
+# Leading bytes hashed to rule out most cross-shard candidates without reading them in full
+SAMPLE_BYTES = 64 * 1024
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Input and output embedding names of the common architectures. On load, transformers
+# re-ties only this pair (tie_word_embeddings), so it is the only tie allowed across shards.
+INPUT_EMBEDDING_SUFFIXES = ('embed_tokens.weight', 'wte.weight', 'word_embeddings.weight', 'tok_embeddings.weight',
+                            'embed_in.weight')
+OUTPUT_EMBEDDING_SUFFIXES = ('lm_head.weight', 'embed_out.weight')
+
+def _has_suffix(name: str, suffixes: Tuple[str, ...]) -> bool:
+    return any(name == suffix or name.endswith('.' + suffix) for suffix in suffixes)
+
+def is_input_embedding(name: str) -> bool:
+    return _has_suffix(name, INPUT_EMBEDDING_SUFFIXES)
+
+def is_output_embedding(name: str) -> bool:
+    return _has_suffix(name, OUTPUT_EMBEDDING_SUFFIXES)
+
+def ties_across_shards(model_path: str) -> bool:
+    """
+    Whether an output embedding may be stored once with an identical input embedding in another shard.
+
+    Only models whose config.json sets tie_word_embeddings qualify, because their
+    loader re-ties the dropped output embedding. A missing config or key assumes nothing.
+    """
+    config_file = os.path.join(model_path, 'config.json')
+    if not os.path.exists(config_file):
+        return False
+    with open(config_file, 'r') as f:
+        return bool(json.load(f).get('tie_word_embeddings', False))
+
+def storage_key(tensor: torch.Tensor) -> Tuple:
+    """
+    Identity of the exact bytes a tensor views: its storage, the byte range it covers
+    within that storage, and the dtype, shape and strides they are read with.
+    """
+    offset = tensor.storage_offset() * tensor.element_size()
+    return (
+        tensor.device,
+        tensor.untyped_storage().data_ptr(),
+        offset,
+        offset + tensor.numel() * tensor.element_size(),
+        tensor.dtype,
+        tuple(tensor.shape),
+        tuple(tensor.stride()),
+    )
+
+def shared_pointers(tensors: Dict[str, torch.Tensor]) -> List[List[str]]:
+    """
+    Group the names of tensors that view exactly the same bytes of the same storage.
+
+    Unlike comparing data_ptr(), this never groups a slice with the tensor it was taken
+    from, nor empty tensors, which can all report the same pointer.
+    """
+    groups = defaultdict(list)
+    for name, tensor in tensors.items():
+        if tensor.numel() > 0:
+            groups[storage_key(tensor)].append(name)
+    return [names for names in groups.values() if len(names) > 1]
+
+def alias_map(groups: List[List[str]]) -> Dict[str, str]:
+    """
+    Alias-to-target map of groups of tied names. A group keeps its input embedding,
+    which transformers ties the output embedding to, and otherwise its first name.
+    """
+    ties = {}
+    for names in groups:
+        target = next((name for name in names if is_input_embedding(name)), names[0])
+        ties.update({alias: target for alias in names if alias != target})
+    return ties
+
+def shared_storages(tensors: Dict[str, torch.Tensor]) -> List[List[str]]:
+    """
+    Group the names of tensors backed by the same storage, whatever part of it they view.
+    """
+    groups = defaultdict(list)
+    for name, tensor in tensors.items():
+        if tensor.numel() > 0:
+            groups[(tensor.device, tensor.untyped_storage().data_ptr())].append(name)
+    return [names for names in groups.values() if len(names) > 1]
+
+def tensor_digest(tensor: torch.Tensor, limit: Optional[int] = None) -> str:
+    """
+    sha256 of the raw bytes of a tensor, or of its first limit bytes.
+    """
+    tensor = tensor.detach().cpu().contiguous()
+    buffer = tensor_buffer(tensor)
+    end = len(buffer) if limit is None else min(limit, len(buffer))
+    hasher = hashlib.sha256()
+    for start in range(0, end, HASH_CHUNK_SIZE):
+        hasher.update(buffer[start:min(start + HASH_CHUNK_SIZE, end)])
+    del buffer
+    return hasher.hexdigest()
+
+def find_tied_weights(shard_files: List[str], load_shard: Callable[[str], Dict[str, torch.Tensor]],
+                      across_shards: bool = True) -> Dict[str, str]:
+    """
+    Find the tied tensors of a checkpoint, within and across its shards.
+
+    Within a shard, tensors are tied when they view the same bytes of the same storage.
+    Shards are saved separately, so ties across shards are found by content instead.
+    Only an output embedding tied to an input embedding counts, as that is the one
+    pair the loader re-ties: identical layers (e.g. repeated by a passthrough merge)
+    are kept. Candidates with the same dtype and shape are compared by a digest of
+    their leading bytes, and only those are hashed in full to confirm the tie. Shards
+    are loaded one at a time, at most twice, so memory-mapped shards are never held together.
+
+    Args:
+        shard_files: Shard names in checkpoint order. A tie keeps the input embedding,
+            or else the first of its tensors.
+        load_shard: Callable returning the (preferably memory-mapped) tensors of a shard.
+        across_shards: Also tie output embeddings to identical input embeddings in other shards.
+
+    Returns:
+        Dict[str, str]: Alias name to the name of the tensor that is kept.
+    """
+    ties = {}
+    shard_of = {}
+    candidates = defaultdict(list)  # (dtype, shape, sample digest) -> names
+    for shard_file in shard_files:
+        tensors = load_shard(shard_file)
+        ties.update(alias_map(shared_pointers(tensors)))
+        for name, tensor in tensors.items():
+            shard_of.setdefault(name, shard_file)
+            if (across_shards and name not in ties and tensor.dim() >= 2 and tensor.numel() > 0
+                    and (is_input_embedding(name) or is_output_embedding(name))):
+                candidates[(tensor.dtype, tuple(tensor.shape), tensor_digest(tensor, SAMPLE_BYTES))].append(name)
+        del tensors
+
+    # Only candidate groups pairing embeddings from different shards are worth reading in full
+    groups = [names for names in candidates.values()
+              if len({shard_of[name] for name in names}) > 1
+              and any(map(is_input_embedding, names)) and any(map(is_output_embedding, names))]
+    to_hash = defaultdict(list)
+    for names in groups:
+        for name in names:
+            to_hash[shard_of[name]].append(name)
+
+    digests = {}
+    for shard_file in shard_files:
+        if to_hash.get(shard_file):
+            tensors = load_shard(shard_file)
+            for name in to_hash[shard_file]:
+                digests[name] = tensor_digest(tensors[name])
+            del tensors
+
+    for names in groups:
+        inputs = [name for name in names if is_input_embedding(name)]
+        for name in filter(is_output_embedding, names):
+            # Separate storages within one shard are left alone, as they were saved
+            target = next((target for target in inputs
+                           if digests[target] == digests[name] and shard_of[target] != shard_of[name]), None)
+            if target is not None:
+                ties[name] = target
+
+    # Point aliases of aliases at the tensor that is actually kept
+    for alias, target in ties.items():
+        while target in ties:
+            target = ties[target]
+        ties[alias] = target
+
+    if ties:
+        logger.info(f"Found {len(ties)} tied tensor(s): {ties}")
+    return ties
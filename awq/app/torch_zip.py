@@ -0,0 +1,360 @@
+# app/torch_zip.py
+
+import io
+import os
+import itertools
+import json
+import mmap
+import pickle
+import struct
+import zipfile
+import logging
+import argparse
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import torch
+
+from app.dtype_policy import as_policy
+from app.pipeline import PIPELINE_DEPTH
+from app.safetensors_io import TIED_WEIGHTS_METADATA_KEY, build_header, write_entries
+from app.tied_weights import alias_map
+
+logger = logging.getLogger(__name__)
+
+# Legacy storage classes referenced by data.pkl and the dtype of their elements
+STORAGE_DTYPES = {
+    'DoubleStorage': torch.float64,
+    'FloatStorage': torch.float32,
+    'HalfStorage': torch.float16,
+    'BFloat16Storage': torch.bfloat16,
+    'LongStorage': torch.int64,
+    'IntStorage': torch.int32,
+    'ShortStorage': torch.int16,
+    'CharStorage': torch.int8,
+    'ByteStorage': torch.uint8,
+    'BoolStorage': torch.bool,
+}
+
+# Fixed part of a zip local file header, followed by the file name and extra field
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+class UnsupportedCheckpoint(ValueError):
+    """
+    Raised when a checkpoint cannot be transcoded directly and has to go through torch.load.
+    """
+
+class StorageRef(NamedTuple):
+    key: str
+    dtype: torch.dtype
+    numel: int
+
+class TensorRecord(NamedTuple):
+    storage: StorageRef
+    offset: int
+    shape: Tuple[int, ...]
+    stride: Tuple[int, ...]
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return self.storage.dtype
+
+    @property
+    def numel(self) -> int:
+        numel = 1
+        for dim in self.shape:
+            numel *= dim
+        return numel
+
+    @property
+    def contiguous(self) -> bool:
+        expected = 1
+        for dim, stride in zip(reversed(self.shape), reversed(self.stride)):
+            if dim != 1 and stride != expected:
+                return False
+            expected *= dim
+        return True
+
+def _rebuild_tensor(storage, storage_offset, size, stride, requires_grad=False, backward_hooks=None, metadata=None):
+    return TensorRecord(storage, storage_offset, tuple(size), tuple(stride))
+
+def _rebuild_parameter(data, requires_grad=False, backward_hooks=None, state=None):
+    return data
+
+class LayoutUnpickler(pickle.Unpickler):
+    """
+    Unpickler for data.pkl that only understands the objects of a state dict.
+
+    Tensors come back as TensorRecord layouts pointing into the storage records of
+    the archive. No tensor is built and no other class can be imported, so
+    reading a checkpoint this way cannot run code from the pickle.
+    """
+
+    ALLOWED = {
+        ('collections', 'OrderedDict'): OrderedDict,
+        ('torch._utils', '_rebuild_tensor_v2'): _rebuild_tensor,
+        ('torch._utils', '_rebuild_parameter'): _rebuild_parameter,
+        ('torch._utils', '_rebuild_parameter_with_state'): _rebuild_parameter,
+    }
+
+    def find_class(self, module, name):
+        if (module, name) in self.ALLOWED:
+            return self.ALLOWED[(module, name)]
+        if module == 'torch' and name in STORAGE_DTYPES:
+            return STORAGE_DTYPES[name]
+        raise UnsupportedCheckpoint(f"{module}.{name} is not part of a plain state dict")
+
+    def persistent_load(self, pid):
+        if not isinstance(pid, tuple) or len(pid) != 5 or pid[0] != 'storage' or not isinstance(pid[1], torch.dtype):
+            raise UnsupportedCheckpoint(f"Unsupported storage reference {pid!r}")
+        _, dtype, key, _, numel = pid
+        return StorageRef(str(key), dtype, int(numel))
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, count: int, chunk_size: int = COPY_CHUNK_SIZE) -> None:
+    """
+    Copy count bytes starting at offset of src_fd to the current position of dst_fd.
+
+    The copy stays inside the kernel with copy_file_range, or sendfile where that is
+    unavailable (older kernels, copies across file systems), and only falls back to
+    reading and writing through user space when neither works.
+    """
+    end = offset + count
+    for copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if copy is None:
+            continue
+        try:
+            while offset < end:
+                size = min(chunk_size, end - offset)
+                if copy is os.sendfile:
+                    copied = os.sendfile(dst_fd, src_fd, offset, size)
+                else:
+                    copied = copy(src_fd, dst_fd, size, offset)
+                if copied == 0:
+                    raise EOFError(f"Unexpected end of file at offset {offset}")
+                offset += copied
+            return
+        except OSError as e:
+            logger.debug(f"{copy.__name__} unavailable ({str(e)}). Trying the next copy method.")
+
+    while offset < end:
+        data = os.pread(src_fd, min(chunk_size, end - offset), offset)
+        if not data:
+            raise EOFError(f"Unexpected end of file at offset {offset}")
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        offset += len(data)
+
+def hash_range(fd: int, offset: int, count: int, hasher, chunk_size: int = COPY_CHUNK_SIZE) -> None:
+    """
+    Update hasher with count bytes of fd starting at offset, read in chunks.
+
+    This reads through user space the very bytes copy_range kept in the kernel,
+    so it is only worth its cost when a digest was asked for.
+    """
+    end = offset + count
+    while offset < end:
+        data = os.pread(fd, min(chunk_size, end - offset), offset)
+        if not data:
+            raise EOFError(f"Unexpected end of file at offset {offset}")
+        hasher.update(data)
+        offset += len(data)
+
+class TorchZipCheckpoint:
+    """
+    Layout of a PyTorch zip checkpoint, read without unpickling any tensor.
+
+    data.pkl is read with a LayoutUnpickler into a table of tensor records, and the
+    file offset of every storage record is taken from its zip local header. Tensor
+    bytes can then be copied straight out of the archive or viewed through a memory map.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._mmap = None
+        try:
+            archive = zipfile.ZipFile(filename)
+        except zipfile.BadZipFile:
+            raise UnsupportedCheckpoint(f"{filename} is not a zip checkpoint")
+
+        with archive, open(filename, 'rb') as f:
+            names = archive.namelist()
+            pickles = [name for name in names if name == 'data.pkl' or name.endswith('/data.pkl')]
+            if len(pickles) != 1:
+                raise UnsupportedCheckpoint(f"{filename} does not contain a single data.pkl")
+            prefix = pickles[0][:-len('data.pkl')]
+            if f'{prefix}byteorder' in names and archive.read(f'{prefix}byteorder').strip() != b'little':
+                raise UnsupportedCheckpoint(f"{filename} was saved on a big-endian machine")
+
+            loaded = LayoutUnpickler(io.BytesIO(archive.read(pickles[0]))).load()
+            if isinstance(loaded, dict) and isinstance(loaded.get('state_dict'), dict):
+                loaded = loaded['state_dict']
+            if not isinstance(loaded, dict) or not all(isinstance(v, TensorRecord) for v in loaded.values()):
+                raise UnsupportedCheckpoint(f"{filename} does not hold a flat state dict")
+            self.records: Dict[str, TensorRecord] = dict(loaded)
+
+            self.storage_offsets: Dict[str, int] = {}
+            for name, record in self.records.items():
+                key = record.storage.key
+                if key not in self.storage_offsets:
+                    info = archive.getinfo(f'{prefix}data/{key}')
+                    if info.file_size < record.storage.numel * torch.empty((), dtype=record.dtype).element_size():
+                        raise UnsupportedCheckpoint(f"Storage {info.filename} is shorter than its declared size")
+                    self.storage_offsets[key] = self._data_offset(info, f)
+                extent = record.offset + sum((dim - 1) * stride for dim, stride in zip(record.shape, record.stride))
+                if record.numel and (record.offset < 0 or extent >= record.storage.numel):
+                    raise UnsupportedCheckpoint(f"Tensor {name} lies outside its storage")
+
+    @staticmethod
+    def _data_offset(info: zipfile.ZipInfo, f) -> int:
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise UnsupportedCheckpoint(f"Storage {info.filename} is compressed")
+        f.seek(info.header_offset)
+        signature, *fields = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+        if signature != ZIP_LOCAL_HEADER_SIGNATURE:
+            raise UnsupportedCheckpoint(f"Bad local header for {info.filename}")
+        name_length, extra_length = fields[-2:]
+        return info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
+
+    def byte_range(self, name: str) -> Tuple[int, int]:
+        """
+        File offset and length of the bytes of a contiguous tensor.
+        """
+        record = self.records[name]
+        itemsize = torch.empty((), dtype=record.dtype).element_size()
+        return self.storage_offsets[record.storage.key] + record.offset * itemsize, record.numel * itemsize
+
+    def _map(self) -> mmap.mmap:
+        if self._mmap is None:
+            with open(self.filename, 'rb') as f:
+                # Copy-on-write keeps the buffer writable for torch.frombuffer without touching the file
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return self._mmap
+
+    def tensor(self, name: str) -> torch.Tensor:
+        """
+        A memory-mapped view of a tensor. Its pages are only read when it is used.
+        """
+        record = self.records[name]
+        if record.numel == 0:
+            return torch.empty(record.shape, dtype=record.dtype)
+        storage = torch.frombuffer(self._map(), dtype=record.dtype, count=record.storage.numel,
+                                   offset=self.storage_offsets[record.storage.key])
+        return storage.as_strided(record.shape, record.stride, record.offset)
+
+    def tensors(self) -> Dict[str, torch.Tensor]:
+        """
+        Memory-mapped views of every tensor, in checkpoint order. Views of one storage
+        record share its pointer, so shared_pointers groups them as aliases() does.
+        """
+        return {name: self.tensor(name) for name in self.records}
+
+    def aliases(self) -> Dict[str, str]:
+        """
+        Alias-to-target map of tensors laid out over the same bytes of the same storage.
+        """
+        groups = OrderedDict()
+        for name, record in self.records.items():
+            if record.numel > 0:
+                groups.setdefault(record, []).append(name)
+        return alias_map([names for names in groups.values() if len(names) > 1])
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # A tensor view is still alive; the map closes once it is collected
+                pass
+            self._mmap = None
+
+def transcode_checkpoint(pt_filename: str, sf_filename: str, dtype=None, metadata: Optional[Dict[str, str]] = None,
+                         ties: Optional[Dict[str, str]] = None, hasher=None,
+                         pipeline_depth: int = PIPELINE_DEPTH) -> Dict[str, str]:
+    """
+    Convert a PyTorch zip checkpoint to safetensors without unpickling its tensors.
+
+    Tensors that keep their dtype and are stored contiguously are copied byte for
+    byte from the archive with kernel-side copies. The rest are cast chunk by chunk
+    from a memory-mapped view, in the read/cast/write pipeline. The bytes of a
+    kernel-side copy never reach user space, so a hasher is fed the same range of
+    the source instead; the digest is still that of the written file, but every
+    copied byte is then read a second time and the zero-copy benefit is lost.
+    Only pass a hasher when the digest is needed. Tied aliases are left out and
+    recorded in the metadata.
+
+    Args:
+        pt_filename: PyTorch zip checkpoint.
+        sf_filename: Output safetensors path. Data goes to a temporary file that is renamed on success.
+        dtype: Optional DtypePolicy, policy string or torch dtype. None keeps stored dtypes.
+        metadata: Optional metadata stored in the header.
+        ties: Alias-to-target map for the whole checkpoint. Defaults to the aliases within this file.
+        hasher: Optional hashlib object updated with the bytes of the file.
+        pipeline_depth: Chunks in flight between the stages of the cast pipeline.
+
+    Returns:
+        Dict[str, str]: Alias-to-target map of the tensors left out.
+
+    Raises:
+        UnsupportedCheckpoint: The checkpoint needs torch.load. Nothing has been written.
+    """
+    checkpoint = TorchZipCheckpoint(pt_filename)
+    try:
+        if ties is None:
+            ties = checkpoint.aliases()
+        dropped = {alias: target for alias, target in ties.items() if alias in checkpoint.records}
+        metadata = dict(metadata or {})
+        if dropped:
+            metadata[TIED_WEIGHTS_METADATA_KEY] = json.dumps(dropped, sort_keys=True)
+
+        policy = as_policy(dtype)
+        entries = []
+        for name, record in checkpoint.records.items():
+            if name not in dropped:
+                out_dtype = policy.resolve(name, checkpoint.tensor(name)) if policy else record.dtype
+                entries.append((name, out_dtype, record.shape))
+
+        def copied(entry) -> bool:
+            record = checkpoint.records[entry[0]]
+            return entry[1] == record.dtype and record.contiguous and record.numel > 0
+
+        tmp_filename = f"{sf_filename}.tmp"
+        try:
+            with open(tmp_filename, 'wb') as f, open(pt_filename, 'rb') as src:
+                header = build_header(entries, metadata)
+                f.write(header)
+                if hasher is not None:
+                    hasher.update(header)
+                for is_copy, run in itertools.groupby(entries, key=copied):
+                    if not is_copy:
+                        write_entries(f, list(run), checkpoint.tensor, hasher, pipeline_depth)
+                        continue
+                    for name, _, _ in run:
+                        f.flush()
+                        offset, count = checkpoint.byte_range(name)
+                        copy_range(src.fileno(), f.fileno(), offset, count)
+                        if hasher is not None:
+                            hash_range(src.fileno(), offset, count, hasher)
+            os.replace(tmp_filename, sf_filename)
+        except Exception:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+    finally:
+        checkpoint.close()
+    return dropped
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcode PyTorch zip checkpoints to safetensors without unpickling tensors")
+    parser.add_argument("input_files", nargs="+", help="PyTorch .bin/.pt checkpoints")
+    parser.add_argument("--dtype", help="Output dtype policy, e.g. bf16 or 'fp16-checked;*norm*=fp32' (defaults to stored dtypes)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for input_file in args.input_files:
+        output_file = os.path.splitext(input_file)[0] + '.safetensors'
+        transcode_checkpoint(input_file, output_file, dtype=args.dtype, metadata={"format": "pt"})
+        logger.info(f"Transcoded {input_file} to {output_file}")
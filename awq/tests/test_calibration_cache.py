@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import numpy as np
+from app.calibration_cache import CalibrationCache, tokenize_calibration, tokenizer_fingerprint
+
+class WordTokenizer:
+    """
+    Slow-tokenizer stand-in: one id per word, plus an optional BOS id.
+    """
+    def __init__(self, bos=None):
+        self.bos = bos
+        self.vocab = {}
+
+    def encode(self, text):
+        ids = [self.vocab.setdefault(word, len(self.vocab) + 10) for word in text.split()]
+        return ([self.bos] if self.bos is not None else []) + ids
+
+    def get_vocab(self):
+        return {'<bos>': self.bos}
+
+class TestCalibrationCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.corpus = os.path.join(self.root, 'corpus.jsonl')
+        with open(self.corpus, 'w') as f:
+            for i in range(20):
+                f.write(json.dumps({'text': ' '.join(f"w{i}_{j}" for j in range(3))}) + '\n')
+        self.cache = CalibrationCache(os.path.join(self.root, 'calibration'))
+
+    def test_tokenize_matches_autoawq_blocks(self):
+        texts = ['a b c', '', 'too many words here for one block', 'd e', 'f g h i']
+        blocks = tokenize_calibration(texts, WordTokenizer(), n_samples=3, seqlen=4)
+        # Empty and over-long texts are skipped (the long one still took ids 13-19); 'a b c', 'd e',
+        # 'f g h i' give 9 tokens, two whole blocks
+        self.assertEqual(blocks.dtype, np.int32)
+        self.assertEqual(blocks.tolist(), [[10, 11, 12, 20], [21, 22, 23, 24]])
+        with self.assertRaisesRegex(ValueError, 'fewer than one block'):
+            tokenize_calibration(['a'], WordTokenizer(), n_samples=3, seqlen=4)
+
+    def test_second_job_reuses_the_tokenized_set(self):
+        samples = self.cache.get_or_build(WordTokenizer(), self.corpus, n_samples=8, seqlen=6)
+        self.assertIsInstance(samples, np.memmap)
+        self.assertEqual(samples.shape, (4, 6))
+
+        with patch('app.calibration_cache.load_calibration_texts') as mock_load:
+            again = self.cache.get_or_build(WordTokenizer(), self.corpus, n_samples=8, seqlen=6)
+            mock_load.assert_not_called()
+        np.testing.assert_array_equal(again, samples)
+
+    def test_key_covers_tokenizer_sizes_and_source(self):
+        plain, with_bos = tokenizer_fingerprint(WordTokenizer()), tokenizer_fingerprint(WordTokenizer(bos=1))
+        self.assertNotEqual(plain, with_bos)
+        paths = {self.cache.path(self.corpus, plain, 8, 6), self.cache.path(self.corpus, with_bos, 8, 6),
+                 self.cache.path(self.corpus, plain, 16, 6), self.cache.path(self.corpus, plain, 8, 12),
+                 self.cache.path('pileval', plain, 8, 6)}
+        self.assertEqual(len(paths), 5)
+
+        # Editing a local corpus changes its key
+        before = self.cache.path(self.corpus, plain, 8, 6)
+        with open(self.corpus, 'a') as f:
+            f.write(json.dumps({'text': 'more'}) + '\n')
+        os.utime(self.corpus, ns=(0, 0))
+        self.assertNotEqual(self.cache.path(self.corpus, plain, 8, 6), before)
+
+if __name__ == '__main__':
+    unittest.main()
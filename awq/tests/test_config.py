@@ -1,6 +1,6 @@
 import unittest
 from unittest.mock import patch
-from app.config import Config, get_default_quanter
+from app.config import Config, get_default_quanter, parse_quant_configs
 
 class TestConfig(unittest.TestCase):
     def test_setup_directories(self):
@@ -17,5 +17,14 @@ class TestConfig(unittest.TestCase):
         mock_whoami.side_effect = Exception("API Error")
         self.assertIsNone(get_default_quanter())
 
+    def test_parse_quant_configs(self):
+        default = {'w_bit': 4, 'q_group_size': 128, 'version': 'GEMM'}
+        self.assertEqual(parse_quant_configs('', default), [default])
+        self.assertEqual(parse_quant_configs('[{}, {"q_group_size": 64, "version": "GEMV"}]', default),
+                         [default, {'w_bit': 4, 'q_group_size': 64, 'version': 'GEMV'}])
+        for spec in ('[]', '{"q_group_size": 64}', '[64]'):
+            with self.assertRaises(ValueError):
+                parse_quant_configs(spec, default)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
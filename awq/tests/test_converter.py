@@ -0,0 +1,161 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import torch
+from safetensors.torch import load_file
+from app.converter import (
+    convert_model_to_safetensors,
+    convert_pytorch_to_safetensors,
+    convert_shard,
+    load_pytorch_shard,
+    update_safetensors_index,
+)
+from app.conversion_journal import ConversionJournal, JOURNAL_FILE_NAME, file_sha256
+from app.safetensors_io import save_file_streaming
+
+class TestConverter(unittest.TestCase):
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.model_path)
+
+    def _state_dict(self):
+        embed = torch.randn(32, 8)
+        return {
+            'model.embed_tokens.weight': embed,
+            'lm_head.weight': embed,
+            'model.layers.0.mlp.up_proj.weight': torch.randn(16, 8),
+            'model.norm.weight': torch.ones(8, dtype=torch.bfloat16),
+            'model.layers.0.self_attn.rotary_emb.inv_freq': torch.arange(4, dtype=torch.int64),
+        }
+
+    def test_save_file_streaming_roundtrip(self):
+        tensors = self._state_dict()
+        sf_filename = os.path.join(self.model_path, 'out.safetensors')
+        save_file_streaming({k: v for k, v in tensors.items() if k != 'lm_head.weight'}, sf_filename,
+                            metadata={'format': 'pt'}, dtype=torch.float16)
+
+        reloaded = load_file(sf_filename)
+        self.assertEqual(reloaded['model.embed_tokens.weight'].dtype, torch.float16)
+        self.assertEqual(reloaded['model.norm.weight'].dtype, torch.float16)
+        self.assertEqual(reloaded['model.layers.0.self_attn.rotary_emb.inv_freq'].dtype, torch.int64)
+        self.assertTrue(torch.equal(reloaded['model.layers.0.mlp.up_proj.weight'],
+                                    tensors['model.layers.0.mlp.up_proj.weight'].half()))
+        self.assertFalse(os.path.exists(sf_filename + '.tmp'))
+
+    def test_convert_shard_streaming_matches_full_load(self):
+        pt_filename = os.path.join(self.model_path, 'pytorch_model.bin')
+        torch.save(self._state_dict(), pt_filename)
+
+        streamed = os.path.join(self.model_path, 'streamed.safetensors')
+        full = os.path.join(self.model_path, 'full.safetensors')
+        convert_shard(pt_filename, streamed, streaming=True)
+        convert_shard(pt_filename, full, streaming=False)
+
+        streamed_tensors = load_file(streamed)
+        full_tensors = load_file(full)
+        self.assertNotIn('lm_head.weight', streamed_tensors)
+        for name in ['model.embed_tokens.weight', 'model.layers.0.mlp.up_proj.weight', 'model.norm.weight']:
+            self.assertTrue(torch.equal(streamed_tensors[name], full_tensors[name]))
+
+    def test_load_pytorch_shard_unwraps_state_dict(self):
+        pt_filename = os.path.join(self.model_path, 'pytorch_model.bin')
+        torch.save({'state_dict': {'weight': torch.ones(2)}}, pt_filename)
+        loaded = load_pytorch_shard(pt_filename)
+        self.assertEqual(list(loaded.keys()), ['weight'])
+
+    def test_convert_pytorch_to_safetensors(self):
+        for i in range(2):
+            torch.save({f'layer.{i}.weight': torch.randn(4, 4)},
+                       os.path.join(self.model_path, f'pytorch_model-0000{i + 1}-of-00002.bin'))
+
+        convert_pytorch_to_safetensors(self.model_path, sorted(f for f in os.listdir(self.model_path) if f.endswith('.bin')))
+
+        self.assertEqual(sorted(os.listdir(self.model_path)),
+                         ['model-00001-of-00002.safetensors', 'model-00002-of-00002.safetensors'])
+        self.assertIn('layer.1.weight', load_file(os.path.join(self.model_path, 'model-00002-of-00002.safetensors')))
+
+    def test_convert_pytorch_to_safetensors_parallel(self):
+        for i in range(3):
+            torch.save({f'layer.{i}.weight': torch.randn(4, 4)},
+                       os.path.join(self.model_path, f'pytorch_model-0000{i + 1}-of-00003.bin'))
+
+        pytorch_files = sorted(f for f in os.listdir(self.model_path) if f.endswith('.bin'))
+        stats = convert_pytorch_to_safetensors(self.model_path, pytorch_files, workers=2, memory_budget=1)
+
+        self.assertEqual(len(stats['jobs']), 3)
+        self.assertFalse(any(f.endswith('.bin') for f in os.listdir(self.model_path)))
+        for i in range(3):
+            tensors = load_file(os.path.join(self.model_path, f'model-0000{i + 1}-of-00003.safetensors'))
+            self.assertIn(f'layer.{i}.weight', tensors)
+
+    def test_update_safetensors_index_reads_shard_headers(self):
+        # Three bin shards were repacked into two safetensors shards, so the old
+        # filename-based mapping no longer applies
+        with open(os.path.join(self.model_path, 'pytorch_model.bin.index.json'), 'w') as f:
+            json.dump({'metadata': {'total_size': 0}, 'weight_map': {
+                'a': 'pytorch_model-00001-of-00003.bin',
+                'b': 'pytorch_model-00002-of-00003.bin',
+                'c': 'pytorch_model-00003-of-00003.bin',
+            }}, f)
+        save_file_streaming({'a': torch.ones(2), 'b': torch.ones(2)},
+                            os.path.join(self.model_path, 'model-00001-of-00002.safetensors'))
+        save_file_streaming({'c': torch.ones(2)}, os.path.join(self.model_path, 'model-00002-of-00002.safetensors'))
+
+        update_safetensors_index(self.model_path)
+
+        with open(os.path.join(self.model_path, 'model.safetensors.index.json')) as f:
+            index = json.load(f)
+        self.assertEqual(index['weight_map'], {
+            'a': 'model-00001-of-00002.safetensors',
+            'b': 'model-00001-of-00002.safetensors',
+            'c': 'model-00002-of-00002.safetensors',
+        })
+        self.assertEqual(index['metadata']['total_size'], 24)
+        self.assertFalse(os.path.exists(os.path.join(self.model_path, 'pytorch_model.bin.index.json')))
+
+    def test_convert_model_to_safetensors_resumes_after_crash(self):
+        for i in range(3):
+            torch.save({f'layer.{i}.weight': torch.randn(4, 4)},
+                       os.path.join(self.model_path, f'pytorch_model-0000{i + 1}-of-00003.bin'))
+
+        converted = []
+        def crash_on_second_shard(pt_filename, sf_filename, *args):
+            if len(converted) == 1:
+                raise RuntimeError("Preempted")
+            converted.append(os.path.basename(pt_filename))
+            return convert_shard(pt_filename, sf_filename, *args)
+
+        with patch('app.converter.convert_shard', side_effect=crash_on_second_shard):
+            with self.assertRaises(RuntimeError):
+                convert_model_to_safetensors(self.model_path)
+
+        self.assertTrue(os.path.exists(os.path.join(self.model_path, JOURNAL_FILE_NAME)))
+        self.assertFalse(os.path.exists(os.path.join(self.model_path, 'pytorch_model-00001-of-00003.bin')))
+
+        converted.clear()
+        with patch('app.converter.convert_shard', side_effect=lambda *args: converted.append(args[0]) or convert_shard(*args)):
+            convert_model_to_safetensors(self.model_path)
+
+        self.assertEqual([os.path.basename(f) for f in converted],
+                         ['pytorch_model-00002-of-00003.bin', 'pytorch_model-00003-of-00003.bin'])
+        self.assertFalse(os.path.exists(os.path.join(self.model_path, JOURNAL_FILE_NAME)))
+        with open(os.path.join(self.model_path, 'model.safetensors.index.json')) as f:
+            self.assertEqual(len(json.load(f)['weight_map']), 3)
+
+    def test_conversion_journal_detects_modified_output(self):
+        sf_filename = os.path.join(self.model_path, 'model-00001-of-00001.safetensors')
+        save_file_streaming({'a': torch.ones(2)}, sf_filename)
+        journal = ConversionJournal.load(self.model_path)
+        journal.record('pytorch_model.bin', 'model-00001-of-00001.safetensors', file_sha256(sf_filename))
+        self.assertTrue(ConversionJournal.load(self.model_path).is_complete('model-00001-of-00001.safetensors', verify_digest=True))
+
+        save_file_streaming({'a': torch.zeros(3)}, sf_filename)
+        self.assertFalse(ConversionJournal.load(self.model_path).is_complete('model-00001-of-00001.safetensors'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+from types import SimpleNamespace
+from unittest.mock import patch
+from app.disk_admission import (GB, RESERVATIONS_FILE_NAME, admit_job, choose_data_dir, conversion_peak, predict_disk_usage,
+                                quantized_size, release_reservation, update_reservation)
+
+DiskUsage = namedtuple('DiskUsage', ['total', 'used', 'free'])
+
+class FakeApi:
+    def __init__(self, files):
+        self.files = files
+
+    def model_info(self, repo_id, files_metadata=False):
+        return SimpleNamespace(siblings=[SimpleNamespace(rfilename=name, size=size) for name, size in self.files.items()])
+
+class TestDiskPrediction(unittest.TestCase):
+    def test_safetensors_model_needs_no_conversion(self):
+        plan = predict_disk_usage({'config.json': 1000, 'model.safetensors': 14 * GB}, w_bit=4, q_group_size=128)
+        self.assertEqual([stage.stage for stage in plan.stages], ['download', 'quantize'])
+        quantized = quantized_size(14 * GB, 2, 4, 128)
+        # 4-bit weights with 10% left in 16 bits come to roughly 0.3 of the fp16 size
+        self.assertAlmostEqual(quantized / (14 * GB), 0.1 + 0.9 * (4 + 20 / 128) / 16, places=3)
+        self.assertEqual(plan.peak_bytes, 1000 + 14 * GB + quantized)
+        self.assertEqual(plan.required_bytes, plan.peak_bytes)
+
+        # Every variant of a multi-variant job is written next to the source
+        variants = predict_disk_usage({'config.json': 1000, 'model.safetensors': 14 * GB},
+                                      quant_configs=[{'w_bit': 4, 'q_group_size': 128}, {'w_bit': 4, 'q_group_size': 32}])
+        self.assertEqual(variants.peak_bytes, 1000 + 14 * GB + quantized + quantized_size(14 * GB, 2, 4, 32))
+
+    def test_conversion_peak_accounts_for_removed_shards(self):
+        # Sources are removed as their outputs complete, so halving fp32 never exceeds the sources plus one output
+        self.assertEqual(conversion_peak([4, 4, 4], 0.5), 14)
+        self.assertEqual(conversion_peak([4, 4, 4], 0.5, workers=3), 18)
+        # Widening fp16 to fp32 peaks near the end
+        self.assertEqual(conversion_peak([4, 4, 4], 2.0), 28)
+
+    def test_bin_model_converted_from_fp32(self):
+        files = {'config.json': 10, 'pytorch_model-00001-of-00002.bin': 8 * GB, 'pytorch_model-00002-of-00002.bin': 8 * GB,
+                 'pytorch_model.bin.index.json': 10}
+        plan = predict_disk_usage(files, present_bytes=16 * GB, dtype_policy='fp16', source_itemsize=4, reshard=True)
+        stages = dict(plan.stages)
+        self.assertEqual(stages['convert'], 20 + 16 * GB + 4 * GB)
+        self.assertEqual(stages['reshard'], 20 + 16 * GB)
+        self.assertEqual(stages['quantize'], 20 + 8 * GB + quantized_size(8 * GB, 2, 4, 128))
+        self.assertEqual(plan.required_bytes, 4 * GB + 20)
+
+        # A native policy keeps the fp32 width
+        native = dict(predict_disk_usage(files, dtype_policy='native;*norm*=fp32', source_itemsize=4).stages)
+        self.assertEqual(native['convert'], 20 + 24 * GB)
+
+    def test_choose_data_dir(self):
+        self.assertEqual(choose_data_dir({'/a': 10, '/b': 10}, {'/a': 5, '/b': 20}), '/b')
+        self.assertEqual(choose_data_dir({'/a': 10, '/b': 10}, {'/a': 10, '/b': 20}), '/a')
+        self.assertIsNone(choose_data_dir({'/a': 10}, {'/a': 9}))
+
+class TestAdmitJob(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.data_dir = os.path.join(self.root, 'data')
+        self.scratch_dir = os.path.join(self.root, 'scratch')
+        self.api = FakeApi({'config.json': 100, 'model.safetensors': 10 * GB})
+        self.free = {}
+        patcher = patch('app.disk_admission.shutil.disk_usage',
+                        side_effect=lambda path: DiskUsage(0, 0, self.free[os.path.basename(path)]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def admit(self, job='author-model', **kwargs):
+        return admit_job('author/model', [job, 'model-AWQ'], [self.data_dir, self.scratch_dir], api=self.api, **kwargs)
+
+    def test_picks_scratch_volume_when_data_dir_is_full(self):
+        self.free = {'data': 5 * GB, 'scratch': 20 * GB}
+        admission = self.admit()
+        self.assertEqual(admission.decision, 'run')
+        self.assertEqual(admission.data_dir, self.scratch_dir)
+
+    def test_refuses_when_nothing_fits(self):
+        self.free = {'data': 5 * GB, 'scratch': 5 * GB}
+        admission = self.admit(mode='queue', queue_timeout=0)
+        self.assertEqual(admission.decision, 'refuse')
+        self.assertIsNone(admission.data_dir)
+
+    def test_existing_download_counts_as_present(self):
+        os.makedirs(os.path.join(self.data_dir, 'author-model'))
+        with open(os.path.join(self.data_dir, 'author-model', 'model.safetensors'), 'wb') as f:
+            f.truncate(10 * GB)
+        self.free = {'data': 5 * GB, 'scratch': 20 * GB}
+        # Only the quantized output is still needed, and the download is not repeated elsewhere
+        admission = self.admit()
+        self.assertEqual(admission.data_dir, self.data_dir)
+        self.assertEqual(admission.plan.required_bytes, 100 + quantized_size(10 * GB, 2, 4, 128))
+
+    def test_selective_download_is_planned_for(self):
+        self.api.files['pytorch_model.bin'] = 10 * GB
+        self.free = {'data': 0, 'scratch': 0}
+        # The safetensors model needs no conversion, so the full plan downloads the .bin as well
+        # and counts it as weights of the quantized output
+        full = self.admit().plan
+        self.assertEqual([stage.stage for stage in full.stages], ['download', 'quantize'])
+        self.assertEqual(full.required_bytes, 100 + 20 * GB + quantized_size(20 * GB, 2, 4, 128))
+        selective = self.admit(selective=True).plan
+        self.assertEqual(selective.required_bytes, 100 + 10 * GB + quantized_size(10 * GB, 2, 4, 128))
+
+    def test_running_jobs_reserve_their_space(self):
+        self.free = {'data': 20 * GB, 'scratch': 0}
+        self.assertEqual(self.admit().data_dir, self.data_dir)
+        # The first job has not written anything yet, but its reservation holds the space
+        self.assertEqual(self.admit(job='author-other').decision, 'refuse')
+        # Admitting the same job again replaces its own reservation
+        self.assertEqual(self.admit().decision, 'run')
+
+    def test_reservation_shrinks_as_stages_finish(self):
+        self.free = {'data': 20 * GB, 'scratch': 0}
+        job_dir_names = ['author-model', 'model-AWQ']
+        admission = self.admit()
+        self.assertEqual(self.admit(job='author-other').decision, 'refuse')
+
+        # The download now occupies its share of the volume, so only the quantized output stays reserved
+        os.makedirs(os.path.join(self.data_dir, 'author-model'))
+        with open(os.path.join(self.data_dir, 'author-model', 'model.safetensors'), 'wb') as f:
+            f.truncate(10 * GB)
+        self.free['data'] -= 10 * GB
+        self.assertEqual(update_reservation(admission, job_dir_names, 'download'), 100 + quantized_size(10 * GB, 2, 4, 128))
+        self.assertEqual(self.admit(job='author-other').decision, 'refuse')
+
+        release_reservation(admission, job_dir_names)
+        with open(os.path.join(self.data_dir, RESERVATIONS_FILE_NAME)) as f:
+            self.assertEqual(json.load(f), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+import torch
+from safetensors.torch import load_file
+from app.dtype_policy import DtypePolicy, as_policy, iter_chunks, overflows_fp16
+from app.safetensors_io import save_file_streaming
+
+class TestDtypePolicy(unittest.TestCase):
+    def test_parse_rules(self):
+        policy = DtypePolicy.parse('fp16-checked; *norm*=fp32 ;lm_head.weight=native')
+        self.assertEqual(policy.default, 'fp16-checked')
+        self.assertEqual(policy.mode_for('model.layers.0.input_layernorm.weight'), 'fp32')
+        self.assertEqual(policy.mode_for('lm_head.weight'), 'native')
+        self.assertEqual(policy.mode_for('model.embed_tokens.weight'), 'fp16-checked')
+        self.assertEqual(str(policy), 'fp16-checked;*norm*=fp32;lm_head.weight=native')
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            DtypePolicy.parse('fp8')
+        with self.assertRaises(ValueError):
+            DtypePolicy('fp16', [('*', 'int4')])
+
+    def test_resolve(self):
+        policy = DtypePolicy.parse('bf16;*norm*=fp32;*.inv_freq=native')
+        self.assertEqual(policy.resolve('q_proj.weight', torch.ones(2, dtype=torch.float32)), torch.bfloat16)
+        self.assertEqual(policy.resolve('norm.weight', torch.ones(2, dtype=torch.bfloat16)), torch.float32)
+        self.assertEqual(policy.resolve('rotary.inv_freq', torch.ones(2, dtype=torch.float32)), torch.float32)
+        self.assertEqual(policy.resolve('position_ids', torch.arange(2)), torch.int64)
+
+    def test_fp16_checked_falls_back_on_overflow(self):
+        policy = DtypePolicy('fp16-checked')
+        self.assertEqual(policy.resolve('small', torch.full((4,), 3.0)), torch.float16)
+        self.assertEqual(policy.resolve('large', torch.tensor([1.0, 1e6])), torch.bfloat16)
+        self.assertEqual(policy.output_dtype('large', torch.float32), torch.float16)
+
+    def test_overflows_fp16_scans_chunks(self):
+        tensor = torch.zeros(10)
+        tensor[9] = 70000.0
+        self.assertTrue(overflows_fp16(tensor, chunk_elements=3))
+        self.assertFalse(overflows_fp16(torch.tensor([float('inf'), 1.0])))
+
+    def test_iter_chunks(self):
+        chunks = list(iter_chunks(torch.arange(10).reshape(2, 5), chunk_elements=4))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+        self.assertTrue(torch.equal(torch.cat(chunks), torch.arange(10)))
+
+    def test_as_policy(self):
+        self.assertIsNone(as_policy(None))
+        self.assertEqual(as_policy(torch.bfloat16).default, 'bf16')
+        self.assertEqual(as_policy('native').default, 'native')
+
+    def test_save_file_streaming_applies_policy(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            sf_filename = os.path.join(tmp_dir, 'model.safetensors')
+            weight = torch.randn(8, 8, dtype=torch.bfloat16)
+            save_file_streaming({'q_proj.weight': weight, 'norm.weight': torch.ones(8, dtype=torch.bfloat16)},
+                                sf_filename, dtype='native;*norm*=fp32')
+            loaded = load_file(sf_filename)
+            self.assertTrue(torch.equal(loaded['q_proj.weight'], weight))
+            self.assertEqual(loaded['norm.weight'].dtype, torch.float32)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import torch
+from app.layer_checkpoint import LayerCheckpoint, checkpoint_fingerprint
+
+class TestLayerCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.model_path = os.path.join(self.root, 'model')
+        os.makedirs(self.model_path)
+        for name in ['config.json', 'model.safetensors']:
+            with open(os.path.join(self.model_path, name), 'w') as f:
+                f.write('{}')
+        self.work_dir = os.path.join(self.root, 'work')
+        self.fingerprint = checkpoint_fingerprint(self.model_path, quant_config={'w_bit': 4})
+
+    def layer(self, i):
+        return {'qweight': torch.full((2, 2), i, dtype=torch.int32), 'scales': torch.full((2,), i / 2).half()}
+
+    def test_resume_from_last_completed_layer(self):
+        checkpoint = LayerCheckpoint(self.work_dir, self.fingerprint)
+        self.assertEqual(checkpoint.completed, 0)
+        self.assertFalse(os.path.exists(self.work_dir))
+        for i in range(2):
+            checkpoint.save(i, torch.full((1, 3, 4), float(i + 1)), self.layer(i))
+        with self.assertRaisesRegex(ValueError, 'expects layer 2'):
+            checkpoint.save(3, torch.zeros(1, 3, 4))
+        # Only the inputs of the next layer are kept
+        self.assertEqual(sorted(os.listdir(self.work_dir)),
+                         ['checkpoint.json', 'inputs-00002.safetensors', 'layer-00000.safetensors', 'layer-00001.safetensors'])
+
+        resumed = LayerCheckpoint(self.work_dir, self.fingerprint)
+        self.assertEqual(resumed.completed, 2)
+        torch.testing.assert_close(resumed.load_inputs(), torch.full((1, 3, 4), 2.0))
+        for i in range(2):
+            for name, tensor in self.layer(i).items():
+                torch.testing.assert_close(resumed.load_layer(i)[name], tensor)
+        with self.assertRaisesRegex(ValueError, 'not checkpointed'):
+            resumed.load_layer(2)
+
+        # Layers kept elsewhere are recorded without tensors
+        resumed.save(2, torch.zeros(1, 3, 4))
+        self.assertIsNone(LayerCheckpoint(self.work_dir, self.fingerprint).load_layer(2))
+
+    def test_other_jobs_start_over(self):
+        checkpoint = LayerCheckpoint(self.work_dir, self.fingerprint)
+        checkpoint.save(0, torch.zeros(1, 2, 2), self.layer(0))
+
+        self.assertNotEqual(checkpoint_fingerprint(self.model_path, quant_config={'w_bit': 8}), self.fingerprint)
+        with open(os.path.join(self.model_path, 'model.safetensors'), 'a') as f:
+            f.write('changed')
+        other = LayerCheckpoint(self.work_dir, checkpoint_fingerprint(self.model_path, quant_config={'w_bit': 4}))
+        self.assertEqual(other.completed, 0)
+        self.assertFalse(os.path.exists(self.work_dir))
+
+    def test_incomplete_checkpoint_starts_over(self):
+        checkpoint = LayerCheckpoint(self.work_dir, self.fingerprint)
+        checkpoint.save(0, torch.zeros(1, 2, 2), self.layer(0))
+        os.remove(checkpoint.inputs_path(1))
+        self.assertEqual(LayerCheckpoint(self.work_dir, self.fingerprint).completed, 0)
+
+        os.makedirs(self.work_dir)
+        with open(os.path.join(self.work_dir, 'checkpoint.json'), 'w') as f:
+            f.write('{"fingerprint": ')
+        self.assertEqual(LayerCheckpoint(self.work_dir, self.fingerprint).completed, 0)
+
+        # The manifest is the commit point: a layer killed before its manifest update is done again
+        checkpoint = LayerCheckpoint(self.work_dir, self.fingerprint)
+        checkpoint.save(0, torch.ones(1, 2, 2), self.layer(0))
+        with patch('app.layer_checkpoint.os.replace', side_effect=OSError("killed")):
+            with self.assertRaises(OSError):
+                checkpoint.save(1, torch.zeros(1, 2, 2), self.layer(1))
+        resumed = LayerCheckpoint(self.work_dir, self.fingerprint)
+        self.assertEqual(resumed.completed, 1)
+        torch.testing.assert_close(resumed.load_inputs(), torch.ones(1, 2, 2))
+        with open(os.path.join(self.work_dir, 'checkpoint.json')) as f:
+            self.assertEqual(json.load(f)['completed'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import torch
+from safetensors.torch import save_file
+from app.layer_streaming import LayerShardWriter, StreamedWeights
+from app.safetensors_inspector import inspect_safetensors
+
+class TinyDecoder(torch.nn.Module):
+    """
+    Decoder-shaped module: embeddings, a stack of layers, a norm and an LM head tied to the embeddings.
+    """
+    def __init__(self, num_layers=3, hidden=4, vocab=6):
+        super().__init__()
+        self.embed = torch.nn.Embedding(vocab, hidden)
+        self.layers = torch.nn.ModuleList(torch.nn.Linear(hidden, hidden) for _ in range(num_layers))
+        self.norm = torch.nn.LayerNorm(hidden)
+        self.register_buffer('scale', torch.full((hidden,), 2.0), persistent=False)
+        self.lm_head = torch.nn.Linear(hidden, vocab, bias=False)
+        self.lm_head.weight = self.embed.weight
+
+class TestLayerStreaming(unittest.TestCase):
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.model_path)
+        torch.manual_seed(0)
+        self.reference = TinyDecoder()
+        state_dict = {name: tensor.to(torch.bfloat16) for name, tensor in self.reference.state_dict().items()}
+        del state_dict['lm_head.weight']
+        layer_names = [name for name in state_dict if name.startswith('layers.')]
+        # Resident weights in one shard, the layers in another, the LM head recorded as a tie
+        save_file({name: state_dict[name] for name in state_dict if name not in layer_names},
+                  os.path.join(self.model_path, 'model-00001-of-00002.safetensors'),
+                  metadata={'format': 'pt', 'tied_weights': json.dumps({'lm_head.weight': 'embed.weight'})})
+        save_file({name: state_dict[name] for name in layer_names},
+                  os.path.join(self.model_path, 'model-00002-of-00002.safetensors'), metadata={'format': 'pt'})
+        self.weights = StreamedWeights(self.model_path)
+        with torch.device('meta'):
+            self.model = TinyDecoder()
+
+    def test_layers_are_loaded_one_at_a_time(self):
+        missing = self.weights.materialize(self.model, dtype=torch.float32, skip=['layers.'])
+        self.assertEqual(missing, [])
+        self.assertEqual(self.model.lm_head.weight.dtype, torch.float32)
+        torch.testing.assert_close(self.model.lm_head.weight, self.reference.embed.weight.to(torch.bfloat16).float())
+        self.assertTrue(all(p.is_meta for p in self.model.layers.parameters()))
+
+        self.weights.materialize(self.model.layers[1], 'layers.1.')
+        self.assertEqual(self.model.layers[1].weight.dtype, torch.bfloat16)
+        torch.testing.assert_close(self.model.layers[1].bias, self.reference.layers[1].bias.to(torch.bfloat16))
+        self.assertTrue(self.model.layers[0].weight.is_meta)
+
+        self.model.layers[1] = self.weights.release(self.model.layers[1])
+        self.assertTrue(self.model.layers[1].weight.is_meta)
+        self.assertFalse(self.model.embed.weight.is_meta)
+
+    def test_missing_and_mismatched_weights(self):
+        with torch.device('meta'):
+            model = TinyDecoder(num_layers=4)
+        missing = self.weights.materialize(model, skip=['layers.0', 'layers.1', 'layers.2'])
+        self.assertEqual(missing, ['layers.3.weight', 'layers.3.bias'])
+
+        with torch.device('meta'):
+            wide = torch.nn.Linear(8, 4)
+        with self.assertRaisesRegex(ValueError, 'shape'):
+            self.weights.materialize(wide, 'layers.0.')
+
+    def test_writer_shards_by_layer(self):
+        output_dir = os.path.join(self.model_path, 'out')
+        writer = LayerShardWriter(output_dir, num_layers=3)
+        self.assertEqual(writer.layer_shard(0), 'model-00002-of-00004.safetensors')
+
+        self.weights.materialize(self.model, skip=['layers.'])
+        self.model.lm_head.weight = self.model.embed.weight
+        writer.write(writer.shard_name(1), {name: tensor for name, tensor in self.model.state_dict().items()
+                                            if not name.startswith('layers.')})
+        for i in range(2):
+            self.weights.materialize(self.model.layers[i], f'layers.{i}.')
+            writer.write(writer.layer_shard(i), {f'layers.{i}.{name}': tensor
+                                                 for name, tensor in self.model.layers[i].state_dict().items()})
+        with self.assertRaisesRegex(FileNotFoundError, 'model-00004-of-00004'):
+            writer.finish()
+
+        self.weights.materialize(self.model.layers[2], 'layers.2.')
+        writer.write(writer.layer_shard(2), {f'layers.2.{name}': tensor
+                                             for name, tensor in self.model.layers[2].state_dict().items()})
+        writer.finish()
+        report = inspect_safetensors(output_dir)
+        self.assertTrue(report.ok, report.problems)
+        # The tied LM head is stored once
+        self.assertIn('embed.weight', report.tensors)
+        self.assertNotIn('lm_head.weight', report.tensors)
+        self.assertEqual(len(report.tensors), 3 + 3 * 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from app.memory_planner import GB, ModelShape, estimate_memory, plan_execution, plan_quantization
+from app.safetensors_inspector import SafetensorsReport, TensorInfo
+
+LLAMA_7B = {
+    'architectures': ['LlamaForCausalLM'], 'hidden_size': 4096, 'intermediate_size': 11008,
+    'num_attention_heads': 32, 'num_hidden_layers': 32, 'num_key_value_heads': 32, 'vocab_size': 32000,
+    'tie_word_embeddings': False, 'torch_dtype': 'float16',
+}
+
+class TestModelShape(unittest.TestCase):
+    def test_llama_parameter_count(self):
+        shape = ModelShape.from_config(LLAMA_7B)
+        self.assertEqual(shape.num_layers * shape.layer_params + shape.resident_params, 6738415616)
+
+    def test_other_config_styles(self):
+        gpt2 = ModelShape.from_config({'n_embd': 768, 'n_layer': 12, 'n_head': 12, 'vocab_size': 50257,
+                                       'tie_word_embeddings': True})
+        self.assertEqual((gpt2.num_layers, gpt2.hidden_size, gpt2.intermediate_size), (12, 768, 3072))
+        self.assertEqual(gpt2.resident_params, 50257 * 768 + 768)
+
+        grouped = ModelShape.from_config({'text_config': dict(LLAMA_7B, num_key_value_heads=8)})
+        self.assertEqual(grouped.layer_params, 2 * 4096 * 4096 + 2 * 4096 * 1024 + 3 * 4096 * 11008 + 2 * 4096)
+
+        with self.assertRaisesRegex(ValueError, 'num_hidden_layers'):
+            ModelShape.from_config({'hidden_size': 8, 'num_attention_heads': 1, 'vocab_size': 10})
+
+class TestMemoryPlanner(unittest.TestCase):
+    def test_estimate_from_shard_headers(self):
+        config = {'hidden_size': 4, 'intermediate_size': 8, 'num_attention_heads': 1, 'num_hidden_layers': 2,
+                  'vocab_size': 10}
+        report = SafetensorsReport(['a.safetensors', 'b.safetensors'], {
+            'model.embed_tokens.weight': TensorInfo('a.safetensors', 'BF16', (10, 4), 80),
+            'model.layers.0.mlp.up_proj.weight': TensorInfo('a.safetensors', 'BF16', (8, 4), 64),
+            'model.layers.1.mlp.up_proj.weight': TensorInfo('b.safetensors', 'BF16', (8, 4), 64),
+            'model.layers.1.mlp.down_proj.weight': TensorInfo('b.safetensors', 'BF16', (4, 8), 64),
+            'model.layers.1.self_attn.rotary_emb.inv_freq': TensorInfo('b.safetensors', 'I64', (2,), 16),
+        }, [])
+        # Loaded in float32 on CPU: floating point weights double, integer buffers keep their size
+        estimate = estimate_memory(config, report, load_itemsize=4, n_samples=2, seqlen=3)
+        self.assertEqual(estimate.resident_bytes, 160)
+        self.assertEqual(estimate.layer_bytes, 128 + 128 + 16)
+        self.assertEqual(estimate.model_bytes, 160 + 128 + 272)
+        self.assertEqual(estimate.largest_shard_bytes, 288)
+        self.assertEqual(estimate.activation_bytes, 6 * (5 * 4 + 8) * 4)
+
+    def test_gpu_plans_by_device_size(self):
+        estimate = estimate_memory(LLAMA_7B)
+        plan = plan_execution(estimate, host_bytes=64 * GB, device_bytes=80 * GB)
+        self.assertEqual((plan.mode, plan.device), ('full', 'cuda'))
+        self.assertLess(plan.host_peak_bytes, 14 * GB)
+
+        plan = plan_execution(estimate, host_bytes=64 * GB, device_bytes=16 * GB)
+        self.assertEqual(plan.mode, 'offload')
+        self.assertEqual(plan.max_memory, {0: 16 * GB - estimate.layer_working_set, 'cpu': 64 * GB})
+        self.assertLess(plan.max_memory[0], estimate.model_bytes)
+
+        # No room for a layer's working set next to the embeddings
+        plan = plan_execution(estimate, host_bytes=64 * GB, device_bytes=4 * GB)
+        self.assertEqual(plan.mode, 'stream')
+        self.assertFalse(plan.fits)
+
+        # The headroom tips a borderline device into offloading
+        needed = estimate.model_bytes + estimate.layer_working_set
+        self.assertEqual(plan_execution(estimate, 64 * GB, needed).mode, 'full')
+        self.assertEqual(plan_execution(estimate, 64 * GB, needed, headroom=GB).mode, 'offload')
+
+    def test_cpu_plans_by_host_size(self):
+        estimate = estimate_memory(LLAMA_7B, load_itemsize=4)
+        plan = plan_execution(estimate, host_bytes=64 * GB)
+        self.assertEqual((plan.mode, plan.device, plan.device_peak_bytes), ('full', 'cpu', 0))
+
+        plan = plan_execution(estimate, host_bytes=16 * GB)
+        self.assertEqual(plan.mode, 'stream')
+        self.assertTrue(plan.fits)
+        self.assertLess(plan.host_peak_bytes, 16 * GB)
+
+    def test_plan_quantization_without_shards_uses_config(self):
+        model_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, model_path)
+        with open(os.path.join(model_path, 'config.json'), 'w') as f:
+            json.dump(LLAMA_7B, f)
+        plan = plan_quantization(model_path, host_bytes=64 * GB)
+        self.assertEqual(plan.estimate, estimate_memory(LLAMA_7B, load_itemsize=4))
+        self.assertEqual(plan.mode, 'full')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import torch
+from safetensors.torch import save_file
+# Importing app puts the repository root, and with it common/, on the path
+import app
+from common.model_store import ModelStore, link_or_copy
+from app.safetensors_io import write_safetensors_index
+
+class TestModelStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.store = ModelStore(os.path.join(self.root, 'store'))
+        self.addCleanup(self.store.close)
+
+    def make_snapshot(self, name, files):
+        directory = os.path.join(self.root, name)
+        for relative, data in files.items():
+            path = os.path.join(directory, relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        return directory
+
+    @patch('common.model_store.LINK_THRESHOLD', 1024)
+    def test_ingest_and_materialize_share_blobs(self):
+        weights = os.urandom(4096)
+        first = self.make_snapshot('first', {'config.json': b'{}', 'model.safetensors': weights,
+                                             '.cache/huggingface/download/model.safetensors.metadata': b'etag'})
+        manifest = self.store.ingest('author/model', 'abc', first)
+        self.assertEqual(manifest, {'config.json': hashlib.sha256(b'{}').hexdigest(),
+                                    'model.safetensors': hashlib.sha256(weights).hexdigest()})
+        blob = self.store.blob_path(manifest['model.safetensors'])
+        self.assertTrue(os.path.samefile(blob, os.path.join(first, 'model.safetensors')))
+        # Blobs cannot be rewritten through a working directory
+        self.assertEqual(os.stat(blob).st_mode & 0o777, 0o444)
+
+        # The same weights under another repository are stored once
+        second = self.make_snapshot('second', {'model.safetensors': weights})
+        self.store.ingest('other/model', 'def', second)
+        self.assertTrue(os.path.samefile(blob, os.path.join(second, 'model.safetensors')))
+        self.assertEqual(self.store.size(), 4096 + 2)
+
+        target = os.path.join(self.root, 'work')
+        self.assertTrue(self.store.materialize('author/model', 'abc', target))
+        self.assertEqual(sorted(os.listdir(target)), ['config.json', 'model.safetensors'])
+        self.assertTrue(os.path.samefile(blob, os.path.join(target, 'model.safetensors')))
+        # Without a revision the latest stored snapshot is used
+        self.assertTrue(self.store.materialize('other/model', None, os.path.join(self.root, 'work2')))
+        self.assertFalse(self.store.materialize('author/model', 'unknown', os.path.join(self.root, 'work3')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'work3')))
+
+    @patch('common.model_store.LINK_THRESHOLD', 1024)
+    def test_small_files_are_not_hardlinked(self):
+        config = b'{"architectures": ["LlamaForCausalLM"]}'
+        index = b'{"weight_map": {}}'
+        first = self.make_snapshot('first', {'config.json': config, 'model.safetensors.index.json': index})
+        save_file({'weight': torch.ones(1024)}, os.path.join(first, 'model.safetensors'))
+        manifest = self.store.ingest('author/model', 'abc', first)
+        target = os.path.join(self.root, 'work')
+        self.assertTrue(self.store.materialize('author/model', 'abc', target))
+        for directory in (first, target):
+            self.assertFalse(os.path.samefile(self.store.blob_path(manifest['config.json']),
+                                              os.path.join(directory, 'config.json')))
+
+        # Tools rewriting small files in place, even as root, leave the stored copies intact
+        with open(os.path.join(target, 'config.json'), 'w') as f:
+            f.write('{}')
+        write_safetensors_index(target, ['model.safetensors'])
+        for relative, data in (('config.json', config), ('model.safetensors.index.json', index)):
+            with open(self.store.blob_path(manifest[relative]), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_falls_back_to_copy_across_file_systems(self):
+        src = self.make_snapshot('src', {'a': b'data'})
+        with patch('common.model_store.os.link', side_effect=OSError(18, 'Invalid cross-device link')), \
+                patch('common.model_store.fcntl.ioctl', side_effect=OSError(95, 'Operation not supported')):
+            self.assertEqual(link_or_copy(os.path.join(src, 'a'), os.path.join(src, 'b')), 'copy')
+        with open(os.path.join(src, 'b'), 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_eviction_drops_least_recently_used_snapshots(self):
+        shared = os.urandom(1000)
+        for i, name in enumerate(['a/one', 'b/two', 'c/three']):
+            self.store.ingest(name, 'main', self.make_snapshot(name, {'shared.bin': shared, 'own.bin': os.urandom(1000 + i)}))
+        # Using a/one makes b/two the least recently used
+        self.assertTrue(self.store.materialize('a/one', 'main', os.path.join(self.root, 'work')))
+        self.assertEqual(self.store.size(), 1000 + 1000 + 1001 + 1002)
+
+        self.store.budget = 3500
+        freed = self.store.evict(keep=('c/three', 'main'))
+        self.assertEqual(freed, 1001)
+        self.assertIsNone(self.store.manifest('b/two', 'main'))
+        self.assertIsNotNone(self.store.manifest('a/one', 'main'))
+        # The blob shared with the remaining snapshots stays
+        self.assertTrue(os.path.exists(self.store.blob_path(hashlib.sha256(shared).hexdigest())))
+        # The evicted snapshot's working directory keeps its files through the hardlinks
+        with open(os.path.join(self.root, 'b/two', 'own.bin'), 'rb') as f:
+            self.assertEqual(len(f.read()), 1001)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,19 @@
+import fnmatch
+import hashlib
+import json
+import os
+import struct
+import shutil
+import tempfile
 import unittest
+from types import SimpleNamespace
 from unittest.mock import patch, MagicMock
 from app.model_utils import authenticate_huggingface, download_model, check_model_files, find_file, get_model_size, validate_model_checksum, calculate_directory_checksum
+from app.checksum_cache import ChecksumCache
+from app.config import Config
+from app.model_index import ModelDirIndex
+from app.model_utils import calculate_directory_manifest, hash_file, manifest_root, save_checksum_manifest, fetch_lfs_checksums
+from app.model_utils import plan_download
 
 class TestModelUtils(unittest.TestCase):
     @patch('app.model_utils.login')
@@ -27,8 +40,10 @@ class TestModelUtils(unittest.TestCase):
         result = authenticate_huggingface()
         self.assertIsNone(result)
 
+    @patch.object(Config, 'MODEL_STORE_DIR', '')
+    @patch('app.model_utils.fetch_lfs_checksums', return_value={})
     @patch('app.model_utils.snapshot_download')
-    def test_download_model(self, mock_snapshot_download):
+    def test_download_model(self, mock_snapshot_download, mock_fetch_lfs_checksums):
         mock_snapshot_download.return_value = '/path/to/model'
         result = download_model('author', 'model')
         self.assertEqual(result, '/path/to/model')
@@ -38,23 +53,6 @@ class TestModelUtils(unittest.TestCase):
         with self.assertRaises(Exception):
             download_model('author', 'model')
 
-    @patch('app.model_utils.find_file')
-    def test_check_model_files(self, mock_find_file):
-        # Test when all required files are found (single file model)
-        mock_find_file.side_effect = [True, True, True, False, False]
-        self.assertTrue(check_model_files('/path/to/model'))
-
-        # Test when all required files are found (sharded safetensors model)
-        mock_find_file.side_effect = [True, True, False, True, False]
-        self.assertTrue(check_model_files('/path/to/model'))
-
-        # Test when all required files are found (sharded PyTorch model)
-        mock_find_file.side_effect = [True, True, False, False, True]
-        self.assertTrue(check_model_files('/path/to/model'))
-
-        # Test when a required file is missing
-        mock_find_file.side_effect = [True, False, False, False, False]
-        self.assertFalse(check_model_files('/path/to/model'))
 
     @patch('os.path.exists')
     @patch('os.walk')
@@ -68,17 +66,6 @@ class TestModelUtils(unittest.TestCase):
         result = find_file('/path/to/model', 'file.txt')
         self.assertEqual(result, '')
 
-    @patch('os.walk')
-    @patch('os.path.getsize')
-    def test_get_model_size(self, mock_getsize, mock_walk):
-        mock_walk.return_value = [
-            ('/path/to/model', [], ['file1.txt', 'file2.txt']),
-            ('/path/to/model/subdir', [], ['file3.txt'])
-        ]
-        mock_getsize.side_effect = [1024 * 1024, 2 * 1024 * 1024, 3 * 1024 * 1024]
-        result = get_model_size('/path/to/model')
-        self.assertEqual(result, 6 * 1024 * 1024)
-
     @patch('app.model_utils.calculate_directory_checksum')
     def test_validate_model_checksum(self, mock_calculate_checksum):
         mock_calculate_checksum.return_value = 'test_checksum'
@@ -109,16 +96,7 @@ class TestModelUtils(unittest.TestCase):
         result = calculate_directory_checksum('/path/to/model')
         self.assertEqual(result, 'test_checksum')
 
-    @patch('app.model_utils.find_file')
-    def test_check_model_files_missing_config(self, mock_find_file):
-        mock_find_file.side_effect = [False, True, True, False, False]
-        self.assertFalse(check_model_files('/path/to/model'))
-
-    @patch('app.model_utils.find_file')
-    def test_check_model_files_missing_tokenizer(self, mock_find_file):
-        mock_find_file.side_effect = [True, False, False, False, False]
-        self.assertFalse(check_model_files('/path/to/model'))
-
+    @patch.object(Config, 'MODEL_STORE_DIR', '')
     @patch('app.model_utils.snapshot_download')
     def test_download_model_network_error(self, mock_snapshot_download):
         mock_snapshot_download.side_effect = ConnectionError("Network error")
@@ -132,13 +110,6 @@ class TestModelUtils(unittest.TestCase):
         result = find_file('/path/to/model', 'nonexistent.txt')
         self.assertEqual(result, '')
 
-    @patch('os.walk')
-    @patch('os.path.getsize')
-    def test_get_model_size_empty_directory(self, mock_getsize, mock_walk):
-        mock_walk.return_value = []
-        result = get_model_size('/path/to/empty/model')
-        self.assertEqual(result, 0)
-
     @patch('os.walk')
     @patch('builtins.open', new_callable=unittest.mock.mock_open, read_data=b'test data')
     @patch('hashlib.sha256')
@@ -147,19 +118,16 @@ class TestModelUtils(unittest.TestCase):
         result = calculate_directory_checksum('/path/to/empty/model')
         self.assertIsNotNone(result) 
 
+    @patch.object(Config, 'MODEL_STORE_DIR', '')
+    @patch('app.model_utils.fetch_lfs_checksums', return_value={})
     @patch('app.model_utils.snapshot_download')
     @patch('app.model_utils.validate_model_checksum')
-    def test_download_model_with_expected_checksum(self, mock_validate, mock_snapshot_download):
+    def test_download_model_with_expected_checksum(self, mock_validate, mock_snapshot_download, mock_fetch_lfs_checksums):
         mock_snapshot_download.return_value = '/path/to/model'
         mock_validate.return_value = True
         result = download_model('author', 'model', expected_checksum='test_checksum')
         self.assertEqual(result, '/path/to/model')
 
-    @patch('app.model_utils.find_file')
-    def test_check_model_files_no_valid_weights(self, mock_find_file):
-        mock_find_file.side_effect = [True, True, False, False, False, False]
-        self.assertFalse(check_model_files('/path/to/model'))
-
     @patch('os.walk')
     @patch('builtins.open', new_callable=unittest.mock.mock_open)
     @patch('hashlib.sha256')
@@ -170,5 +138,303 @@ class TestModelUtils(unittest.TestCase):
         result = calculate_directory_checksum('/path/to/model')
         self.assertEqual(result, 'error_checksum')
 
+class TestModelDirIndex(unittest.TestCase):
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.model_path)
+
+    def write(self, relative_path, size=1):
+        path = os.path.join(self.model_path, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def write_safetensors(self, relative_path, names=('weight',)):
+        header = {name: {'dtype': 'F16', 'shape': [2], 'data_offsets': [4 * i, 4 * i + 4]} for i, name in enumerate(names)}
+        header_bytes = json.dumps(header).encode()
+        path = self.write(relative_path, size=0)
+        with open(path, 'wb') as f:
+            f.write(struct.pack('<Q', len(header_bytes)) + header_bytes + b'\0' * (4 * len(names)))
+        return path
+
+    def test_check_model_files(self):
+        self.write('config.json')
+        self.write('tokenizer.json')
+        # No weights yet
+        self.assertFalse(check_model_files(self.model_path))
+
+        def write_sharded_safetensors(weights):
+            self.write_safetensors('model-00001-of-00001.safetensors')
+            with open(os.path.join(self.model_path, weights), 'w') as f:
+                json.dump({'weight_map': {'weight': 'model-00001-of-00001.safetensors'}}, f)
+
+        for weights, expected, write in [('pytorch_model.bin.index.json', 'sharded-bin', self.write),
+                                         ('model.safetensors.index.json', 'sharded-safetensors', write_sharded_safetensors),
+                                         ('model.safetensors', 'safetensors', self.write_safetensors),
+                                         ('pytorch_model.bin', 'bin', self.write)]:
+            write(weights)
+            index = ModelDirIndex(self.model_path)
+            self.assertEqual(index.weights_format, expected)
+            self.assertTrue(check_model_files(self.model_path, index))
+
+    def test_check_model_files_missing_config(self):
+        self.write('tokenizer.json')
+        self.write('model.safetensors')
+        self.assertFalse(check_model_files(self.model_path))
+
+    def test_check_model_files_missing_tokenizer(self):
+        self.write('config.json')
+        self.write_safetensors('model.safetensors')
+        self.assertFalse(check_model_files(self.model_path))
+        self.write('nested/tokenizer.model')
+        self.assertTrue(check_model_files(self.model_path))
+
+    def test_index_matches_find_file_and_resolves_symlinks(self):
+        blob = self.write('.cache/blobs/abc123', size=10)
+        os.symlink(blob, os.path.join(self.model_path, 'model.safetensors'))
+        self.write('config.json', size=5)
+        self.write('sub/dir/tokenizer.json', size=7)
+
+        index = ModelDirIndex(self.model_path)
+        for name in ['model.safetensors', 'config.json', 'tokenizer.json', 'abc123', 'missing.json']:
+            self.assertEqual(index.find(name), find_file(self.model_path, name))
+        self.assertEqual(index.find('model.safetensors'), os.path.realpath(blob))
+        self.assertTrue(index.has('sub/dir/tokenizer.json'))
+        self.assertFalse(index.has('tokenizer.json'))
+        self.assertEqual(index.top_level('.safetensors'), ['model.safetensors'])
+        self.assertTrue(index.has_safetensors_weights)
+
+    def test_get_model_size(self):
+        self.write('model.safetensors', size=1024)
+        self.write('subdir/file.txt', size=2048)
+        self.assertEqual(get_model_size(self.model_path), 3072)
+        self.assertEqual(get_model_size(self.model_path, ModelDirIndex(self.model_path)), 3072)
+
+    def test_get_model_size_empty_directory(self):
+        self.assertEqual(get_model_size(self.model_path), 0)
+
+class TestDirectoryChecksum(unittest.TestCase):
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+        self.files = {'config.json': b'{}', 'model.safetensors': os.urandom(3000), 'tokenizer.json': b'tok'}
+        for name, data in self.files.items():
+            with open(os.path.join(self.model_path, name), 'wb') as f:
+                f.write(data)
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.cache_path = os.path.join(cache_dir, 'checksums.sqlite')
+        patcher = patch.object(Config, 'CHECKSUM_CACHE_PATH', self.cache_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.model_path)
+
+    def test_root_matches_previous_checksum_for_flat_directory(self):
+        previous = hashlib.sha256("".join(hashlib.sha256(self.files[name]).hexdigest()
+                                          for name in sorted(self.files)).encode()).hexdigest()
+        self.assertEqual(calculate_directory_checksum(self.model_path), previous)
+        manifest = calculate_directory_manifest(self.model_path, workers=2)
+        self.assertEqual(list(manifest), sorted(self.files))
+        self.assertEqual(manifest_root(manifest), previous)
+
+    def test_hash_file_streams_in_chunks(self):
+        path = os.path.join(self.model_path, 'model.safetensors')
+        self.assertEqual(hash_file(path, chunk_size=7), hashlib.sha256(self.files['model.safetensors']).hexdigest())
+
+    def test_manifest_names_the_corrupt_file(self):
+        manifest_path = os.path.join(tempfile.mkdtemp(), 'model.checksums.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(manifest_path))
+        root = save_checksum_manifest(self.model_path, manifest_path)
+        self.assertTrue(validate_model_checksum(self.model_path, manifest_path))
+        self.assertTrue(validate_model_checksum(self.model_path, root))
+
+        with open(os.path.join(self.model_path, 'model.safetensors'), 'r+b') as f:
+            f.write(b'\0')
+        with self.assertLogs('app.model_utils', level='WARNING') as logs:
+            self.assertFalse(validate_model_checksum(self.model_path, manifest_path))
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('model.safetensors has sha256', logs.output[0])
+
+    def test_cache_rehashes_only_changed_files(self):
+        expected = calculate_directory_checksum(self.model_path)
+        with ChecksumCache(self.cache_path) as cache, patch('app.model_utils.hash_file', wraps=hash_file) as mock_hash:
+            self.assertEqual(calculate_directory_checksum(self.model_path, cache=cache), expected)
+            self.assertEqual(mock_hash.call_count, 3)
+
+            mock_hash.reset_mock()
+            self.assertEqual(calculate_directory_checksum(self.model_path, cache=cache), expected)
+            mock_hash.assert_not_called()
+
+            with open(os.path.join(self.model_path, 'tokenizer.json'), 'ab') as f:
+                f.write(b'!')
+            changed = calculate_directory_checksum(self.model_path, cache=cache)
+            self.assertNotEqual(changed, expected)
+            self.assertEqual([c.args[0] for c in mock_hash.call_args_list], [os.path.join(self.model_path, 'tokenizer.json')])
+
+        # The cache outlives the connection
+        with patch('app.model_utils.hash_file') as mock_hash:
+            self.assertTrue(validate_model_checksum(self.model_path, changed))
+            mock_hash.assert_not_called()
+
+    def test_unusable_cache_falls_back_to_hashing(self):
+        expected = calculate_directory_checksum(self.model_path)
+        # The cache directory cannot be created, even as root, below a regular file
+        blocker = os.path.join(os.path.dirname(self.cache_path), 'not-a-directory')
+        with open(blocker, 'w'):
+            pass
+        with ChecksumCache(os.path.join(blocker, 'checksums.sqlite')) as cache, \
+                self.assertLogs('app.checksum_cache', level='WARNING') as logs:
+            self.assertEqual(calculate_directory_checksum(self.model_path, cache=cache), expected)
+            self.assertEqual(calculate_directory_checksum(self.model_path, cache=cache), expected)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('hashing without it', logs.output[0])
+
+class FakeHub:
+    """
+    Stand-in for the Hub: serves repo files from a dict and their LFS metadata like HfApi.model_info.
+    """
+    def __init__(self, files):
+        self.files = files
+        self.downloads = []
+        self.ranged = []
+
+    def model_info(self, repo_id, files_metadata=False):
+        return SimpleNamespace(sha='0123abcd', siblings=[
+            SimpleNamespace(rfilename=name, size=len(data),
+                            lfs={'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data)}
+                            if name.endswith(('.safetensors', '.bin', '.pth')) else None)
+            for name, data in self.files.items()
+        ])
+
+    def write(self, local_dir, filename, data):
+        path = os.path.join(local_dir, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def snapshot_download(self, repo_id, local_dir, revision=None, allow_patterns=None, ignore_patterns=None):
+        for name, data in self.files.items():
+            if allow_patterns is not None and not any(fnmatch.fnmatch(name, pattern) for pattern in allow_patterns):
+                continue
+            if ignore_patterns is not None and any(fnmatch.fnmatch(name, pattern) for pattern in ignore_patterns):
+                continue
+            # The first shard arrives truncated
+            self.write(local_dir, name, data[:-1] if name == 'model-00001-of-00002.safetensors' else data)
+        return local_dir
+
+    def hf_hub_download(self, repo_id, filename, local_dir, revision=None, force_download=False):
+        self.downloads.append(filename)
+        self.write(local_dir, filename, self.files[filename])
+        return os.path.join(local_dir, filename)
+
+    def download_file(self, url, dest, size=None, **kwargs):
+        # hf_hub_url is patched to return the file name
+        self.ranged.append(url)
+        self.write(os.path.dirname(dest), os.path.basename(dest), self.files[url])
+        return dest
+
+class TestDownloadVerification(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.hub = FakeHub({
+            'config.json': b'{}',
+            'model-00001-of-00002.safetensors': os.urandom(5000),
+            'model-00002-of-00002.safetensors': os.urandom(5000),
+        })
+        for target, value in [('snapshot_download', self.hub.snapshot_download), ('hf_hub_download', self.hub.hf_hub_download)]:
+            patcher = patch(f'app.model_utils.{target}', side_effect=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name, value in [('DATA_DIR', self.data_dir), ('MODEL_STORE_DIR', os.path.join(self.data_dir, 'store'))]:
+            patcher = patch.object(Config, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_fetch_lfs_checksums_lists_only_lfs_files(self):
+        checksums = fetch_lfs_checksums('author/model', api=self.hub)
+        self.assertEqual(sorted(checksums), ['model-00001-of-00002.safetensors', 'model-00002-of-00002.safetensors'])
+
+    def test_plan_download_picks_one_weight_format(self):
+        files = {
+            'config.json': 10, 'tokenizer.json': 20, 'training_args.bin': 5,
+            'model-00001-of-00002.safetensors': 1000, 'model-00002-of-00002.safetensors': 1000,
+            'model.safetensors.index.json': 30,
+            'pytorch_model-00001-of-00002.bin': 1000, 'pytorch_model-00002-of-00002.bin': 1000,
+            'pytorch_model.bin.index.json': 30, 'consolidated.safetensors': 2000, 'tf_model.h5': 2000,
+            'original/consolidated.00.pth': 2000, 'original/params.json': 1,
+        }
+        plan = plan_download(files)
+        self.assertEqual(plan.weights_format, 'safetensors')
+        self.assertEqual(plan.skipped, ['consolidated.safetensors', 'original/consolidated.00.pth',
+                                        'pytorch_model-00001-of-00002.bin', 'pytorch_model-00002-of-00002.bin',
+                                        'pytorch_model.bin.index.json', 'tf_model.h5', 'training_args.bin'])
+        self.assertEqual(plan.download_bytes, 2061)
+        self.assertEqual(plan.saved_bytes, 8035)
+
+        bin_only = {name: size for name, size in files.items() if 'safetensors' not in name}
+        plan = plan_download(bin_only)
+        self.assertEqual(plan.weights_format, 'bin')
+        self.assertIn('pytorch_model.bin.index.json', plan.allow_patterns)
+        self.assertIsNone(plan_download({'config.json': 10, 'model.gguf': 1000}))
+
+    def test_selective_download_fetches_only_chosen_format(self):
+        self.hub.files.update({'pytorch_model.bin': os.urandom(3000), 'original/consolidated.00.pth': os.urandom(3000),
+                               'original/params.json': b'{}'})
+        with self.assertLogs('app.model_utils', level='INFO') as logs:
+            model_path = download_model('author', 'model', api=self.hub)
+        self.assertEqual(sorted(os.path.relpath(os.path.join(root, f), model_path) for root, _, files in os.walk(model_path) for f in files),
+                         ['config.json', 'model-00001-of-00002.safetensors', 'model-00002-of-00002.safetensors',
+                          'original/params.json'])
+        self.assertTrue(any('saving 0.00 GB' in line and 'skipping 2 files' in line for line in logs.output))
+        # Skipped LFS files are not reported missing and re-fetched
+        self.assertEqual(self.hub.downloads, ['model-00001-of-00002.safetensors'])
+
+    def test_corrupt_shard_is_fetched_again(self):
+        model_path = download_model('author', 'model', api=self.hub)
+        self.assertEqual(self.hub.downloads, ['model-00001-of-00002.safetensors'])
+        with open(os.path.join(model_path, 'model-00001-of-00002.safetensors'), 'rb') as f:
+            self.assertEqual(f.read(), self.hub.files['model-00001-of-00002.safetensors'])
+
+    def test_unlisted_repo_skips_lfs_verification(self):
+        with patch.object(self.hub, 'model_info', side_effect=OSError("Hub unavailable")), \
+                self.assertLogs('app.model_utils', level='WARNING') as logs:
+            model_path = download_model('author', 'model', api=self.hub)
+        self.assertTrue(os.path.exists(os.path.join(model_path, 'model-00002-of-00002.safetensors')))
+        self.assertEqual(self.hub.downloads, [])
+        self.assertTrue(any('Skipping LFS verification' in line for line in logs.output))
+
+    @patch('common.model_store.LINK_THRESHOLD', 100)
+    def test_stored_model_is_linked_instead_of_downloaded(self):
+        first = download_model('author', 'model', api=self.hub)
+        with patch('app.model_utils.snapshot_download') as mock_snapshot_download:
+            second = download_model('author', 'model', api=self.hub, data_dir=os.path.join(self.data_dir, 'scratch'))
+            mock_snapshot_download.assert_not_called()
+        self.assertNotEqual(first, second)
+        for name, data in self.hub.files.items():
+            # Only the weights are hardlinked; small files are separate copies
+            self.assertEqual(os.path.samefile(os.path.join(first, name), os.path.join(second, name)), len(data) >= 100)
+            with open(os.path.join(second, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_large_files_use_range_downloads(self):
+        with patch.object(Config, 'RANGE_DOWNLOAD_MIN_MB', 4000 / 1024 ** 2), \
+                patch('app.model_utils.hf_hub_url', side_effect=lambda repo_id, filename, revision=None: filename), \
+                patch('app.model_utils.download_file', side_effect=self.hub.download_file):
+            model_path = download_model('author', 'model', api=self.hub)
+        self.assertEqual(self.hub.ranged, ['model-00001-of-00002.safetensors', 'model-00002-of-00002.safetensors'])
+        # snapshot_download skipped the large files, so the truncated shard never arrived
+        self.assertEqual(self.hub.downloads, [])
+        with open(os.path.join(model_path, 'model-00001-of-00002.safetensors'), 'rb') as f:
+            self.assertEqual(f.read(), self.hub.files['model-00001-of-00002.safetensors'])
+
+    def test_persistent_corruption_fails_the_download(self):
+        with patch('app.model_utils.hf_hub_download'):
+            with self.assertRaisesRegex(ValueError, 'model-00001-of-00002.safetensors'):
+                download_model('author', 'model', api=self.hub)
+
 if __name__ == '__main__':
     unittest.main()
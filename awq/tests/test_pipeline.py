@@ -0,0 +1,69 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+import torch
+from app.dtype_policy import iter_chunks
+from app.pipeline import run_pipeline
+from app.safetensors_io import save_file_streaming
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.model_path)
+
+    def test_run_pipeline_keeps_order_across_threads(self):
+        threads = set()
+        def transform(x):
+            threads.add(threading.current_thread().name)
+            return x * 2
+
+        for depth in [0, 1, 4]:
+            consumed = []
+            run_pipeline(iter(range(100)), transform, consumed.append, depth)
+            self.assertEqual(consumed, [x * 2 for x in range(100)])
+        self.assertIn('pipeline-cast', threads)
+
+    def test_run_pipeline_reraises_stage_errors(self):
+        def failing_source():
+            yield 1
+            raise OSError("read failed")
+
+        with self.assertRaisesRegex(OSError, "read failed"):
+            run_pipeline(failing_source(), lambda x: x, lambda x: None, depth=2)
+        with self.assertRaisesRegex(ValueError, "cast failed"):
+            run_pipeline(iter(range(10)), lambda x: (_ for _ in ()).throw(ValueError("cast failed")), lambda x: None)
+
+        def failing_sink(x):
+            raise IOError("disk full")
+        # The reader would block on a full queue forever if a failing writer did not stop it
+        with self.assertRaisesRegex(IOError, "disk full"):
+            run_pipeline(iter(range(1000)), lambda x: x, failing_sink, depth=1)
+        self.assertEqual([t.name for t in threading.enumerate() if t.name.startswith('pipeline-')], [])
+
+    def test_pipelined_write_matches_serial_write(self):
+        tensors = {
+            'a': torch.randn(300, 70),
+            'b': torch.randn(50, dtype=torch.bfloat16),
+            'c': torch.arange(20),
+            'd': torch.randn(40, 30).t(),
+        }
+        digests = []
+        # Small chunks so every tensor spans several pipeline items
+        with patch.object(iter_chunks, '__defaults__', (1000,)):
+            for depth in [0, 3]:
+                hasher = hashlib.sha256()
+                filename = os.path.join(self.model_path, f'{depth}.safetensors')
+                save_file_streaming(tensors, filename, dtype='fp16', hasher=hasher, pipeline_depth=depth)
+                with open(filename, 'rb') as f:
+                    self.assertEqual(hashlib.sha256(f.read()).hexdigest(), hasher.hexdigest())
+                digests.append(hasher.hexdigest())
+        self.assertEqual(digests[0], digests[1])
+
+if __name__ == '__main__':
+    unittest.main()
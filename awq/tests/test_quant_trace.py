@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import numpy as np
+from app.quant_trace import QuantTrace, read_rss, reset_rss_peak, trace_span
+
+MB = 1024 * 1024
+
+class TestQuantTrace(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.jsonl_path = os.path.join(self.root, 'traces', 'job.jsonl')
+        self.chrome_path = os.path.join(self.root, 'traces', 'job.trace.json')
+
+    def read_jsonl(self):
+        with open(self.jsonl_path) as f:
+            return [json.loads(line) for line in f]
+
+    @patch('torch.cuda.is_available', return_value=False)
+    def test_nested_spans(self, mock_cuda_available):
+        trace = QuantTrace(self.jsonl_path, self.chrome_path, metadata={'model_path': '/models/tiny'})
+        with trace.span('quantize'):
+            for i in range(2):
+                with trace.span('layer', 'layer', layer=i):
+                    with trace.span('scale_search', layer=i):
+                        sum(range(10000))
+        with self.assertRaises(KeyError):
+            with trace_span(trace, 'save'):
+                raise KeyError('qweight')
+        with trace_span(None, 'not traced'):
+            pass
+
+        # Spans are written as they end, before close
+        meta, *spans = self.read_jsonl()
+        self.assertEqual(meta['type'], 'meta')
+        self.assertEqual(meta['model_path'], '/models/tiny')
+        self.assertEqual([(span['name'], span['depth'], span['args']) for span in spans], [
+            ('scale_search', 2, {'layer': 0}), ('layer', 1, {'layer': 0}),
+            ('scale_search', 2, {'layer': 1}), ('layer', 1, {'layer': 1}),
+            ('quantize', 0, {}), ('save', 0, {}),
+        ])
+        self.assertEqual(spans[1]['category'], 'layer')
+        self.assertEqual(spans[-1]['error'], 'KeyError')
+        self.assertNotIn('error', spans[-2])
+        quantize = spans[4]
+        self.assertGreaterEqual(quantize['wall_s'], spans[1]['wall_s'] + spans[3]['wall_s'])
+        for span in spans:
+            self.assertGreaterEqual(span['cpu_s'], 0)
+            self.assertGreaterEqual(span['rss_peak'], span['rss_end'])
+            self.assertIsNone(span['device_peak'])
+        # Peaks of nested spans are folded into the spans enclosing them
+        self.assertGreaterEqual(quantize['rss_peak'], max(span['rss_peak'] for span in spans[:4]))
+        self.assertFalse(os.path.exists(self.chrome_path))
+
+        trace.close()
+        trace.close()
+        with open(self.chrome_path) as f:
+            events = json.load(f)['traceEvents']
+        complete = [event for event in events if event['ph'] == 'X']
+        self.assertEqual([event['name'] for event in complete],
+                         ['quantize', 'layer', 'scale_search', 'layer', 'scale_search', 'save'])
+        outer = complete[0]
+        for event in complete[1:5]:
+            self.assertGreaterEqual(event['ts'], outer['ts'])
+            self.assertLessEqual(event['ts'] + event['dur'], outer['ts'] + outer['dur'])
+        self.assertEqual(complete[1]['args']['layer'], 0)
+        counters = [event for event in events if event['ph'] == 'C']
+        self.assertEqual(len(counters), 6)
+        self.assertNotIn('device_peak_mb', counters[0]['args'])
+
+    def test_span_reports_its_own_memory_peak(self):
+        if not reset_rss_peak():
+            self.skipTest("The peak RSS cannot be reset on this platform")
+        trace = QuantTrace(self.jsonl_path)
+        self.addCleanup(trace.close)
+        with trace.span('layer', 'layer'):
+            with trace.span('scale_search'):
+                block = np.ones(200 * MB // 8)
+                del block
+            with trace.span('pack'):
+                pass
+        search, pack, layer = self.read_jsonl()[1:]
+        self.assertGreaterEqual(search['rss_peak'] - search['rss_start'], 150 * MB)
+        self.assertLess(search['rss_end'], search['rss_peak'] - 150 * MB)
+        self.assertGreaterEqual(layer['rss_peak'], search['rss_peak'])
+        # The block freed before pack started is not part of its peak
+        self.assertLess(pack['rss_peak'], search['rss_peak'] - 150 * MB)
+        self.assertLessEqual(read_rss()[0], read_rss()[1])
+
+    @patch('torch.cuda.reset_peak_memory_stats')
+    @patch('torch.cuda.max_memory_allocated')
+    @patch('torch.cuda.device_count', return_value=2)
+    @patch('torch.cuda.is_available', return_value=True)
+    def test_device_peaks(self, mock_cuda_available, mock_device_count, mock_max_allocated, mock_reset_peak):
+        peaks = {0: 0, 1: 0}
+        mock_max_allocated.side_effect = lambda device: peaks[device]
+        mock_reset_peak.side_effect = lambda device: peaks.update({device: 0})
+
+        trace = QuantTrace(self.jsonl_path, self.chrome_path)
+        with trace.span('layer', 'layer'):
+            with trace.span('scale_search'):
+                peaks.update({0: 3 * MB, 1: 1 * MB})
+            with trace.span('pack'):
+                peaks.update({0: 1 * MB})
+        trace.close()
+
+        meta, search, pack, layer = self.read_jsonl()
+        self.assertEqual(meta['devices'], 2)
+        self.assertEqual((search['device_peak'], pack['device_peak'], layer['device_peak']), (4 * MB, 1 * MB, 4 * MB))
+        with open(self.chrome_path) as f:
+            counters = [event['args'] for event in json.load(f)['traceEvents'] if event['ph'] == 'C']
+        self.assertEqual(sorted(counter['device_peak_mb'] for counter in counters), [1, 4, 4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,22 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 import torch
+import numpy as np
+from safetensors.torch import load_file
+from transformers import LlamaConfig, LlamaForCausalLM
+from app.config import Config
 from app.quantization import run_quantization, validate_quantized_model, validate_quant_config, get_quantized_model_size
+from app.quantization import load_calibration_kwargs
+from app.multi_variant import MultiVariantQuantizer
+from app.checkpointed_quantizer import CheckpointedAwqQuantizer
+from app.layer_checkpoint import LayerCheckpoint
+from app.quantization import AutoAWQForCausalLM
+from app.safetensors_inspector import inspect_safetensors
+from app.streaming_quantizer import run_streaming_quantization
 
 class TestQuantization(unittest.TestCase):
     @patch('app.quantization.AutoAWQForCausalLM')
@@ -51,6 +66,99 @@ class TestQuantization(unittest.TestCase):
             device_map=None
         )
 
+    @patch('app.quantization.AutoAWQForCausalLM')
+    @patch('app.quantization.AutoTokenizer')
+    @patch('app.quantization.plan_quantization')
+    @patch('torch.cuda.is_available', return_value=False)
+    @patch('os.listdir', return_value=[])
+    def test_run_quantization_follows_memory_plan(self, mock_listdir, mock_cuda_available, mock_plan, mock_tokenizer, mock_awq):
+        mock_plan.return_value.mode = 'offload'
+        mock_plan.return_value.max_memory = {0: 1024, 'cpu': 4096}
+        run_quantization('/path/to/model', {}, '/path/to/output')
+        self.assertEqual(mock_awq.from_pretrained.call_args.kwargs['max_memory'], {0: 1024, 'cpu': 4096})
+
+        # A model that only fits layer by layer is streamed instead of loaded
+        mock_awq.reset_mock()
+        mock_plan.return_value.mode = 'stream'
+        mock_plan.return_value.fits = True
+        with patch('app.quantization.run_streaming_quantization') as mock_stream:
+            run_quantization('/path/to/model', {'w_bit': 4}, '/path/to/output')
+            mock_stream.assert_called_once()
+            self.assertEqual(mock_stream.call_args.args[:3], ('/path/to/model', {'w_bit': 4}, '/path/to/output'))
+            self.assertEqual(mock_stream.call_args.kwargs['dtype'], torch.float32)
+        mock_awq.from_pretrained.assert_not_called()
+
+        # Not even one layer fits: refused before anything is loaded
+        mock_plan.return_value.fits = False
+        with self.assertRaisesRegex(RuntimeError, 'Not enough memory'):
+            run_quantization('/path/to/model', {}, '/path/to/output')
+        mock_awq.from_pretrained.assert_not_called()
+
+    @patch('app.quantization.AutoAWQForCausalLM')
+    @patch('app.quantization.AutoTokenizer')
+    @patch('torch.cuda.is_available', return_value=False)
+    @patch('os.listdir', return_value=[])
+    def test_run_quantization_variants_share_one_load(self, mock_listdir, mock_cuda_available, mock_tokenizer, mock_awq):
+        mock_model = MagicMock()
+        mock_awq.from_pretrained.return_value = mock_model
+        variants = [{'w_bit': 4, 'q_group_size': group_size, 'zero_point': True, 'version': version}
+                    for group_size, version in [(128, 'GEMM'), (64, 'GEMM'), (32, 'GEMM'), (128, 'GEMV')]]
+        output_dirs = ['/out/g128', '/out/g64', '/out/g32', '/out/g128-gemv']
+        run_quantization('/path/to/model', variants, output_dirs)
+
+        mock_awq.from_pretrained.assert_called_once()
+        mock_model.quantize.assert_called_once()
+        kwargs = mock_model.quantize.call_args.kwargs
+        self.assertIs(kwargs['quantizer_cls'], MultiVariantQuantizer)
+        self.assertEqual(kwargs['variants'], variants)
+        self.assertIsNotNone(kwargs['checkpoint'])
+        self.assertEqual(mock_model.quantizer.save_variant.call_args_list,
+                         [((index, path),) for index, path in enumerate(output_dirs)])
+        mock_model.save_quantized.assert_not_called()
+
+        with self.assertRaisesRegex(ValueError, 'one output directory per'):
+            run_quantization('/path/to/model', variants, output_dirs[:2])
+
+    @patch('app.quantization.AutoAWQForCausalLM')
+    @patch('app.quantization.AutoTokenizer')
+    @patch('torch.cuda.is_available', return_value=False)
+    def test_run_quantization_writes_trace(self, mock_cuda_available, mock_tokenizer, mock_awq):
+        trace_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, trace_dir)
+        mock_model = MagicMock()
+        mock_awq.from_pretrained.return_value = mock_model
+        quant_config = {'w_bit': 4, 'q_group_size': 128, 'zero_point': True, 'version': 'GEMM'}
+        with patch.object(Config, 'QUANT_TRACE_DIR', trace_dir), patch.object(Config, 'QUANT_CHECKPOINT_DIR', ''), \
+                patch('os.listdir', return_value=[]):
+            run_quantization('/path/to/model', quant_config, '/path/to/output')
+
+        # The per-layer trace needs the checkpointed quantizer even without a checkpoint
+        kwargs = mock_model.quantize.call_args.kwargs
+        self.assertIs(kwargs['quantizer_cls'], CheckpointedAwqQuantizer)
+        self.assertIsNone(kwargs['checkpoint'])
+        jsonl, chrome = sorted(os.listdir(trace_dir))
+        self.assertTrue(jsonl.startswith('model-') and jsonl.endswith('.jsonl'))
+        self.assertEqual(chrome, jsonl[:-len('.jsonl')] + '.trace.json')
+        with open(os.path.join(trace_dir, jsonl)) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0]['model_path'], '/path/to/model')
+        self.assertEqual([record['name'] for record in records[1:]],
+                         ['plan', 'load_model', 'calibration_data', 'quantize', 'save'])
+        # The model directory does not exist, so planning failed and the job went on with defaults
+        self.assertIn('error', records[1])
+
+    @patch('app.quantization.CalibrationCache')
+    def test_cached_calibration_blocks_are_passed_as_tokens(self, mock_cache):
+        mock_cache.return_value.get_or_build.return_value = np.arange(8, dtype=np.int32).reshape(2, 4)
+        with patch.object(Config, 'CALIBRATION_CACHE_DIR', '/tmp/calibration'):
+            self.assertEqual(load_calibration_kwargs(MagicMock()),
+                             {'calib_data': [[0, 1, 2, 3], [4, 5, 6, 7]], 'max_calib_samples': 2, 'max_calib_seq_len': 4})
+            # Without the corpus, AutoAWQ is left to load its own
+            mock_cache.return_value.get_or_build.side_effect = ConnectionError("offline")
+            self.assertEqual(load_calibration_kwargs(MagicMock()), {})
+        with patch.object(Config, 'CALIBRATION_CACHE_DIR', ''):
+            self.assertEqual(load_calibration_kwargs(MagicMock()), {})
+
     @patch('app.quantization.AutoAWQForCausalLM')
     @patch('os.listdir')
     @patch('os.path.getsize')
@@ -336,5 +444,157 @@ class TestQuantization(unittest.TestCase):
             result = get_quantized_model_size('/path/to/model')
             self.assertEqual(result, 0)
 
+TINY_QUANT_CONFIG = {'w_bit': 4, 'q_group_size': 32, 'zero_point': True, 'version': 'GEMM'}
+
+def save_tiny_llama(model_path):
+    """
+    A three-layer Llama small enough to quantize on CPU in seconds, with a calibration set for it.
+    """
+    torch.manual_seed(0)
+    config = LlamaConfig(hidden_size=64, intermediate_size=128, num_hidden_layers=3, num_attention_heads=4,
+                         num_key_value_heads=4, vocab_size=128, max_position_embeddings=64)
+    LlamaForCausalLM(config).save_pretrained(model_path, safe_serialization=True)
+    return {'calib_data': torch.randint(0, 128, (4, 16)).tolist(), 'max_calib_samples': 4, 'max_calib_seq_len': 16}
+
+def quantize_in_memory(model_path, calib_kwargs, **kwargs):
+    model = AutoAWQForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32)
+    model.quantize(None, quant_config=TINY_QUANT_CONFIG, **calib_kwargs, **kwargs)
+    return model.model.state_dict()
+
+def load_shards(output_dir):
+    report = inspect_safetensors(output_dir)
+    tensors = {}
+    for shard in report.shards:
+        tensors.update(load_file(os.path.join(output_dir, shard)))
+    return report, tensors
+
+class TestLayerwiseQuantization(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.model_path = os.path.join(self.root, 'model')
+        self.calib_kwargs = save_tiny_llama(self.model_path)
+        self.expected = quantize_in_memory(self.model_path, self.calib_kwargs)
+        self.checkpoint = LayerCheckpoint(os.path.join(self.root, 'work'), 'job')
+
+    def assert_matches_expected(self, state_dict):
+        self.assertEqual(set(state_dict), set(self.expected))
+        for name, tensor in self.expected.items():
+            torch.testing.assert_close(state_dict[name].cpu(), tensor.cpu(), msg=name)
+
+    def test_streamed_model_matches_in_memory_quantization(self):
+        output_dir = os.path.join(self.root, 'streamed')
+        with patch('app.streaming_quantizer.StreamedWeights.release', wraps=lambda module: module.to('meta')) as release:
+            run_streaming_quantization(self.model_path, TINY_QUANT_CONFIG, output_dir, None, self.calib_kwargs)
+        self.assertEqual(release.call_count, 3)
+
+        report, streamed = load_shards(output_dir)
+        self.assertTrue(report.ok, report.problems)
+        self.assertEqual(len(report.shards), 4)
+        with open(os.path.join(output_dir, 'config.json')) as f:
+            self.assertEqual(json.load(f)['quantization_config']['quant_method'], 'awq')
+        self.assert_matches_expected(streamed)
+
+    def test_variants_match_separate_quantizations(self):
+        gemv = dict(TINY_QUANT_CONFIG, version='GEMV')
+        model = AutoAWQForCausalLM.from_pretrained(self.model_path, torch_dtype=torch.float32)
+        model.quantize(None, quant_config=TINY_QUANT_CONFIG, quantizer_cls=MultiVariantQuantizer,
+                       variants=[TINY_QUANT_CONFIG, gemv], **self.calib_kwargs)
+        for i, layer in enumerate(model.quantizer.variant_layers[0]):
+            model.quantizer.modules[i] = layer
+        self.assert_matches_expected(model.model.state_dict())
+        # GEMV shares the GEMM scale search and only packs differently
+        self.assertEqual(len(model.quantizer.variant_layers[1]), 3)
+        self.assertIsNot(model.quantizer.variant_layers[1][0], model.quantizer.variant_layers[0][0])
+
+    def test_variants_resume_after_interruption(self):
+        gemv = dict(TINY_QUANT_CONFIG, version='GEMV')
+        quantize_layer = MultiVariantQuantizer._quantize_layer
+
+        def dies_at_layer_1(quantizer, i):
+            if i == 1:
+                raise RuntimeError("preempted")
+            quantize_layer(quantizer, i)
+
+        def quantize_variants():
+            model = AutoAWQForCausalLM.from_pretrained(self.model_path, torch_dtype=torch.float32)
+            model.quantize(None, quant_config=TINY_QUANT_CONFIG, quantizer_cls=MultiVariantQuantizer,
+                           variants=[TINY_QUANT_CONFIG, gemv], checkpoint=self.checkpoint, **self.calib_kwargs)
+            return model
+
+        with patch.object(MultiVariantQuantizer, '_quantize_layer', dies_at_layer_1):
+            with self.assertRaisesRegex(RuntimeError, 'preempted'):
+                quantize_variants()
+        self.assertEqual(self.checkpoint.completed, 1)
+
+        with patch.object(MultiVariantQuantizer, '_quantize_layer', autospec=True,
+                          side_effect=quantize_layer) as mock_quantize_layer:
+            model = quantize_variants()
+        self.assertEqual([call.args[1] for call in mock_quantize_layer.call_args_list], [1, 2])
+        # Both variants of the restored layer are rebuilt from the checkpoint
+        self.assertEqual([len(layers) for layers in model.quantizer.variant_layers], [3, 3])
+        self.assertEqual(type(model.quantizer.variant_layers[1][0].self_attn.q_proj).__name__, 'WQLinear_GEMV')
+        for i, layer in enumerate(model.quantizer.variant_layers[0]):
+            model.quantizer.modules[i] = layer
+        self.assert_matches_expected(model.model.state_dict())
+
+    def test_resume_after_interruption(self):
+        quantize_layer = CheckpointedAwqQuantizer._quantize_layer
+
+        def dies_at_layer_2(quantizer, i):
+            if i == 2:
+                raise RuntimeError("preempted")
+            quantize_layer(quantizer, i)
+
+        with patch.object(CheckpointedAwqQuantizer, '_quantize_layer', dies_at_layer_2):
+            with self.assertRaisesRegex(RuntimeError, 'preempted'):
+                quantize_in_memory(self.model_path, self.calib_kwargs,
+                                   quantizer_cls=CheckpointedAwqQuantizer, checkpoint=self.checkpoint)
+        self.assertEqual(self.checkpoint.completed, 2)
+
+        # Only the last layer is searched again, and the result is the same as an uninterrupted run
+        with patch.object(CheckpointedAwqQuantizer, '_quantize_layer', autospec=True,
+                          side_effect=quantize_layer) as mock_quantize_layer:
+            resumed = quantize_in_memory(self.model_path, self.calib_kwargs,
+                                         quantizer_cls=CheckpointedAwqQuantizer, checkpoint=self.checkpoint)
+        self.assertEqual([call.args[1] for call in mock_quantize_layer.call_args_list], [2])
+        self.assert_matches_expected(resumed)
+
+    def test_streaming_resume_after_interruption(self):
+        output_dir = os.path.join(self.root, 'streamed')
+        quantize_layer = CheckpointedAwqQuantizer._quantize_layer
+
+        def dies_at_layer_1(quantizer, i):
+            if i == 1:
+                raise RuntimeError("preempted")
+            quantize_layer(quantizer, i)
+
+        with patch.object(CheckpointedAwqQuantizer, '_quantize_layer', dies_at_layer_1):
+            with self.assertRaisesRegex(RuntimeError, 'preempted'):
+                run_streaming_quantization(self.model_path, TINY_QUANT_CONFIG, output_dir, None, self.calib_kwargs,
+                                           checkpoint=self.checkpoint)
+        self.assertEqual(self.checkpoint.completed, 1)
+
+        with patch.object(CheckpointedAwqQuantizer, '_quantize_layer', autospec=True,
+                          side_effect=quantize_layer) as mock_quantize_layer:
+            run_streaming_quantization(self.model_path, TINY_QUANT_CONFIG, output_dir, None, self.calib_kwargs,
+                                       checkpoint=self.checkpoint)
+        self.assertEqual([call.args[1] for call in mock_quantize_layer.call_args_list], [1, 2])
+        self.assert_matches_expected(load_shards(output_dir)[1])
+
+    @patch('app.quantization.AutoAWQForCausalLM')
+    @patch('app.quantization.AutoTokenizer')
+    @patch('torch.cuda.is_available', return_value=False)
+    def test_run_quantization_checkpoints_and_cleans_up(self, mock_cuda_available, mock_tokenizer, mock_awq):
+        mock_model = MagicMock()
+        mock_awq.from_pretrained.return_value = mock_model
+        with patch.object(Config, 'QUANT_CHECKPOINT_DIR', os.path.join(self.root, 'checkpoints')):
+            run_quantization(self.model_path, TINY_QUANT_CONFIG, os.path.join(self.root, 'out'))
+        kwargs = mock_model.quantize.call_args.kwargs
+        self.assertIs(kwargs['quantizer_cls'], CheckpointedAwqQuantizer)
+        self.assertTrue(kwargs['checkpoint'].work_dir.startswith(os.path.join(self.root, 'checkpoints', 'out-')))
+        mock_model.save_quantized.assert_called_once()
+        self.assertFalse(os.path.exists(kwargs['checkpoint'].work_dir))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,149 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+import requests
+from app.range_downloader import PART_SUFFIX, RESUME_SUFFIX, download_file
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves the server's data with optional range support, a delay per block and dropped connections.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        data = server.data
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get('Range')
+        if range_header and server.ranges:
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start, end = int(first), min(int(last) if last else end, end)
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', server.etag)
+        self.end_headers()
+
+        body = data[start:end + 1]
+        with server.lock:
+            server.starts.append(start)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            # The one-byte probe always gets through
+            if server.drops and len(body) > 1:
+                server.drops -= 1
+                body = body[:len(body) // 2]
+        try:
+            for offset in range(0, len(body), 1024):
+                self.wfile.write(body[offset:offset + 1024])
+                with server.lock:
+                    server.served += len(body[offset:offset + 1024])
+                time.sleep(server.delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+        self.close_connection = True
+
+class TestRangeDownloader(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.reset(os.urandom(200 * 1024))
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/model.safetensors"
+        self.dest = os.path.join(self.root, 'model.safetensors')
+        # Small blocks so that a dropped connection still delivers part of its range
+        patcher = patch('app.range_downloader.STREAM_BLOCK_SIZE', 4096)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reset(self, data, etag='"v1"'):
+        self.server.data = data
+        self.server.etag = etag
+        self.server.ranges = True
+        self.server.drops = 0
+        self.server.delay = 0
+        self.server.served = 0
+        self.server.starts = []
+        self.server.active = 0
+        self.server.max_active = 0
+
+    def download(self, **kwargs):
+        options = dict(connections=4, chunk_size=32 * 1024, retries=2, timeout=5, backoff=0)
+        options.update(kwargs)
+        return download_file(self.url, self.dest, **options)
+
+    def assert_downloaded(self):
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), self.server.data)
+        self.assertFalse(os.path.exists(self.dest + PART_SUFFIX))
+        self.assertFalse(os.path.exists(self.dest + RESUME_SUFFIX))
+
+    def test_throttled_chunks_are_fetched_in_parallel(self):
+        self.server.delay = 0.002
+        self.assertEqual(self.download(size=len(self.server.data)), self.dest)
+        self.assert_downloaded()
+        self.assertGreater(self.server.max_active, 1)
+        # The probe byte plus every byte exactly once
+        self.assertEqual(self.server.served, len(self.server.data) + 1)
+
+    def test_dropped_connections_continue_from_last_byte(self):
+        self.server.drops = 5
+        self.download()
+        self.assert_downloaded()
+        # Retries ask for the rest of a chunk, not the whole chunk again
+        self.assertTrue(any(start % (32 * 1024) for start in self.server.starts))
+
+    def test_interrupted_download_resumes_where_it_stopped(self):
+        self.server.drops = 1000
+        with self.assertRaises(requests.RequestException):
+            self.download(retries=0)
+        with open(self.dest + RESUME_SUFFIX) as f:
+            done = sum(json.load(f)['progress'])
+        self.assertGreater(done, 0)
+        self.assertEqual(os.path.getsize(self.dest + PART_SUFFIX), len(self.server.data))
+        self.assertFalse(os.path.exists(self.dest))
+
+        self.server.drops = 0
+        self.server.served = 0
+        self.download()
+        self.assert_downloaded()
+        self.assertEqual(self.server.served, len(self.server.data) - done + 1)
+
+    def test_changed_file_is_downloaded_from_scratch(self):
+        self.server.drops = 1000
+        with self.assertRaises(requests.RequestException):
+            self.download(retries=0)
+        self.reset(os.urandom(200 * 1024), etag='"v2"')
+        self.download()
+        self.assert_downloaded()
+        self.assertEqual(self.server.served, len(self.server.data) + 1)
+
+    def test_server_without_ranges_gets_one_stream(self):
+        self.server.ranges = False
+        self.download()
+        self.assert_downloaded()
+
+    def test_size_mismatch_is_refused(self):
+        with self.assertRaisesRegex(ValueError, 'expected 10'):
+            self.download(size=10)
+
+if __name__ == '__main__':
+    unittest.main()
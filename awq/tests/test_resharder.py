@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import torch
+from safetensors.torch import load_file, save_file
+from app.resharder import ShardSource, parse_size, plan_shards, reshard_model
+
+class TestResharder(unittest.TestCase):
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.model_path)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('5GB'), 5 * 1024 ** 3)
+        self.assertEqual(parse_size('500MB'), 500 * 1024 ** 2)
+        self.assertEqual(parse_size('2GiB'), 2 * 1024 ** 3)
+        self.assertEqual(parse_size('1024'), 1024)
+        with self.assertRaises(ValueError):
+            parse_size('five gigabytes')
+
+    def test_plan_shards_first_fit_decreasing(self):
+        sizes = [('a', 6), ('b', 5), ('c', 4), ('d', 3), ('e', 2)]
+        self.assertEqual(plan_shards(sizes, 10), [['a', 'c'], ['b', 'd', 'e']])
+
+    def test_plan_shards_oversized_tensor(self):
+        self.assertEqual(plan_shards([('a', 1), ('big', 50), ('b', 1)], 10), [['a', 'b'], ['big']])
+
+    def _write_uneven_shards(self):
+        tensors = {f'model.layers.{i}.weight': torch.randn(16, 16) for i in range(6)}
+        names = list(tensors)
+        save_file({k: tensors[k] for k in names[:5]}, os.path.join(self.model_path, 'model-00001-of-00002.safetensors'))
+        save_file({k: tensors[k] for k in names[5:]}, os.path.join(self.model_path, 'model-00002-of-00002.safetensors'))
+        return tensors
+
+    def test_reshard_model_in_place(self):
+        tensors = self._write_uneven_shards()
+        shards = reshard_model(self.model_path, target_size=2 * 16 * 16 * 4)
+
+        self.assertEqual(shards, [f'model-0000{i}-of-00003.safetensors' for i in range(1, 4)])
+        self.assertFalse(os.path.exists(os.path.join(self.model_path, '.reshard-tmp')))
+        with open(os.path.join(self.model_path, 'model.safetensors.index.json')) as f:
+            index = json.load(f)
+        self.assertEqual(index['metadata']['total_size'], 6 * 16 * 16 * 4)
+
+        for shard in shards:
+            loaded = load_file(os.path.join(self.model_path, shard))
+            self.assertEqual(len(loaded), 2)
+            for name, tensor in loaded.items():
+                self.assertEqual(index['weight_map'][name], shard)
+                self.assertTrue(torch.equal(tensor, tensors[name]))
+
+    def test_failed_reshard_keeps_the_old_shards(self):
+        tensors = self._write_uneven_shards()
+        with patch('app.resharder.write_safetensors_index', side_effect=OSError(28, 'No space left on device')):
+            with self.assertRaises(OSError):
+                reshard_model(self.model_path, target_size=2 * 16 * 16 * 4)
+
+        # The new shards were moved in, but nothing was removed before the index was written
+        files = sorted(f for f in os.listdir(self.model_path) if f.endswith('.safetensors'))
+        self.assertEqual(files, ['model-00001-of-00002.safetensors', 'model-00001-of-00003.safetensors',
+                                 'model-00002-of-00002.safetensors', 'model-00002-of-00003.safetensors',
+                                 'model-00003-of-00003.safetensors'])
+        self.assertFalse(os.path.exists(os.path.join(self.model_path, '.reshard-tmp')))
+        loaded = {}
+        for shard in [f for f in files if f.endswith('-of-00003.safetensors')]:
+            loaded.update(load_file(os.path.join(self.model_path, shard)))
+        self.assertEqual(sorted(loaded), sorted(tensors))
+
+    def test_reshard_to_one_file_removes_stale_shards(self):
+        self._write_uneven_shards()
+        with open(os.path.join(self.model_path, 'model.safetensors.index.json'), 'w') as f:
+            json.dump({'weight_map': {}}, f)
+        self.assertEqual(reshard_model(self.model_path), ['model.safetensors'])
+        self.assertEqual(sorted(os.listdir(self.model_path)), ['model.safetensors'])
+
+    def test_dtype_policy_reads_tensors_once(self):
+        tensors = self._write_uneven_shards()
+        with patch.object(ShardSource, 'get_tensor', autospec=True, side_effect=ShardSource.get_tensor) as mock_get:
+            reshard_model(self.model_path, target_size=2 * 16 * 16 * 4, dtype='bf16')
+        self.assertEqual(mock_get.call_count, len(tensors))
+
+        # fp16-checked has to scan float32 tensors before their header entry is written
+        with patch.object(ShardSource, 'get_tensor', autospec=True, side_effect=ShardSource.get_tensor) as mock_get:
+            reshard_model(self.model_path, target_size=2 * 16 * 16 * 4, dtype='fp16-checked;*.5.*=native')
+        self.assertEqual(mock_get.call_count, 2 * len(tensors) - 1)
+
+    def test_reshard_model_from_bin_with_dtype(self):
+        torch.save({'a.weight': torch.randn(4, 4), 'b.weight': torch.randn(4, 4)},
+                   os.path.join(self.model_path, 'pytorch_model.bin'))
+        output_path = os.path.join(self.model_path, 'out')
+        shards = reshard_model(self.model_path, output_path, target_size=1024 ** 3, dtype=torch.float16)
+
+        self.assertEqual(shards, ['model.safetensors'])
+        self.assertTrue(os.path.exists(os.path.join(self.model_path, 'pytorch_model.bin')))
+        loaded = load_file(os.path.join(output_path, 'model.safetensors'))
+        self.assertEqual(loaded['a.weight'].dtype, torch.float16)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import torch
+from app.model_utils import check_model_files
+from app.safetensors_inspector import inspect_safetensors, inspect_shard
+from app.safetensors_io import save_file_streaming, write_safetensors_index
+
+class TestSafetensorsInspector(unittest.TestCase):
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.model_path)
+        for name in ['config.json', 'tokenizer.json']:
+            with open(os.path.join(self.model_path, name), 'w') as f:
+                f.write('{}')
+        save_file_streaming({'embed.weight': torch.zeros(8, 4, dtype=torch.float16),
+                             'norm.weight': torch.zeros(4, dtype=torch.float32)},
+                            self.path('model-00001-of-00002.safetensors'))
+        save_file_streaming({'lm_head.weight': torch.zeros(8, 4, dtype=torch.bfloat16)},
+                            self.path('model-00002-of-00002.safetensors'))
+        write_safetensors_index(self.model_path, ['model-00001-of-00002.safetensors', 'model-00002-of-00002.safetensors'])
+
+    def path(self, name):
+        return os.path.join(self.model_path, name)
+
+    def edit_index(self, edit):
+        with open(self.path('model.safetensors.index.json')) as f:
+            index = json.load(f)
+        edit(index['weight_map'])
+        with open(self.path('model.safetensors.index.json'), 'w') as f:
+            json.dump(index, f)
+
+    def test_reports_params_and_bytes_per_dtype(self):
+        report = inspect_safetensors(self.model_path)
+        self.assertTrue(report.ok, report.problems)
+        self.assertEqual(report.shards, ['model-00001-of-00002.safetensors', 'model-00002-of-00002.safetensors'])
+        self.assertEqual(report.total_params, 32 + 4 + 32)
+        self.assertEqual(report.bytes_by_dtype, {'BF16': 64, 'F16': 64, 'F32': 16})
+        self.assertEqual(report.tensors['lm_head.weight'].shape, (8, 4))
+        self.assertTrue(check_model_files(self.model_path))
+
+    def test_truncated_shard_is_caught(self):
+        shard = self.path('model-00002-of-00002.safetensors')
+        with open(shard, 'r+b') as f:
+            f.truncate(os.path.getsize(shard) - 10)
+        report = inspect_safetensors(self.model_path)
+        self.assertFalse(report.ok)
+        self.assertEqual(len(report.problems), 1)
+        self.assertIn('model-00002-of-00002.safetensors is truncated', report.problems[0])
+        self.assertFalse(check_model_files(self.model_path))
+
+        # Cut inside the header
+        with open(shard, 'r+b') as f:
+            f.truncate(20)
+        _, problems = inspect_shard(shard)
+        self.assertIn('header needs', problems[0])
+
+    def test_index_is_checked_against_shards(self):
+        def edit(weight_map):
+            weight_map['norm.weight'] = 'model-00002-of-00002.safetensors'
+            del weight_map['lm_head.weight']
+            weight_map['missing.weight'] = 'model-00003-of-00003.safetensors'
+        self.edit_index(edit)
+        problems = inspect_safetensors(self.model_path).problems
+        self.assertIn('model-00003-of-00003.safetensors is missing', problems)
+        self.assertIn('norm.weight is mapped to model-00002-of-00002.safetensors by the index but is not in it', problems)
+        self.assertIn('lm_head.weight in model-00002-of-00002.safetensors is not listed in the index', problems)
+
+    def test_duplicate_tensors_are_reported(self):
+        save_file_streaming({'lm_head.weight': torch.zeros(8, 4, dtype=torch.bfloat16),
+                             'embed.weight': torch.zeros(8, 4, dtype=torch.float16)},
+                            self.path('model-00002-of-00002.safetensors'))
+        problems = inspect_safetensors(self.model_path).problems
+        self.assertEqual(problems, ['embed.weight is duplicated in model-00001-of-00002.safetensors and '
+                                    'model-00002-of-00002.safetensors'])
+
+    def test_single_file_takes_precedence_over_index(self):
+        save_file_streaming({'weight': torch.zeros(3, dtype=torch.float32)}, self.path('model.safetensors'))
+        report = inspect_safetensors(self.model_path)
+        self.assertEqual(report.shards, ['model.safetensors'])
+        self.assertEqual(report.total_params, 3)
+
+if __name__ == '__main__':
+    unittest.main()
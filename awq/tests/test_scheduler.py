@@ -0,0 +1,37 @@
+import unittest
+from app.scheduler import select_admissible, run_with_memory_budget
+
+def _square(x):
+    return x * x
+
+class TestScheduler(unittest.TestCase):
+    def _jobs(self, costs):
+        return [{'name': f'shard-{i}', 'cost': cost, 'bytes': cost, 'args': (i,)} for i, cost in enumerate(costs)]
+
+    def test_select_admissible_respects_budget(self):
+        pending = self._jobs([4, 4, 4, 1])
+        self.assertEqual(select_admissible(pending, 0, 10, 4), [0, 1, 3])
+        self.assertEqual(select_admissible(pending, 6, 10, 4), [0])
+        self.assertEqual(select_admissible(pending, 0, 10, 1), [0])
+
+    def test_select_admissible_oversized_job_runs_alone(self):
+        pending = self._jobs([20, 1])
+        self.assertEqual(select_admissible(pending, 0, 10, 2), [0])
+        self.assertEqual(select_admissible(pending, 1, 10, 2), [1])
+
+    def test_run_with_memory_budget_in_process(self):
+        completed = []
+        stats = run_with_memory_budget(self._jobs([1, 2, 3]), _square, 10,
+                                       on_complete=lambda job, result: completed.append(result))
+        self.assertEqual(completed, [0, 1, 4])
+        self.assertEqual(stats['total_bytes'], 6)
+        self.assertEqual([job['name'] for job in stats['jobs']], ['shard-0', 'shard-1', 'shard-2'])
+
+    def test_run_with_memory_budget_process_pool(self):
+        completed = {}
+        run_with_memory_budget(self._jobs([3, 3, 3, 3]), _square, 6, max_workers=3,
+                               on_complete=lambda job, result: completed.update({job['name']: result}))
+        self.assertEqual(completed, {'shard-0': 0, 'shard-1': 1, 'shard-2': 4, 'shard-3': 9})
+
+if __name__ == '__main__':
+    unittest.main()
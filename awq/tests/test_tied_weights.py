@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file
+from app.converter import convert_model_to_safetensors, convert_shard
+from app.tied_weights import alias_map, find_tied_weights, shared_pointers
+
+class TestTiedWeights(unittest.TestCase):
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.model_path)
+
+    def test_shared_pointers_keys_by_byte_range(self):
+        fused = torch.randn(12, 4)
+        tensors = {
+            'embed.weight': fused,
+            'lm_head.weight': fused,
+            'q_proj.weight': fused[:4],
+            'k_proj.weight': fused[4:8],
+            'empty.a': torch.empty(0),
+            'empty.b': torch.empty(0),
+        }
+        # q_proj starts at the same address as the fused weight but covers fewer bytes
+        self.assertEqual(tensors['q_proj.weight'].data_ptr(), fused.data_ptr())
+        self.assertEqual(shared_pointers(tensors), [['embed.weight', 'lm_head.weight']])
+
+    def test_find_tied_weights_across_shards(self):
+        embed = torch.randn(32, 8)
+        shards = {
+            'a.bin': {'lm_head.weight': embed, 'layer.0.weight': torch.randn(32, 8), 'norm.weight': torch.ones(8)},
+            'b.bin': {'layer.1.weight': torch.randn(32, 8), 'model.embed_tokens.weight': embed.clone(),
+                      'norm_f.weight': torch.ones(8)},
+        }
+        # The input embedding is kept even when the output embedding comes first
+        self.assertEqual(find_tied_weights(list(shards), shards.__getitem__),
+                         {'lm_head.weight': 'model.embed_tokens.weight'})
+        self.assertEqual(find_tied_weights(list(shards), shards.__getitem__, across_shards=False), {})
+
+    def test_identical_layers_across_shards_stay_untied(self):
+        down_proj = torch.randn(32, 8)
+        shards = {
+            'a.bin': {'model.layers.0.mlp.down_proj.weight': down_proj, 'model.embed_tokens.weight': torch.randn(32, 8)},
+            'b.bin': {'model.layers.1.mlp.down_proj.weight': down_proj.clone(), 'lm_head.weight': torch.randn(32, 8)},
+        }
+        self.assertEqual(find_tied_weights(list(shards), shards.__getitem__), {})
+
+    def test_alias_map_keeps_the_input_embedding(self):
+        self.assertEqual(alias_map([['lm_head.weight', 'model.embed_tokens.weight'], ['q.weight', 'k.weight']]),
+                         {'lm_head.weight': 'model.embed_tokens.weight', 'k.weight': 'q.weight'})
+
+    def test_convert_shard_records_ties_in_metadata(self):
+        embed = torch.randn(16, 4)
+        pt_filename = os.path.join(self.model_path, 'pytorch_model.bin')
+        torch.save({'embed.weight': embed, 'lm_head.weight': embed, 'fused.q': embed[:8]}, pt_filename)
+
+        sf_filename = os.path.join(self.model_path, 'full.safetensors')
+        convert_shard(pt_filename, sf_filename, streaming=False)
+        with safe_open(sf_filename, framework='pt') as f:
+            self.assertEqual(json.loads(f.metadata()['tied_weights']), {'lm_head.weight': 'embed.weight'})
+        self.assertEqual(sorted(load_file(sf_filename)), ['embed.weight', 'fused.q'])
+
+    def test_convert_model_stores_cross_shard_tie_once(self):
+        embed = torch.randn(32, 8)
+        torch.save({'model.embed_tokens.weight': embed, 'model.layers.0.weight': torch.randn(32, 8)},
+                   os.path.join(self.model_path, 'pytorch_model-00001-of-00002.bin'))
+        torch.save({'model.layers.1.weight': torch.randn(32, 8), 'lm_head.weight': embed.clone()},
+                   os.path.join(self.model_path, 'pytorch_model-00002-of-00002.bin'))
+        with open(os.path.join(self.model_path, 'config.json'), 'w') as f:
+            json.dump({'tie_word_embeddings': True}, f)
+
+        convert_model_to_safetensors(self.model_path, dtype_policy='native')
+
+        second = os.path.join(self.model_path, 'model-00002-of-00002.safetensors')
+        self.assertEqual(list(load_file(second)), ['model.layers.1.weight'])
+        with open(os.path.join(self.model_path, 'model.safetensors.index.json')) as f:
+            index = json.load(f)
+        self.assertEqual(index['metadata']['tied_weights'], {'lm_head.weight': 'model.embed_tokens.weight'})
+        self.assertNotIn('lm_head.weight', index['weight_map'])
+        self.assertEqual(index['metadata']['total_size'], 3 * 32 * 8 * 4)
+
+    def test_untied_config_keeps_identical_weights(self):
+        embed = torch.randn(32, 8)
+        # Configs without the key do not tie either, matching transformers' default for most architectures
+        for config in ({'tie_word_embeddings': False}, {}):
+            model_path = tempfile.mkdtemp(dir=self.model_path)
+            torch.save({'model.embed_tokens.weight': embed},
+                       os.path.join(model_path, 'pytorch_model-00001-of-00002.bin'))
+            torch.save({'lm_head.weight': embed.clone()}, os.path.join(model_path, 'pytorch_model-00002-of-00002.bin'))
+            with open(os.path.join(model_path, 'config.json'), 'w') as f:
+                json.dump(config, f)
+
+            convert_model_to_safetensors(model_path)
+
+            self.assertIn('lm_head.weight', load_file(os.path.join(model_path, 'model-00002-of-00002.safetensors')))
+
+if __name__ == '__main__':
+    unittest.main()
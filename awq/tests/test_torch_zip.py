@@ -0,0 +1,130 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import torch
+from safetensors.torch import load_file
+from app.converter import convert_shard, load_shard_layout
+from app.conversion_journal import file_sha256
+from app.tied_weights import alias_map, shared_pointers
+from app.torch_zip import TorchZipCheckpoint, UnsupportedCheckpoint, copy_range, transcode_checkpoint
+
+class Payload:
+    def __reduce__(self):
+        return (os.getcwd, ())
+
+class TestTorchZip(unittest.TestCase):
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+        self.pt_filename = os.path.join(self.model_path, 'pytorch_model.bin')
+        self.sf_filename = os.path.join(self.model_path, 'model.safetensors')
+
+    def tearDown(self):
+        shutil.rmtree(self.model_path)
+
+    def _state_dict(self):
+        embed = torch.randn(64, 16)
+        return {
+            'embed.weight': embed,
+            'lm_head.weight': embed,
+            'fused.k': embed[32:],
+            'transposed': torch.randn(8, 4).t(),
+            'norm.weight': torch.nn.Parameter(torch.ones(16, dtype=torch.bfloat16)),
+            'position_ids': torch.arange(8),
+            'empty': torch.empty(0),
+        }
+
+    def test_layout_matches_torch_load(self):
+        state_dict = self._state_dict()
+        torch.save(state_dict, self.pt_filename)
+
+        checkpoint = TorchZipCheckpoint(self.pt_filename)
+        self.assertEqual(checkpoint.aliases(), {'lm_head.weight': 'embed.weight'})
+        self.assertFalse(checkpoint.records['transposed'].contiguous)
+        for name, tensor in state_dict.items():
+            self.assertTrue(torch.equal(checkpoint.tensor(name), tensor.detach()), name)
+        checkpoint.close()
+
+    def test_tie_scan_reads_records_without_torch_load(self):
+        torch.save(self._state_dict(), self.pt_filename)
+        with patch('app.converter.torch.load') as mock_load:
+            tensors = load_shard_layout(self.pt_filename)
+        mock_load.assert_not_called()
+        self.assertEqual(alias_map(shared_pointers(tensors)), {'lm_head.weight': 'embed.weight'})
+
+    def test_transcode_copies_bytes(self):
+        state_dict = self._state_dict()
+        torch.save(state_dict, self.pt_filename)
+
+        dropped = transcode_checkpoint(self.pt_filename, self.sf_filename, metadata={'format': 'pt'})
+
+        self.assertEqual(dropped, {'lm_head.weight': 'embed.weight'})
+        reloaded = load_file(self.sf_filename)
+        self.assertEqual(sorted(reloaded), sorted(set(state_dict) - {'lm_head.weight'}))
+        for name, tensor in reloaded.items():
+            self.assertTrue(torch.equal(tensor, state_dict[name].detach()), name)
+
+    def test_transcode_casts_and_hashes(self):
+        state_dict = self._state_dict()
+        torch.save(state_dict, self.pt_filename)
+
+        hasher = hashlib.sha256()
+        transcode_checkpoint(self.pt_filename, self.sf_filename, dtype='fp16;norm*=native', hasher=hasher)
+
+        self.assertEqual(hasher.hexdigest(), file_sha256(self.sf_filename))
+        reloaded = load_file(self.sf_filename)
+        self.assertEqual(reloaded['embed.weight'].dtype, torch.float16)
+        self.assertEqual(reloaded['norm.weight'].dtype, torch.bfloat16)
+        self.assertTrue(torch.equal(reloaded['transposed'], state_dict['transposed'].half()))
+
+    def test_convert_shard_copies_in_the_kernel(self):
+        state_dict = self._state_dict()
+        torch.save(state_dict, self.pt_filename)
+
+        with patch('app.torch_zip.copy_range', wraps=copy_range) as mock_copy:
+            digest = convert_shard(self.pt_filename, self.sf_filename, dtype_policy='native', digest=True)
+
+        # Every contiguous non-empty tensor but the dropped alias is copied, and the journal digest still matches
+        copied = sorted(call.args[3] for call in mock_copy.call_args_list)
+        self.assertEqual(copied, sorted(tensor.numel() * tensor.element_size() for name, tensor in state_dict.items()
+                                        if name not in ('lm_head.weight', 'transposed', 'empty')))
+        self.assertEqual(digest, file_sha256(self.sf_filename))
+        reloaded = load_file(self.sf_filename)
+        for name, tensor in reloaded.items():
+            self.assertTrue(torch.equal(tensor, state_dict[name].detach()), name)
+
+        # Without a digest the copied bytes are not read back
+        with patch('app.torch_zip.hash_range') as mock_hash:
+            self.assertIsNone(convert_shard(self.pt_filename, self.sf_filename, dtype_policy='native'))
+        mock_hash.assert_not_called()
+
+    def test_rejects_arbitrary_globals(self):
+        torch.save({'weight': torch.ones(2), 'payload': Payload()}, self.pt_filename)
+        with self.assertRaises(UnsupportedCheckpoint):
+            TorchZipCheckpoint(self.pt_filename)
+
+    def test_convert_shard_falls_back_for_legacy_checkpoints(self):
+        torch.save({'weight': torch.ones(2, 2)}, self.pt_filename, _use_new_zipfile_serialization=False)
+        with self.assertRaises(UnsupportedCheckpoint):
+            TorchZipCheckpoint(self.pt_filename)
+
+        convert_shard(self.pt_filename, self.sf_filename)
+        self.assertTrue(torch.equal(load_file(self.sf_filename)['weight'], torch.ones(2, 2, dtype=torch.float16)))
+
+    def test_copy_range(self):
+        src = os.path.join(self.model_path, 'src')
+        dst = os.path.join(self.model_path, 'dst')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(10000))
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            f_dst.write(b'head')
+            f_dst.flush()
+            copy_range(f_src.fileno(), f_dst.fileno(), 100, 5000, chunk_size=1024)
+            f_dst.write(b'tail')
+        with open(src, 'rb') as f_src, open(dst, 'rb') as f_dst:
+            self.assertEqual(f_dst.read(), b'head' + f_src.read()[100:5100] + b'tail')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,282 @@
+"""
+Benchmark the bin-to-safetensors conversion paths on synthetic Llama-shaped checkpoints.
+
+Generates a checkpoint of the requested shape once, then converts a fresh copy of it
+with each converter in its own process and records wall time, throughput, peak RSS
+and bytes written to a JSON results file. Runs on CPU only, so it can gate CI:
+pass --baseline with an earlier results file to fail on regressions.
+
+    python benchmarks/conversion_benchmark.py --layers 4 --hidden-size 1024 --shards 2 --output results.json
+"""
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import platform
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AWQ_DIR = os.path.join(REPO_DIR, "awq")
+COMMON_DIR = os.path.join(REPO_DIR, "common")
+
+CONVERTERS = ["awq", "file-converter", "simple"]
+DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16, "float32": torch.float32}
+MB = 1024 * 1024
+
+
+def llama_tensor_shapes(layers, hidden_size, intermediate_size, vocab_size, kv_heads_ratio=1, tie_embeddings=False):
+    """(name, shape) pairs of a Llama-style decoder in checkpoint order, grouped per layer."""
+    kv_size = hidden_size // kv_heads_ratio
+    groups = [[("model.embed_tokens.weight", (vocab_size, hidden_size))]]
+    for i in range(layers):
+        prefix = f"model.layers.{i}"
+        groups.append([
+            (f"{prefix}.self_attn.q_proj.weight", (hidden_size, hidden_size)),
+            (f"{prefix}.self_attn.k_proj.weight", (kv_size, hidden_size)),
+            (f"{prefix}.self_attn.v_proj.weight", (kv_size, hidden_size)),
+            (f"{prefix}.self_attn.o_proj.weight", (hidden_size, hidden_size)),
+            (f"{prefix}.mlp.gate_proj.weight", (intermediate_size, hidden_size)),
+            (f"{prefix}.mlp.up_proj.weight", (intermediate_size, hidden_size)),
+            (f"{prefix}.mlp.down_proj.weight", (hidden_size, intermediate_size)),
+            (f"{prefix}.input_layernorm.weight", (hidden_size,)),
+            (f"{prefix}.post_attention_layernorm.weight", (hidden_size,)),
+        ])
+    tail = [("model.norm.weight", (hidden_size,))]
+    if not tie_embeddings:
+        tail.append(("lm_head.weight", (vocab_size, hidden_size)))
+    groups.append(tail)
+    return groups
+
+
+def generate_checkpoint(path, layers, hidden_size, intermediate_size, vocab_size, dtype, shards, kv_heads_ratio=1,
+                        tie_embeddings=False, seed=0):
+    """
+    Write a sharded pytorch_model-*.bin checkpoint with its index and config.json.
+
+    Layers are spread evenly over the shards, and only one shard is held in memory at a time.
+    Returns the total size of the bin files in bytes.
+    """
+    os.makedirs(path, exist_ok=True)
+    generator = torch.Generator().manual_seed(seed)
+    groups = llama_tensor_shapes(layers, hidden_size, intermediate_size, vocab_size, kv_heads_ratio, tie_embeddings)
+    shards = max(1, min(shards, len(groups)))
+    per_shard = -(-len(groups) // shards)
+
+    weight_map = {}
+    embed = None
+    for shard in range(shards):
+        shard_file = f"pytorch_model-{shard + 1:05d}-of-{shards:05d}.bin"
+        state_dict = {}
+        for group in groups[shard * per_shard:(shard + 1) * per_shard]:
+            for name, shape in group:
+                tensor = torch.randn(shape, generator=generator) * 0.02
+                if len(shape) == 1:
+                    tensor += 1
+                state_dict[name] = tensor.to(DTYPES[dtype])
+                weight_map[name] = shard_file
+        if tie_embeddings and shard == 0:
+            embed = state_dict["model.embed_tokens.weight"]
+        if tie_embeddings and shard == shards - 1:
+            # Within one shard the tie shares storage; in another shard transformers saves a copy
+            state_dict["lm_head.weight"] = embed if shard == 0 else embed.clone()
+            weight_map["lm_head.weight"] = shard_file
+        torch.save(state_dict, os.path.join(path, shard_file))
+        del state_dict
+
+    total_size = sum(os.path.getsize(f) for f in glob.glob(os.path.join(path, "*.bin")))
+    with open(os.path.join(path, "pytorch_model.bin.index.json"), "w") as f:
+        json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f, indent=2)
+    with open(os.path.join(path, "config.json"), "w") as f:
+        json.dump({
+            "architectures": ["LlamaForCausalLM"],
+            "model_type": "llama",
+            "hidden_size": hidden_size,
+            "intermediate_size": intermediate_size,
+            "num_hidden_layers": layers,
+            "vocab_size": vocab_size,
+            "torch_dtype": dtype,
+            "tie_word_embeddings": tie_embeddings,
+        }, f, indent=2)
+    return total_size
+
+
+def run_converter(converter, model_path, options):
+    """Run one conversion in the current process. Returns (seconds, output directory)."""
+    start = time.perf_counter()
+    if converter == "awq":
+        sys.path.insert(0, AWQ_DIR)
+        from app.converter import convert_model_to_safetensors
+        convert_model_to_safetensors(model_path, workers=options["workers"],
+                                     memory_budget=int(options["memory_budget_gb"] * 1024 ** 3),
+                                     dtype_policy=options["dtype_policy"], pipeline_depth=options["pipeline_depth"])
+        output_path = model_path
+    elif converter == "file-converter":
+        sys.path.insert(0, COMMON_DIR)
+        spec = importlib.util.spec_from_file_location("convert_to_tensor", os.path.join(COMMON_DIR, "convert-to-tensor.py"))
+        module = importlib.util.module_from_spec(spec)
+        # Registered so worker processes can unpickle the converter
+        sys.modules["convert_to_tensor"] = module
+        spec.loader.exec_module(module)
+        output_path = model_path + "_safetensors"
+        module.FileConverter(model_path, output_path, False, options["workers"], options["memory_budget_gb"],
+                             options["verify"], options["dtype_policy"], options["pipeline_depth"]).convert_files()
+    elif converter == "simple":
+        sys.path.insert(0, COMMON_DIR)
+        sys.argv = ["convert-pytorch-simple.py", "--dtype", options["dtype_policy"], os.path.join(model_path, "*.bin")]
+        runpy.run_path(os.path.join(COMMON_DIR, "convert-pytorch-simple.py"), run_name="__main__")
+        output_path = model_path
+    else:
+        raise ValueError(f"Unknown converter {converter}. Expected one of {CONVERTERS}")
+    return time.perf_counter() - start, output_path
+
+
+def measure(converter, checkpoint_path, input_bytes, options, work_dir):
+    """Convert a fresh copy of the checkpoint in a child process and collect its metrics."""
+    model_path = os.path.join(work_dir, "model")
+    shutil.rmtree(model_path, ignore_errors=True)
+    shutil.rmtree(model_path + "_safetensors", ignore_errors=True)
+    shutil.copytree(checkpoint_path, model_path)
+
+    result_file = os.path.join(work_dir, "result.json")
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-one", converter, model_path,
+                                json.dumps(options), result_file])
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{converter} failed with exit code {process.returncode}")
+
+    with open(result_file) as f:
+        seconds, output_path = json.load(f)
+    bytes_written = sum(os.path.getsize(f) for f in glob.glob(os.path.join(output_path, "*.safetensors")))
+    return {
+        "converter": converter,
+        "seconds": round(seconds, 4),
+        "mb_per_s": round(input_bytes / MB / max(seconds, 1e-9), 2),
+        # ru_maxrss is in KiB on Linux: the largest of the child and the processes it waited for
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "bytes_written": bytes_written,
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    """Compare the best run of each converter with a baseline results file."""
+    def best(entries):
+        by_converter = {}
+        for entry in entries:
+            current = by_converter.get(entry["converter"])
+            if current is None or entry["seconds"] < current["seconds"]:
+                by_converter[entry["converter"]] = entry
+        return by_converter
+
+    regressions = []
+    previous = best(baseline["results"])
+    for converter, entry in best(results).items():
+        if converter not in previous:
+            continue
+        for metric in ["seconds", "peak_rss_mb", "bytes_written"]:
+            old, new = previous[converter][metric], entry[metric]
+            if old and new > old * (1 + tolerance):
+                regressions.append(f"{converter}: {metric} went from {old} to {new}")
+    return regressions
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--run-one":
+        converter, model_path, options, result_file = sys.argv[2:6]
+        seconds, output_path = run_converter(converter, model_path, json.loads(options))
+        with open(result_file, "w") as f:
+            json.dump([seconds, output_path], f)
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark the conversion paths on a synthetic Llama-shaped checkpoint")
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--hidden-size", type=int, default=1024)
+    parser.add_argument("--intermediate-size", type=int, help="Defaults to 8/3 of the hidden size, rounded up to 256")
+    parser.add_argument("--vocab-size", type=int, default=32000)
+    parser.add_argument("--kv-heads-ratio", type=int, default=1, help="Attention heads per key/value head")
+    parser.add_argument("--dtype", choices=sorted(DTYPES), default="float16", help="dtype of the synthetic weights")
+    parser.add_argument("--shards", type=int, default=2)
+    parser.add_argument("--tie-embeddings", action="store_true", help="Store lm_head as a copy of the embeddings")
+    parser.add_argument("--converters", default=",".join(CONVERTERS), help=f"Comma separated subset of {CONVERTERS}")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--memory-budget-gb", type=float, default=16)
+    parser.add_argument("--dtype-policy", default="native", help="Output dtype policy passed to every converter")
+    parser.add_argument("--pipeline-depth", type=int, default=4, help="Read/cast/write pipeline depth, 0 to disable")
+    parser.add_argument("--verify", choices=["hash", "tensor"], default="hash", help="FileConverter verification mode")
+    parser.add_argument("--work-dir", help="Scratch directory (defaults to a temporary directory)")
+    parser.add_argument("--output", default="conversion-benchmark.json", help="Results file")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    intermediate_size = args.intermediate_size or -(-args.hidden_size * 8 // 3 // 256) * 256
+    converters = [c.strip() for c in args.converters.split(",") if c.strip()]
+    options = {"workers": args.workers, "memory_budget_gb": args.memory_budget_gb,
+               "dtype_policy": args.dtype_policy, "verify": args.verify, "pipeline_depth": args.pipeline_depth}
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="conversion-benchmark-")
+    try:
+        checkpoint_path = os.path.join(work_dir, "checkpoint")
+        shutil.rmtree(checkpoint_path, ignore_errors=True)
+        print(f"Generating a {args.layers}-layer checkpoint (hidden {args.hidden_size}, intermediate {intermediate_size}, "
+              f"{args.dtype}, {args.shards} shards)...")
+        input_bytes = generate_checkpoint(checkpoint_path, args.layers, args.hidden_size, intermediate_size,
+                                          args.vocab_size, args.dtype, args.shards, args.kv_heads_ratio,
+                                          args.tie_embeddings)
+
+        results = []
+        for converter in converters:
+            for run in range(args.repeat):
+                result = {**measure(converter, checkpoint_path, input_bytes, options, work_dir), "run": run}
+                results.append(result)
+                print(f"{converter} #{run}: {result['seconds']:.2f}s, {result['mb_per_s']:.2f} MB/s, "
+                      f"peak RSS {result['peak_rss_mb']:.1f} MB, {result['bytes_written'] / MB:.2f} MB written")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "checkpoint": {
+            "layers": args.layers,
+            "hidden_size": args.hidden_size,
+            "intermediate_size": intermediate_size,
+            "vocab_size": args.vocab_size,
+            "kv_heads_ratio": args.kv_heads_ratio,
+            "dtype": args.dtype,
+            "shards": args.shards,
+            "tie_embeddings": args.tie_embeddings,
+            "bytes": input_bytes,
+        },
+        "options": options,
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 import torch
-import argparse, os, glob
-from safetensors.torch import save_file
+import argparse, os, sys, glob, json, zipfile
+
+# The tensor-format code is the awq pipeline's own
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "awq"))
+from app.converter import load_shard_layout
+from app.safetensors_io import TIED_WEIGHTS_METADATA_KEY, save_file_streaming
+from app.tied_weights import alias_map, find_tied_weights, shared_pointers, ties_across_shards
+from app.torch_zip import UnsupportedCheckpoint, transcode_checkpoint
 
 parser = argparse.ArgumentParser(description="Convert .bin/.pt files to .safetensors")
 parser.add_argument("--unshare", action="store_true", help="Detach tensors to prevent any from sharing memory")
 parser.add_argument("--use_gpu", action="store_true", help="Use GPU to process tensors if available")
+parser.add_argument("--dtype", default="native", help="Output dtype policy, e.g. native, bf16 or 'fp16-checked;*norm*=fp32' (default: native)")
 parser.add_argument("input_files", nargs="+", type=str, help="Input file(s)")
 args = parser.parse_args()
 
@@ -15,10 +22,38 @@ tensor_files = []
 for file_pattern in args.input_files:
     tensor_files.extend(glob.glob(file_pattern))
 
+# Ties are found across the shards of each folder up front, so a tensor tied across shards is stored once
+ties = {}
+for folder in sorted({os.path.dirname(os.path.abspath(file)) for file in tensor_files}):
+    shards = sorted(file for file in tensor_files if os.path.dirname(os.path.abspath(file)) == folder)
+    ties.update(find_tied_weights(shards, load_shard_layout, across_shards=ties_across_shards(folder)))
+
 for file in tensor_files:
+    out_file = os.path.splitext(file)[0] + ".safetensors"
+    if not (args.use_gpu or args.unshare):
+        # Zip checkpoints are copied straight from the archive without unpickling tensors
+        try:
+            transcode_checkpoint(file, out_file, dtype=args.dtype, metadata={"format": "pt"}, ties=ties)
+            print(f" -- Transcoded {file} to {out_file}")
+            continue
+        except UnsupportedCheckpoint as e:
+            print(f" -- Cannot transcode {file} directly ({e}), loading it instead")
+
     print(f" -- Loading {file}...")
-    # Load tensors to specified device
-    state_dict = torch.load(file, map_play="cpu")
+    # Memory-map the checkpoint so tensors are only read while they are written
+    state_dict = torch.load(file, map_location="cpu", mmap=zipfile.is_zipfile(file))
+    state_dict = state_dict.get("state_dict", state_dict)
+
+    # Tied aliases are left out before anything is copied, and recorded in the metadata
+    file_ties = {**alias_map(shared_pointers(state_dict)), **ties}
+    tied = {alias: target for alias, target in file_ties.items() if alias in state_dict}
+    for alias in tied:
+        state_dict.pop(alias)
+    metadata = {"format": "pt"}
+    if tied:
+        metadata[TIED_WEIGHTS_METADATA_KEY] = json.dumps(tied, sort_keys=True)
+        print(f" -- Storing {len(tied)} tied tensor(s) once: {tied}")
+
     if args.use_gpu and torch.cuda.is_available():
         # If GPU is available and the flag is set, transfer tensors to GPU
         state_dict = {k: v.to(device) for k, v in state_dict.items()}
@@ -30,11 +65,11 @@ for file in tensor_files:
             state_dict[k] = new_tensor
             print(f"Tensor {k} is now contiguous: {new_tensor.is_contiguous()}")
 
-    out_file = os.path.splitext(file)[0] + ".safetensors"
     print(f" -- Saving {out_file}...")
 
     # Convert tensors back to CPU for saving
     if device.type == 'cuda':
         state_dict = {k: v.cpu() for k, v in state_dict.items()}
 
-    save_file(state_dict, out_file, metadata={"format": "pt"})
+    # Tensors are cast chunk by chunk as they are written, so the policy never doubles memory
+    save_file_streaming(state_dict, out_file, metadata=metadata, dtype=args.dtype)
@@ -1,11 +1,23 @@
+import hashlib
 import json
 import os
 import shutil
+import sys
+import zipfile
 import torch
-from collections import defaultdict
 from safetensors.torch import load_file, save_file
 from tqdm import tqdm
 
+# The tensor-format code is the awq pipeline's own
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "awq"))
+from app.conversion_journal import file_sha256
+from app.dtype_policy import DtypePolicy
+from app.pipeline import PIPELINE_DEPTH
+from app.safetensors_io import TIED_WEIGHTS_METADATA_KEY, save_file_streaming, write_safetensors_index
+from app.scheduler import run_with_memory_budget
+from app.tied_weights import alias_map, find_tied_weights, shared_pointers, shared_storages, ties_across_shards
+from app.torch_zip import TorchZipCheckpoint, UnsupportedCheckpoint, transcode_checkpoint
+
 class Config:
     COPY_ADD_DATA_DEFAULT = True
     DELETE_OLD_DEFAULT = False
@@ -16,19 +28,49 @@ class Config:
     FILE_EXTENSION = '.safetensors'
     INDEX_FILE_NAME = 'model.safetensors.index.json'
     CONVERTED_FORMAT = 'pt'
+    WORKERS_DEFAULT = 1
+    MEMORY_BUDGET_GB_DEFAULT = 16
+    # 'hash' hashes the bytes while writing and re-hashes the output with one sequential read,
+    # 'tensor' reloads the output and compares every tensor with torch.equal
+    VERIFY_MODE_DEFAULT = 'hash'
+    # Output dtype policy, e.g. 'native', 'bf16' or 'fp16-checked;*norm*=fp32'
+    DTYPE_POLICY_DEFAULT = 'fp16'
+    # Chunks in flight between the read, cast and write stages of a conversion, 0 to disable
+    PIPELINE_DEPTH_DEFAULT = PIPELINE_DEPTH
+    # Peak memory of one conversion relative to the shard size on disk. Tensor
+    # verification holds the loaded tensors, their cast copies and the reloaded output
+    MEMORY_PER_SHARD_FACTOR = {'hash': 1, 'tensor': 3}
 
 class FileConverter:
-    def __init__(self, source_folder, dest_folder, delete_old):
+    def __init__(self, source_folder, dest_folder, delete_old, workers=Config.WORKERS_DEFAULT,
+                 memory_budget_gb=Config.MEMORY_BUDGET_GB_DEFAULT, verify=Config.VERIFY_MODE_DEFAULT,
+                 dtype_policy=Config.DTYPE_POLICY_DEFAULT, pipeline_depth=Config.PIPELINE_DEPTH_DEFAULT):
+        if verify not in Config.MEMORY_PER_SHARD_FACTOR:
+            raise ValueError(f"verify must be one of {sorted(Config.MEMORY_PER_SHARD_FACTOR)}")
         self.source_folder = source_folder
         self.dest_folder = dest_folder
         self.delete_old = delete_old
+        self.verify = verify
+        self.dtype_policy = DtypePolicy.parse(dtype_policy)
+        self.pipeline_depth = pipeline_depth
+        self.workers = workers
+        self.memory_budget = int(memory_budget_gb * 1024 ** 3)
+
+    shared_pointers = staticmethod(shared_pointers)
 
     @staticmethod
-    def shared_pointers(tensors):
-        ptrs = defaultdict(list)
-        for k, v in tensors.items():
-            ptrs[v.data_ptr()].append(k)
-        return [names for names in ptrs.values() if len(names) > 1]
+    def load_checkpoint(pt_filename, mmap=True):
+        # Legacy (non-zip) checkpoints cannot be memory-mapped
+        loaded = torch.load(pt_filename, map_location="cpu", mmap=mmap and zipfile.is_zipfile(pt_filename))
+        return loaded.get("state_dict", loaded)
+
+    @classmethod
+    def load_layout(cls, pt_filename):
+        # Zip checkpoints are scanned for ties from their storage records, without torch.load
+        try:
+            return TorchZipCheckpoint(pt_filename).tensors()
+        except UnsupportedCheckpoint:
+            return cls.load_checkpoint(pt_filename)
 
     @staticmethod
     def check_file_size(sf_filename, pt_filename):
@@ -37,27 +79,62 @@ class FileConverter:
         if (sf_size - pt_size) / pt_size > Config.FILE_SIZE_DIFFERENCE_THRESHOLD:
             raise RuntimeError(f"File size difference exceeds 1% between {sf_filename} and {pt_filename}")
 
-    def convert_file(self, pt_filename, sf_filename, copy_add_data=Config.COPY_ADD_DATA_DEFAULT):
-        loaded = torch.load(pt_filename, map_location="cpu")
-        loaded = loaded.get("state_dict", loaded)
-        shared = self.shared_pointers(loaded)
-
-        for shared_weights in shared:
-            for name in shared_weights[1:]:
-                loaded.pop(name)
-
-        loaded = {k: v.contiguous().half() for k, v in loaded.items()}
-
+    def convert_file(self, pt_filename, sf_filename, copy_add_data=Config.COPY_ADD_DATA_DEFAULT, ties=None):
         os.makedirs(self.dest_folder, exist_ok=True)
-        save_file(loaded, sf_filename, metadata={"format": Config.CONVERTED_FORMAT})
+        digest = None
+        if self.verify == 'hash':
+            # Zip checkpoints are copied straight from the archive without unpickling tensors
+            try:
+                hasher = hashlib.sha256()
+                transcode_checkpoint(pt_filename, sf_filename, self.dtype_policy, {"format": Config.CONVERTED_FORMAT},
+                                     ties, hasher=hasher, pipeline_depth=self.pipeline_depth)
+                digest = hasher.hexdigest()
+            except UnsupportedCheckpoint:
+                pass
+
+        if digest is None:
+            self.save_loaded(pt_filename, sf_filename, ties)
         self.check_file_size(sf_filename, pt_filename)
         if copy_add_data:
             self.copy_additional_files(self.source_folder, self.dest_folder)
 
-        reloaded = load_file(sf_filename)
-        for k, v in loaded.items():
-            if not torch.equal(v, reloaded[k]):
-                raise RuntimeError(f"Mismatch in tensors for key {k}.")
+        if digest is not None:
+            self.verify_digest(sf_filename, digest)
+
+    @staticmethod
+    def verify_digest(sf_filename, digest):
+        if file_sha256(sf_filename) != digest:
+            raise RuntimeError(f"Mismatch in {sf_filename}: the file does not hash to the bytes written")
+
+    def save_loaded(self, pt_filename, sf_filename, ties=None):
+        loaded = self.load_checkpoint(pt_filename, mmap=self.verify == 'hash')
+
+        # Without a tie map for the whole checkpoint only aliases within this file are found
+        if ties is None:
+            ties = alias_map(self.shared_pointers(loaded))
+        tied = {alias: target for alias, target in ties.items() if alias in loaded}
+        for name in tied:
+            loaded.pop(name)
+        metadata = {"format": Config.CONVERTED_FORMAT}
+        if tied:
+            metadata[TIED_WEIGHTS_METADATA_KEY] = json.dumps(tied, sort_keys=True)
+
+        if self.verify == 'hash':
+            hasher = hashlib.sha256()
+            save_file_streaming(loaded, sf_filename, metadata=metadata, dtype=self.dtype_policy, hasher=hasher,
+                                pipeline_depth=self.pipeline_depth)
+            self.verify_digest(sf_filename, hasher.hexdigest())
+        else:
+            loaded = {k: v.contiguous().to(self.dtype_policy.resolve(k, v)) for k, v in loaded.items()}
+            # safetensors refuses tensors that still share a storage, such as slices of a fused weight
+            for names in shared_storages(loaded):
+                for name in names:
+                    loaded[name] = loaded[name].clone()
+            save_file(loaded, sf_filename, metadata=metadata)
+            reloaded = load_file(sf_filename)
+            for k, v in loaded.items():
+                if not torch.equal(v, reloaded[k]):
+                    raise RuntimeError(f"Mismatch in tensors for key {k}.")
 
     @staticmethod
     def rename(pt_filename):
@@ -76,6 +153,23 @@ class FileConverter:
                 return file
         return None
 
+    def run_jobs(self, jobs):
+        """Convert jobs, running as many at once as the memory budget allows (see app.scheduler)."""
+        with tqdm(total=len(jobs)) as progress:
+            def on_complete(job, _):
+                if self.delete_old:
+                    os.remove(job['args'][0])
+                progress.update(1)
+
+            stats = run_with_memory_budget(jobs, self.convert_file, self.memory_budget, max_workers=self.workers,
+                                           on_complete=on_complete)
+
+        for job in stats['jobs']:
+            print(f"{job['name']}: {job['bytes'] / (1024 * 1024):.2f} MB in {job['seconds']:.2f}s ({job['mb_per_s']:.2f} MB/s)")
+        print(f"Converted {len(stats['jobs'])} files ({stats['total_bytes'] / (1024 * 1024):.2f} MB) in {stats['wall_seconds']:.2f}s "
+              f"({stats['mb_per_s']:.2f} MB/s aggregate)")
+        return stats
+
     def convert_files(self):
         index_file = self.find_index_file()
         if not index_file:
@@ -85,19 +179,28 @@ class FileConverter:
         with open(index_file) as f:
             index_data = json.load(f)
 
-        for pt_filename in tqdm(set(index_data["weight_map"].values())):
+        shard_files = sorted(set(index_data["weight_map"].values()))
+        # Ties are found across all shards up front so each tied tensor is stored once
+        ties = find_tied_weights(shard_files, lambda f: self.load_layout(os.path.join(self.source_folder, f)),
+                                 across_shards=ties_across_shards(self.source_folder))
+        if ties:
+            print(f"Storing {len(ties)} tied tensor(s) once: {ties}")
+
+        jobs = []
+        for pt_filename in shard_files:
             full_pt_filename = os.path.join(self.source_folder, pt_filename)
             sf_filename = os.path.join(self.dest_folder, self.rename(pt_filename))
-            self.convert_file(full_pt_filename, sf_filename, copy_add_data=False)
-            if self.delete_old:
-                os.remove(full_pt_filename)
+            size = os.path.getsize(full_pt_filename)
+            jobs.append({'name': pt_filename, 'cost': size * Config.MEMORY_PER_SHARD_FACTOR[self.verify], 'bytes': size,
+                         'args': (full_pt_filename, sf_filename, False, ties)})
+
+        self.run_jobs(jobs)
 
         self.copy_additional_files(self.source_folder, self.dest_folder)
         
-        index_path = os.path.join(self.dest_folder, Config.INDEX_FILE_NAME)
-        with open(index_path, "w") as f:
-            new_map = {k: self.rename(v) for k, v in index_data["weight_map"].items()}
-            json.dump({**index_data, "weight_map": new_map}, f, indent=4)
+        # The weight map, total size and tie map are read back from the written shards
+        metadata = {k: v for k, v in index_data.get("metadata", {}).items() if k != "total_size"}
+        write_safetensors_index(self.dest_folder, sorted({self.rename(f) for f in shard_files}), metadata)
 
 def main():
     script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -110,8 +213,15 @@ def main():
         dest_folder = os.path.join(source_folder, model_name + "_safetensors")
 
     delete_old = input("Delete old PyTorch files? (Y/N): ").strip().upper() == 'Y'
+    workers = int(input(f"Parallel conversions (leave blank for {Config.WORKERS_DEFAULT}): ").strip() or Config.WORKERS_DEFAULT)
+    memory_budget_gb = float(input(f"RAM budget in GB for parallel conversions (leave blank for {Config.MEMORY_BUDGET_GB_DEFAULT}): ").strip()
+                             or Config.MEMORY_BUDGET_GB_DEFAULT)
+
+    verify = input(f"Verification mode, hash or tensor (leave blank for {Config.VERIFY_MODE_DEFAULT}): ").strip().lower() or Config.VERIFY_MODE_DEFAULT
+
+    dtype_policy = input(f"Output dtype policy, e.g. native, bf16 or fp16-checked;*norm*=fp32 (leave blank for {Config.DTYPE_POLICY_DEFAULT}): ").strip() or Config.DTYPE_POLICY_DEFAULT
 
-    converter = FileConverter(source_folder, dest_folder, delete_old)
+    converter = FileConverter(source_folder, dest_folder, delete_old, workers, memory_budget_gb, verify, dtype_policy)
 
     if "pytorch_model.bin" in os.listdir(source_folder):
         converter.convert_file(os.path.join(source_folder, "pytorch_model.bin"), os.path.join(dest_folder, "model.safetensors"))
@@ -0,0 +1,239 @@
+# common/model_store.py
+# Imported by both the awq and exl2 pipelines, which share one store on disk.
+
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# ioctl that makes a file share the extents of another (btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+# Files below the Hub's LFS threshold (configs, tokenizers, indexes) are the ones tools
+# rewrite in place, so they are never hardlinked to a blob. Copying them costs little.
+LINK_THRESHOLD = 10 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    repo_id TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    manifest TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (repo_id, revision)
+);
+"""
+
+def _sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def link_or_copy(src: str, dst: str, hardlink: bool = True) -> str:
+    """
+    Create dst with the content of src without duplicating data where possible.
+
+    Tries a hardlink, then a reflink, then falls back to a copy. Returns the
+    method used: 'hardlink', 'reflink' or 'copy'. Without hardlink, dst is always
+    a separate file: a reflink shares extents copy-on-write, so writes to dst
+    never reach src.
+    """
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflink'
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst, HASH_CHUNK_SIZE)
+    shutil.copystat(src, dst)
+    return 'copy'
+
+class ModelStore:
+    """
+    Content-addressed store of model snapshots shared by the quantization pipelines.
+
+    Files are kept once under blobs/sha256/<digest>, whichever repository or
+    revision they came from, and a SQLite database maps each (repo_id, revision)
+    to its {path: digest} manifest. Working directories are materialized from the
+    blobs with hardlinks or reflinks, so a base model quantized by several
+    pipelines is downloaded and stored once. Blobs are made read-only, but that
+    does not stop root, so a hardlinked working file must be replaced rather than
+    rewritten in place. Only files of at least LINK_THRESHOLD bytes, i.e. weights,
+    are hardlinked; smaller files are reflinked or copied.
+
+    When the store grows past its budget, the least recently used snapshots are
+    dropped along with the blobs no remaining snapshot refers to.
+    """
+
+    def __init__(self, root: str, budget: Optional[int] = None):
+        self.root = root
+        self.budget = budget
+        self.blob_dir = os.path.join(root, 'blobs', 'sha256')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(root, 'store.sqlite'), timeout=60)
+        self._connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> 'ModelStore':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest)
+
+    def _snapshot(self, repo_id: str, revision: Optional[str]) -> Optional[tuple]:
+        if revision:
+            return self._connection.execute(
+                "SELECT revision, manifest FROM snapshots WHERE repo_id = ? AND revision = ?",
+                (repo_id, revision)).fetchone()
+        return self._connection.execute(
+            "SELECT revision, manifest FROM snapshots WHERE repo_id = ? ORDER BY last_used DESC LIMIT 1",
+            (repo_id,)).fetchone()
+
+    def manifest(self, repo_id: str, revision: Optional[str] = None) -> Optional[Dict[str, str]]:
+        """
+        The {path: digest} manifest of a stored snapshot. Without a revision, the most
+        recently used snapshot of the repository is returned.
+        """
+        row = self._snapshot(repo_id, revision)
+        return json.loads(row[1]) if row else None
+
+    def _add_blob(self, path: str, digest: str) -> None:
+        blob = self.blob_path(digest)
+        hardlink = os.path.getsize(path) >= LINK_THRESHOLD
+        if not os.path.exists(blob):
+            tmp = f"{blob}.{os.getpid()}.tmp"
+            link_or_copy(os.path.realpath(path), tmp, hardlink)
+            os.chmod(tmp, 0o444)
+            # Concurrent ingests of the same content race harmlessly here
+            os.replace(tmp, blob)
+        elif hardlink and not os.path.samefile(path, blob):
+            # Same content already stored: point the working file at the stored copy
+            tmp = f"{path}.{os.getpid()}.tmp"
+            link_or_copy(blob, tmp)
+            os.replace(tmp, path)
+        with self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO blobs (sha256, size) VALUES (?, ?)",
+                                     (digest, os.path.getsize(blob)))
+
+    def ingest(self, repo_id: str, revision: str, directory: str, digests: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        """
+        Add the files of a downloaded snapshot to the store.
+
+        Args:
+            repo_id: Repository the snapshot came from.
+            revision: Commit of the snapshot.
+            directory: Directory holding the snapshot. Its files become links to the blobs.
+            digests: Already verified sha256 digests by path (e.g. LFS object ids);
+                other files are hashed here.
+
+        Returns:
+            Dict[str, str]: The manifest of the snapshot.
+        """
+        digests = digests or {}
+        manifest = {}
+        for root, dirs, files in os.walk(directory):
+            # Download bookkeeping such as .cache/huggingface is not part of the model
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, directory).replace(os.sep, '/')
+                digest = digests.get(relative) or _sha256(path)
+                self._add_blob(path, digest)
+                manifest[relative] = digest
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO snapshots (repo_id, revision, manifest, last_used) VALUES (?, ?, ?, ?)",
+                (repo_id, revision, json.dumps(manifest, sort_keys=True), time.time()))
+        logger.info(f"Stored {repo_id}@{revision}: {len(manifest)} files")
+        self.evict(keep=(repo_id, revision))
+        return manifest
+
+    def materialize(self, repo_id: str, revision: Optional[str], target_dir: str) -> bool:
+        """
+        Recreate a stored snapshot in target_dir from the blobs.
+
+        Returns False, without touching target_dir, when the snapshot or one of its
+        blobs is not in the store.
+        """
+        row = self._snapshot(repo_id, revision)
+        if row is None:
+            return False
+        revision, manifest = row[0], json.loads(row[1])
+        if not all(os.path.exists(self.blob_path(digest)) for digest in manifest.values()):
+            return False
+
+        methods = {}
+        for relative, digest in manifest.items():
+            path = os.path.join(target_dir, relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path):
+                os.remove(path)
+            blob = self.blob_path(digest)
+            method = link_or_copy(blob, path, os.path.getsize(blob) >= LINK_THRESHOLD)
+            methods[method] = methods.get(method, 0) + 1
+        with self._connection:
+            self._connection.execute("UPDATE snapshots SET last_used = ? WHERE repo_id = ? AND revision = ?",
+                                     (time.time(), repo_id, revision))
+        logger.info(f"Materialized {repo_id}@{revision} in {target_dir} from the model store ({methods})")
+        return True
+
+    def size(self) -> int:
+        return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def evict(self, keep: Optional[tuple] = None) -> int:
+        """
+        Drop least recently used snapshots until the blobs fit in the budget.
+
+        The snapshot named by keep is never dropped. Returns the bytes freed.
+        """
+        if self.budget is None:
+            return 0
+        freed = 0
+        while self.size() > self.budget:
+            victims = [row for row in self._connection.execute(
+                "SELECT repo_id, revision FROM snapshots ORDER BY last_used").fetchall() if tuple(row) != keep]
+            if not victims:
+                break
+            repo_id, revision = victims[0]
+            with self._connection:
+                self._connection.execute("DELETE FROM snapshots WHERE repo_id = ? AND revision = ?", (repo_id, revision))
+            referenced = set()
+            for (manifest,) in self._connection.execute("SELECT manifest FROM snapshots"):
+                referenced.update(json.loads(manifest).values())
+            for digest, size in self._connection.execute("SELECT sha256, size FROM blobs").fetchall():
+                if digest not in referenced:
+                    try:
+                        os.remove(self.blob_path(digest))
+                    except FileNotFoundError:
+                        pass
+                    with self._connection:
+                        self._connection.execute("DELETE FROM blobs WHERE sha256 = ?", (digest,))
+                    freed += size
+            logger.info(f"Evicted {repo_id}@{revision} from the model store")
+        return freed
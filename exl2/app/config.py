@@ -55,6 +55,10 @@ class Config:
     # Bits per weight (BPW) configurations
     BPW_VALUES = ["8.0", "6.5", "5.0", "4.5", "4.0", "3.5", "3.0", "2.5", "2.0"]
 
+    # Content-addressed store of downloaded models shared by the awq and exl2 pipelines, empty to disable
+    MODEL_STORE_DIR = os.getenv('MODEL_STORE_DIR', os.path.join(APP_HOME, 'model-store'))
+    MODEL_STORE_BUDGET_GB = float(os.getenv('MODEL_STORE_BUDGET_GB', '500'))  # Least recently used models are evicted above this
+
     # Authentication Settings
     HF_ACCESS_TOKEN = os.getenv('HF_ACCESS_TOKEN')
 
@@ -1,9 +1,16 @@
 import os
+import sys
 import logging
 import argparse
 from typing import List
+
+# The model store is shared with the awq pipeline and lives in the repository's common/ directory.
+# The repository root goes first so an installed package named common cannot shadow it
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
 from .config import Config
 from .quantization import run_quantization, validate_quantized_model
+from common.model_store import ModelStore
 from huggingface_hub import login, HfApi
 from exllamav2.conversion.convert_exl2 import convert_model
 
@@ -22,7 +29,21 @@ def download_model(author: str, model: str) -> str:
     api = HfApi()
     model_id = f"{author}/{model}"
     model_path = os.path.join(Config.DATA_DIR, f"{author}-{model}")
-    api.snapshot_download(repo_id=model_id, local_dir=model_path)
+    if not Config.MODEL_STORE_DIR:
+        api.snapshot_download(repo_id=model_id, local_dir=model_path)
+        return model_path
+
+    # Reuse a snapshot another run (or the awq pipeline) already stored
+    with ModelStore(Config.MODEL_STORE_DIR, int(Config.MODEL_STORE_BUDGET_GB * 1024 ** 3)) as store:
+        try:
+            revision = api.model_info(model_id).sha
+        except Exception as e:
+            logger.warning(f"Could not resolve the revision of {model_id}, using the latest stored snapshot: {str(e)}")
+            revision = None
+        if not store.materialize(model_id, revision, model_path):
+            api.snapshot_download(repo_id=model_id, local_dir=model_path)
+            if revision:
+                store.ingest(model_id, revision, model_path)
     return model_path
 
 def main(author: str, model: str, quanter: str = None):